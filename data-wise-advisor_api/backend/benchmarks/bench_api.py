@@ -0,0 +1,214 @@
+"""Latency, throughput, memory and upstream calls of every /api/shopify endpoint.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_api --sizes 10000 100000 1000000
+
+Each shop size runs in its own process against a ``FakeShopify`` of that
+many orders, with a fresh store and snapshot directory, so peak RSS is per
+size. The initial sync is timed first; then every endpoint gets one cold
+call followed by ``--requests`` warm calls at ``--concurrency``. Upstream
+calls are what the fake Shopify served during each phase, 429s included.
+
+The fake's rate limit defaults to a generous one so large shops sync in
+minutes; pass ``--leak-rate 2 --bucket 40`` for standard-plan behaviour.
+The initial sync is a bulk export unless ``--rest-sync`` is given.
+The app's own warnings go to stderr; redirect it to keep the tables tidy.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+SHOP = "bench.myshopify.com"
+SECRET = "bench-webhook-secret"
+TOKEN = "bench-dashboard-token"
+
+# (method, path, params); the data endpoint is also asked for a date range
+ENDPOINTS = [
+    ("GET", "/api/shopify/data", {}),
+    ("GET", "/api/shopify/data", {"start_date": "{month_ago}", "end_date": "{today}"}),
+    ("GET", "/api/shopify/data/stream", {"format": "ndjson"}),
+    ("GET", "/api/shopify/records/orders", {"limit": 250}),
+    ("GET", "/api/shopify/customer_cohorts", {"months": 12}),
+    ("GET", "/api/shopify/sales_analytics", {}),
+    ("GET", "/api/shopify/sessions", {}),
+    ("GET", "/api/shopify/device_types", {}),
+    ("GET", "/api/shopify/top_products", {}),
+    ("GET", "/api/shopify/top_products", {"start_date": "{month_ago}", "end_date": "{today}", "level": "product"}),
+    ("GET", "/api/shopify/products/search", {"q": "product 1"}),
+    ("GET", "/api/shopify/products/1/sales", {"bucket": "month"}),
+    ("GET", "/api/shopify/inventory/sell_through", {}),
+    ("GET", "/api/shopify/reports", {}),
+    ("POST", "/api/shopify/sync", {}),
+    ("GET", "/api/shopify/sync", {}),
+    ("POST", "/api/shopify/webhooks/orders/updated", {}),
+    ("GET", "/api/shopify/webhooks", {}),
+    ("GET", "/api/shopify/jobs", {}),
+    ("GET", "/api/shopify/rate_limit", {}),
+    ("GET", "/api/shopify/cache", {}),
+]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def configure(workdir, bulk_sync=True):
+    """Point the app at a scratch store before it is imported"""
+    os.environ.update({
+        "SHOPIFY_BULK_SYNC": "1" if bulk_sync else "0",
+        "SHOPIFY_BULK_POLL_INTERVAL": "0.2",
+        "SHOPIFY_SHOP": SHOP,
+        "SHOPIFY_ACCESS_TOKEN": "bench",
+        "SHOPIFY_WEBHOOK_SECRET": SECRET,
+        "SHOPIFY_DASHBOARD_TOKEN": TOKEN,
+        "SHOPIFY_STORE_PATH": os.path.join(workdir, "shopify_store.db"),
+        "SHOPIFY_SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+        "SHOPIFY_DATA_DIR": os.path.join(workdir, "shops"),
+        "SHOPIFY_BACKGROUND_REFRESH": "0",
+    })
+    os.environ.pop("SHOPIFY_SHOPS_FILE", None)
+
+
+def webhook_request(fake, i):
+    """A signed orders/updated delivery for an existing order"""
+    import webhooks
+
+    order = fake.order(i % fake.order_count)
+    body = json.dumps(order).encode()
+    return body, {
+        "X-Shopify-Hmac-Sha256": webhooks.sign(body, SECRET),
+        "X-Shopify-Webhook-Id": f"bench-{i}",
+        "Content-Type": "application/json",
+    }
+
+
+async def measure(api, fake, method, path, params, requests, concurrency):
+    counter = iter(range(requests + 1))
+
+    async def call():
+        i = next(counter)
+        body, headers = webhook_request(fake, i) if "/webhooks/" in path else (None, None)
+        started = time.perf_counter()
+        resp = await api.request(method, path, params=params, content=body, headers=headers)
+        elapsed = time.perf_counter() - started
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {resp.status_code}: {resp.text[:200]}")
+        return elapsed
+
+    calls_before = sum(fake.calls.values())
+    cold = await call()
+    cold_calls = sum(fake.calls.values()) - calls_before
+
+    latencies = []
+
+    async def worker(n):
+        for _ in range(n):
+            latencies.append(await call())
+
+    per_worker = [requests // concurrency + (w < requests % concurrency) for w in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in per_worker if n))
+    wall = time.perf_counter() - started
+    return {
+        "cold_ms": cold * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "rps": len(latencies) / wall if wall else 0.0,
+        "cold_calls": cold_calls,
+        "warm_calls": sum(fake.calls.values()) - calls_before - cold_calls,
+        "rss_mb": peak_rss_mb(),
+    }
+
+
+async def run(args):
+    from datetime import date, timedelta
+
+    import httpx
+
+    from benchmarks.fake_shopify import FakeShopify
+
+    workdir = tempfile.mkdtemp(prefix="bench-api-")
+    configure(workdir, bulk_sync=not args.rest_sync)
+    import main
+    from rate_limit import LeakyBucketScheduler
+    from shopify_client import ShopifyClient
+
+    fake = FakeShopify(
+        orders=args.run, products=args.products, seed=args.seed, latency=args.latency,
+        bucket_size=args.bucket, leak_rate=args.leak_rate, throttle_rate=args.throttle_rate,
+    )
+    main.registry.client_factory = lambda domain, creds: ShopifyClient(
+        domain, creds.get("access_token", ""), max_concurrency=main.SHOPIFY_MAX_CONCURRENCY,
+        scheduler=LeakyBucketScheduler(capacity=args.bucket, leak_rate=args.leak_rate),
+        fair_share=main.fair_share, transport=fake,
+    )
+    dates = {"today": date.today().isoformat(), "month_ago": (date.today() - timedelta(days=30)).isoformat()}
+
+    print(f"\n== {args.run:,} orders, {args.products} products, {fake.customer_count:,} customers ==")
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://bench", headers={"X-Shopify-Shop-Domain": SHOP, "Authorization": f"Bearer {TOKEN}"}, timeout=None,
+    ) as api:
+        started = time.perf_counter()
+        resp = await api.post("/api/shopify/sync")
+        resp.raise_for_status()
+        sync_s = time.perf_counter() - started
+        print(f"initial sync: {sync_s:.1f}s, {args.run / sync_s:,.0f} orders/s, "
+              f"{sum(fake.calls.values())} upstream calls ({fake.throttled} throttled), "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+
+        print(f"{'endpoint':<48} {'cold ms':>9} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} "
+              f"{'calls':>11} {'RSS MB':>7}")
+        for method, path, params in ENDPOINTS:
+            params = {k: v.format(**dates) if isinstance(v, str) else v for k, v in params.items()}
+            result = await measure(api, fake, method, path, params, args.requests, args.concurrency)
+            label = f"{method} {path}" + (f"?{'&'.join(f'{k}={v}' for k, v in params.items())}" if params else "")
+            print(f"{label[:48]:<48} {result['cold_ms']:>9.1f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+                  f"{result['rps']:>8.0f} {result['cold_calls']:>5}/{result['warm_calls']:<5} "
+                  f"{result['rss_mb']:>7.0f}")
+
+        print(f"upstream calls by endpoint: {json.dumps(fake.snapshot()['calls'], sort_keys=True)}")
+        print(f"throttled by fake Shopify: {fake.throttled}, "
+              f"client retries: {main.registry.get(SHOP).client.scheduler.stats['retries']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=200, help="Warm requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated upstream latency in seconds")
+    parser.add_argument("--bucket", type=int, default=400, help="Fake Shopify bucket size")
+    parser.add_argument("--leak-rate", type=float, default=200.0, help="Fake Shopify calls per second")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--rest-sync", action="store_true", help="Sync through REST pages instead of a bulk export")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        asyncio.run(run(args))
+        return
+
+    # One process per size so each reports its own peak RSS
+    for size in args.sizes:
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_api", *sys.argv[1:], "--run", str(size)], check=True)
+
+
+if __name__ == "__main__":
+    main()
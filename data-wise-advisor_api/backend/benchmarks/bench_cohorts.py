@@ -0,0 +1,132 @@
+"""Cohort engine: full rebuild, incremental batches and reads at scale.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_cohorts --customers 1000000 --orders 2500000
+
+Incremental batches mix new orders with edits to existing ones (including
+moving an order to another month, which can change a customer's cohort).
+The incrementally maintained tables are then checked against a rebuild
+from the final order set.
+"""
+import argparse
+import itertools
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import cohorts
+import metrics
+from benchmarks.synthetic import generate_orders
+
+BATCH = 250
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(cohorts.SCHEMA)
+    return conn
+
+
+def base_orders(args):
+    # A fixed start so regenerating the base orders yields identical timestamps
+    return generate_orders(args.orders, customers=args.customers, seed=args.seed, start=args.start)
+
+
+def edits(args, batch):
+    """A batch of new orders plus edited copies of existing ones, and the originals they replace"""
+    originals = list(itertools.islice(base_orders(args), batch * BATCH, batch * BATCH + BATCH // 2))
+    edited = []
+    for order in originals:
+        order = dict(order)
+        created = datetime.fromisoformat(order["created_at"]) - timedelta(days=45)
+        order["created_at"] = created.strftime("%Y-%m-%dT%H:%M:%S-00:00")
+        order["total_price"] = f"{float(order['total_price']) * 1.1:.2f}"
+        edited.append(order)
+    fresh = list(generate_orders(
+        BATCH - len(edited), customers=args.customers * 2, seed=args.seed + 1 + batch,
+        start=datetime.now(timezone.utc) - timedelta(days=30), days=30,
+    ))
+    for i, order in enumerate(fresh):
+        order["id"] = 9_000_000_000 + batch * BATCH + i
+    return originals, edited + fresh
+
+
+def same(expected, actual, path="cohorts"):
+    if isinstance(expected, dict):
+        assert set(expected) == set(actual), f"{path}: keys differ"
+        for key in expected:
+            same(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, list):
+        assert len(expected) == len(actual), f"{path}: lengths differ"
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            same(e, a, f"{path}[{i}]")
+    else:
+        assert expected == actual, f"{path}: {expected} != {actual}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--customers", type=int, default=1_000_000)
+    parser.add_argument("--orders", type=int, default=2_500_000)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--no-check", action="store_true", help="Skip the rebuild comparison")
+    args = parser.parse_args()
+    args.start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=730)
+    workdir = tempfile.mkdtemp(prefix="bench-cohorts-")
+
+    started = time.perf_counter()
+    cols = metrics.build_columns(base_orders(args))
+    print(f"columns for {args.orders} orders: {time.perf_counter() - started:.1f}s")
+
+    conn = connect(os.path.join(workdir, "incremental.db"))
+    started = time.perf_counter()
+    cohorts.rebuild(conn, cols)
+    conn.commit()
+    rebuild_s = time.perf_counter() - started
+    customers = conn.execute("SELECT SUM(customers) FROM cohort_sizes").fetchone()[0]
+    print(f"full rebuild: {rebuild_s:.1f}s for {customers} customers")
+
+    started = time.perf_counter()
+    for _ in range(10):
+        cohorts.summary(conn, max_age=24)
+    print(f"read matrix (24 months): {(time.perf_counter() - started) / 10 * 1000:.1f}ms")
+
+    timings = []
+    replaced = {}
+    added = []
+    for batch in range(args.batches):
+        originals, updated = edits(args, batch)
+        started = time.perf_counter()
+        cohorts.apply(conn, [(metrics.build_columns(originals), -1), (metrics.build_columns(updated), 1)])
+        conn.commit()
+        timings.append(time.perf_counter() - started)
+        for order in updated:
+            if order["id"] >= 9_000_000_000:
+                added.append(order)
+            else:
+                replaced[order["id"]] = order
+    timings.sort()
+    print(f"incremental batch of {BATCH}: p50 {timings[len(timings) // 2] * 1000:.1f}ms "
+          f"max {timings[-1] * 1000:.1f}ms ({rebuild_s / timings[len(timings) // 2]:.0f}x faster than a rebuild)")
+
+    if not args.no_check:
+        final = itertools.chain((replaced.get(o["id"], o) for o in base_orders(args)), added)
+        check = connect(os.path.join(workdir, "rebuilt.db"))
+        cohorts.rebuild(check, metrics.build_columns(final))
+        same(cohorts.summary(check, max_age=24), cohorts.summary(conn, max_age=24))
+        for table, key in (("cohort_cells", "cohort, age"), ("cohort_sizes", "cohort")):
+            query = f"SELECT * FROM {table} ORDER BY {key}"
+            expected, actual = check.execute(query).fetchall(), conn.execute(query).fetchall()
+            assert len(expected) == len(actual), f"{table}: row counts differ"
+            for e, a in zip(expected, actual):
+                assert e == a, f"{table}: {e} != {a}"
+        print("incremental state matches a full rebuild")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Scaling benchmark for the metrics aggregation engine.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_metrics --sizes 10000 100000 1000000
+
+``reference_metrics`` is the original get_shopify_data computation, one
+pass over the order dicts per metric, and every field of
+``metrics.compute_metrics`` is checked against it. Cold times include
+building the columns from the order dicts; warm times aggregate columns
+that are already built, as the snapshot serves them.
+"""
+import argparse
+import math
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import metrics
+from benchmarks.synthetic import generate_orders
+
+
+def reference_metrics(orders, current_year):
+    """The original multi-pass dict walk, in the shape of ``metrics.compute_metrics``.
+
+    Returns read the embedded refunds where the original fetched
+    ``orders/{id}/refunds``; the synthetic orders carry the same refunds.
+    """
+    gross_sales = sum(float(o.get("total_line_items_price", 0)) for o in orders)
+    discounts = sum(float(o.get("total_discounts", 0)) for o in orders)
+
+    returns = 0.0
+    for order in orders:
+        for refund in order.get("refunds", []):
+            txs = refund.get("transactions", [])
+            if txs and isinstance(txs, list):
+                returns += sum(float(tx.get("amount", 0)) for tx in txs)
+
+    net_sales = gross_sales - discounts - returns
+    shipping = sum(float(o.get("total_shipping_price_set", {}).get("shop_money", {}).get("amount", 0))
+                   for o in orders if o.get("total_shipping_price_set"))
+    taxes = sum(float(o.get("total_tax", 0)) for o in orders)
+    total_sales = sum(float(o.get("total_price", 0)) for o in orders)
+
+    orders_fulfilled = sum(1 for o in orders if o.get("fulfillment_status") == "fulfilled")
+    order_count = len(orders)
+    aov = total_sales / order_count if order_count > 0 else 0
+
+    customer_orders = defaultdict(int)
+    for o in orders:
+        email = o.get("email")
+        if email:
+            customer_orders[email] += 1
+    returning_customers = sum(1 for email, count in customer_orders.items() if count > 1)
+    total_customers = len(customer_orders)
+    returning_customer_rate = (returning_customers / total_customers) * 100 if total_customers else 0
+
+    sales_by_channel = defaultdict(float)
+    for o in orders:
+        sales_by_channel[o.get("source_name", "Other")] += float(o.get("total_price", 0))
+
+    sales_by_product = defaultdict(float)
+    for o in orders:
+        for item in o.get("line_items", []):
+            sales_by_product[metrics.product_name(item)] += float(item.get("price", 0)) * int(item.get("quantity", 1))
+
+    current_year_data = [0.0] * 12
+    previous_year_data = [0.0] * 12
+    for o in orders:
+        created = o.get("created_at")
+        if created:
+            dt = datetime.fromisoformat(created.replace("Z", "+00:00")).astimezone(timezone.utc)
+            if dt.year == current_year:
+                current_year_data[dt.month - 1] += float(o.get("total_price", 0))
+            elif dt.year == current_year - 1:
+                previous_year_data[dt.month - 1] += float(o.get("total_price", 0))
+
+    return {
+        "order_count": order_count,
+        "orders_fulfilled": orders_fulfilled,
+        "gross_sales": gross_sales,
+        "discounts": discounts,
+        "returns": returns,
+        "net_sales": net_sales,
+        "shipping": shipping,
+        "taxes": taxes,
+        "total_sales": total_sales,
+        "aov": aov,
+        "total_customers": total_customers,
+        "returning_customers": returning_customers,
+        "returning_customer_rate": returning_customer_rate,
+        "sales_by_channel": dict(sales_by_channel),
+        "sales_by_product": dict(sales_by_product),
+        "sales_over_time": {
+            "current_year": dict(zip(metrics.MONTHS, current_year_data)),
+            "previous_year": dict(zip(metrics.MONTHS, previous_year_data)),
+        },
+    }
+
+
+def same(expected, actual, path="metrics"):
+    if isinstance(expected, dict):
+        assert set(expected) == set(actual), f"{path}: keys differ: {set(expected) ^ set(actual)}"
+        for key in expected:
+            same(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, float):
+        # Summation order differs, so money sums agree to rounding error only
+        assert math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-6), f"{path}: {expected} != {actual}"
+    else:
+        assert expected == actual, f"{path}: {expected} != {actual}"
+
+
+def run(size, check=True):
+    orders = list(generate_orders(size, seed=size))
+    current_year = datetime.now(timezone.utc).year
+
+    started = time.perf_counter()
+    refunds = {o["id"]: metrics.refund_amount(o.get("refunds")) for o in orders}
+    cols = metrics.OrderColumnsBuilder().extend(orders, refunds).build()
+    built = time.perf_counter()
+    summary = metrics.compute_metrics(cols, current_year=current_year)
+    computed = time.perf_counter()
+
+    row = {
+        "orders": size,
+        "build_s": built - started,
+        "aggregate_s": computed - built,
+        "cold_s": computed - started,
+    }
+    if check:
+        started = time.perf_counter()
+        expected = reference_metrics(orders, current_year)
+        row["reference_s"] = time.perf_counter() - started
+        same(expected, summary)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--no-check", action="store_true", help="Skip the reference implementation")
+    args = parser.parse_args()
+
+    print(f"{'orders':>10} {'build s':>9} {'aggr s':>9} {'cold s':>9} {'ref s':>9} {'cold x':>8} {'warm x':>8}")
+    for size in args.sizes:
+        row = run(size, check=not args.no_check)
+        reference = row.get("reference_s", float("nan"))
+        # Below 1x the columns cost more to build than one walk of the dicts
+        print(f"{row['orders']:>10} {row['build_s']:>9.3f} {row['aggregate_s']:>9.4f} {row['cold_s']:>9.3f} "
+              f"{reference:>9.3f} {reference / row['cold_s']:>8.2f} {reference / row['aggregate_s']:>8.0f}")
+    if not args.no_check:
+        print("every compute_metrics field matches the reference")
+
+
+if __name__ == "__main__":
+    main()
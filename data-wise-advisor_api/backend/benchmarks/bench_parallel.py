@@ -0,0 +1,116 @@
+"""Single-process vs. time-sharded rebuilds of the order columns and rollup rows.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_parallel --orders 300000 --workers 1 2 4 8
+
+A store is filled with synthetic orders (a few without a creation date).
+The columns are built the way ``main.order_columns`` builds them in one
+process, then with ``parallel.build_columns_sharded`` for every worker
+count; the sharded columns must be identical and give the same
+``metrics.compute_metrics`` result. The rollup rows of the snapshot are
+likewise compared with ``rollups.day_rows``. Times are the best of
+``--repeat`` runs, so the pool's process start-up is not counted.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+import parallel
+import refunds
+import rollups
+import snapshot
+import store
+from benchmarks.synthetic import generate_orders
+
+
+def fill(path, count, seed):
+    batch = []
+    for i, order in enumerate(generate_orders(count, seed=seed)):
+        if i % 1000 == 999:
+            order["created_at"] = None
+        batch.append(order)
+        if len(batch) == 10_000:
+            store.upsert("orders", batch, path=path)
+            batch = []
+    store.upsert("orders", batch, path=path)
+
+
+def build_columns(path):
+    """The single-process build of ``main.order_columns``, without the Shopify refund lookups"""
+    builder = metrics.OrderColumnsBuilder()
+    after_id = None
+    while True:
+        batch = store.load_page("orders", after_id=after_id, limit=parallel.PAGE_SIZE, path=path)
+        if not batch:
+            return builder.build()
+        totals, _ = refunds.local_totals(batch)
+        builder.extend(batch, totals)
+        after_id = batch[-1]["id"]
+
+
+def identical(expected, actual):
+    for name in expected.order_fields + expected.item_fields:
+        assert np.array_equal(getattr(expected, name), getattr(actual, name)), f"column {name} differs"
+    for name in ("channels", "customers", "products"):
+        assert getattr(expected, name) == getattr(actual, name), f"dictionary {name} differs"
+
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=300_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-parallel-")
+    path = os.path.join(workdir, "store.db")
+    fill(path, args.orders, seed=args.orders)
+    # The first build caches the embedded refund totals; every timed build then reads them alike
+    store.use(path)
+    build_columns(path)
+
+    build_s, cols = timed(lambda: build_columns(path), args.repeat)
+    expected = metrics.compute_metrics(cols)
+    _, cols = snapshot.open_dir(snapshot.write("orders", cols, "bench", base=workdir))
+    rows_s, rows = timed(lambda: rollups.day_rows(cols), args.repeat)
+
+    print(f"{os.cpu_count()} CPUs, {args.orders} orders")
+    print(f"{'workers':>8} {'columns s':>10} {'speedup':>8} {'rollups s':>10} {'speedup':>8}")
+    print(f"{'-':>8} {build_s:>10.3f} {1:>8.2f} {rows_s:>10.3f} {1:>8.2f}")
+    for workers in args.workers:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            ranges = store.created_ranges("orders", workers, path=path)
+            sharded_s, (sharded, missing) = timed(
+                lambda: parallel.build_columns_sharded(path, ranges, pool), args.repeat
+            )
+            assert not missing, "synthetic orders embed their refunds"
+            identical(cols, sharded)
+            assert metrics.compute_metrics(sharded) == expected, "compute_metrics differs"
+
+            sharded_rows_s, sharded_rows = timed(
+                lambda: parallel.rollup_rows_sharded(cols, workers, pool), args.repeat
+            )
+            assert sharded_rows == rows, "rollup rows differ"
+        print(f"{workers:>8} {sharded_s:>10.3f} {build_s / sharded_s:>8.2f} "
+              f"{sharded_rows_s:>10.3f} {rows_s / sharded_rows_s:>8.2f}")
+    print("sharded columns, compute_metrics and rollup rows match the single-process build")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Product sales index: rankings, search and series at catalog scale.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_products --skus 100000 --rows 3000000
+
+Daily rollup rows are generated with a skewed popularity so a few SKUs
+dominate, as in real catalogs. Each query is timed in process,
+next to the ``GROUP BY`` over ``rollup_daily_product`` it replaces. After
+the incremental batches, rankings are checked against that query.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+import rollups
+from product_sales import ProductSalesIndex
+
+BATCH = 250
+
+
+def generate_rows(args):
+    rng = np.random.default_rng(args.seed)
+    skus = (args.skus * rng.random(args.rows) ** 3).astype(np.int64)
+    days = rng.integers(args.first_day, args.first_day + args.days, args.rows)
+    quantity = rng.integers(1, 5, args.rows)
+    price = 5 + (np.arange(args.skus) * 7919 % 2500) / 10
+    # One row per (day, SKU), like the rollup table
+    keys, inverse = np.unique(days * args.skus + skus, return_inverse=True)
+    quantity = np.bincount(inverse, weights=quantity).astype(np.int64)
+    days, skus = keys // args.skus, keys % args.skus
+    return [
+        (int(day), 1 + int(sku) // 4, 10_000_000 + int(sku), f"Product {int(sku) // 4} | Size {int(sku) % 4}",
+         int(q), round(float(q * price[sku]), 2))
+        for day, sku, q in zip(days, skus, quantity)
+    ]
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat * 1e6, result
+
+
+def uncached(top, *args, **kwargs):
+    """A date-range ranking computed from the rows, not remembered from the previous call"""
+    top.__self__._ranges.clear()
+    return top(*args, **kwargs)
+
+
+def sql_top(conn, n, first, last):
+    return conn.execute(
+        "SELECT product_id, variant_id, SUM(amount) AS total FROM rollup_daily_product "
+        "WHERE day BETWEEN ? AND ? GROUP BY product_id, variant_id ORDER BY total DESC LIMIT ?",
+        (first, last, n),
+    ).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--skus", type=int, default=100_000)
+    parser.add_argument("--rows", type=int, default=3_000_000, help="Sales rows before (day, SKU) grouping")
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+    args.first_day = rollups.day_number("2023-01-01")
+    last_day = args.first_day + args.days - 1
+
+    rows = generate_rows(args)
+    conn = sqlite3.connect(os.path.join(tempfile.mkdtemp(prefix="bench-products-"), "store.db"))
+    conn.executescript(rollups.SCHEMA)
+    conn.executemany("INSERT INTO rollup_daily_product VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    index = ProductSalesIndex()
+    started = time.perf_counter()
+    index.load(rows)
+    print(f"load {len(rows)} rows, {len(index.names)} SKUs: {time.perf_counter() - started:.2f}s")
+
+    queries = [
+        ("top 10 variants by revenue, all time", lambda: index.top(10)),
+        ("top 10 products by quantity, all time", lambda: index.top(10, "quantity", "product")),
+        ("top 10 variants, last 30 days", lambda: uncached(index.top, 10, first=last_day - 29, last=last_day)),
+        ("top 10 products, last 365 days", lambda: uncached(index.top, 10, level="product",
+                                                            first=last_day - 364, last=last_day)),
+        ("top 10 variants, last 30 days (repeated)", lambda: index.top(10, first=last_day - 29, last=last_day)),
+        ("search 'product 12'", lambda: index.search("product 12", 20)),
+        ("search 'size 3' (title words)", lambda: index.search("size 3", 20)),
+        ("daily series of a best seller, 90 days", lambda: index.series(1, first=last_day - 89, last=last_day)),
+        ("monthly series of a best seller, all time", lambda: index.series(1, bucket="month")),
+    ]
+    print(f"{'query':<45} {'index':>10}")
+    for label, query in queries:
+        micros, _ = timed(query, args.repeat)
+        print(f"{label:<45} {micros:>8.0f}us")
+    for label, first in (("all time", args.first_day), ("last 30 days", last_day - 29)):
+        micros, _ = timed(lambda: sql_top(conn, 10, first, last_day), 3)
+        print(f"{'SQL GROUP BY top 10, ' + label:<45} {micros:>8.0f}us")
+
+    # Incremental batches: order edits move sales between days and SKUs
+    rng = random.Random(args.seed)
+    timings = []
+    for _ in range(args.batches):
+        changes = []
+        for _ in range(BATCH):
+            day, product_id, variant_id, name, quantity, amount = rows[rng.randrange(len(rows))]
+            changes.append((day, product_id, variant_id, name, -1, -amount / max(quantity, 1)))
+            changes.append((last_day, product_id, variant_id, name, 1, amount / max(quantity, 1)))
+        conn.executemany(rollups._UPSERT_PRODUCT, changes)
+        started = time.perf_counter()
+        index.apply(changes)
+        timings.append(time.perf_counter() - started)
+    conn.commit()
+    timings.sort()
+    print(f"apply a batch of {BATCH} order edits: p50 {timings[len(timings) // 2] * 1000:.2f}ms "
+          f"max {timings[-1] * 1000:.2f}ms")
+    micros, _ = timed(lambda: index.top(10), args.repeat)
+    print(f"{'top 10 variants after the batches':<45} {micros:>8.0f}us")
+
+    for first in (args.first_day, last_day - 29):
+        expected = [(p, v) for p, v, _ in sql_top(conn, 10, first, last_day)]
+        actual = [(e["product_id"], e["variant_id"]) for e in index.top(10, first=first, last=last_day)]
+        assert expected == actual, f"ranking from day {first} differs: {expected} != {actual}"
+    print("rankings match the rollup table")
+
+
+if __name__ == "__main__":
+    main()
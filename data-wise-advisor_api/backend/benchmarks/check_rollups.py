@@ -0,0 +1,127 @@
+"""Incremental rollups and cohorts against a rebuild of the same orders.
+
+Run from the backend directory:
+
+    python -m benchmarks.check_rollups --orders 5000 --updates 2000
+
+A store is synced from the fake shop and its rollups built. Random order
+updates (moved ``created_at``, new prices, channels and emails, added
+refunds) are then queued as webhooks and drained by two workers at once.
+The incrementally maintained rollup and cohort summaries must equal those
+of a second store rebuilt from the final orders, and every event must
+have been applied exactly once.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import metrics
+import store
+import webhooks
+from benchmarks import synthetic
+from benchmarks.fake_shopify import FakeShopify
+
+
+def columns(path):
+    """Columnar view of every order in the store at ``path``, refunds taken from the payloads"""
+    orders = store.load("orders", path=path)
+    totals = {order["id"]: metrics.refund_amount(order.get("refunds")) for order in orders}
+    return metrics.OrderColumnsBuilder().extend(orders, totals).build()
+
+
+def build(path):
+    """Rebuild the rollups of the store at ``path`` from its stored orders"""
+    assert store.rebuild_rollups(columns(path), store.version("orders", path=path), path=path)
+
+
+def update(order, rng, now):
+    """A random edit of ``order`` as Shopify would send it in orders/updated"""
+    order = json.loads(json.dumps(order))
+    change = rng.choice(("created_at", "price", "channel", "email", "refund"))
+    if change == "created_at":
+        created = datetime.fromisoformat(order["created_at"]) + timedelta(days=rng.randint(-90, 90))
+        order["created_at"] = created.strftime("%Y-%m-%dT%H:%M:%S-05:00")
+    elif change == "price":
+        order["total_price"] = f"{float(order['total_price']) * rng.uniform(0.5, 1.5):.2f}"
+    elif change == "channel":
+        order["source_name"] = rng.choice(synthetic.CHANNELS)
+    elif change == "email":
+        # A guest checkout is keyed on the email alone
+        order["email"] = f"guest{rng.randrange(50)}@example.com"
+        order["customer"] = None
+    else:
+        order.setdefault("refunds", []).append({
+            "id": rng.randrange(10 ** 12),
+            "order_id": order["id"],
+            "transactions": [{"kind": "refund", "amount": f"{float(order['total_price']) * 0.25:.2f}"}],
+        })
+    order["updated_at"] = now.strftime("%Y-%m-%dT%H:%M:%S-00:00")
+    return order
+
+
+async def drain(workers):
+    return sum(await asyncio.gather(*(worker.drain() for worker in workers)))
+
+
+def same(expected, actual, path="summary"):
+    if isinstance(expected, dict):
+        assert set(expected) == set(actual), f"{path}: keys differ"
+        for key in expected:
+            same(expected[key], actual[key], f"{path}.{key}")
+    elif isinstance(expected, list):
+        assert len(expected) == len(actual), f"{path}: lengths differ"
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            same(e, a, f"{path}[{i}]")
+    else:
+        assert expected == actual, f"{path}: {expected} != {actual}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix="check-rollups-")
+    incremental = os.path.join(workdir, "incremental.db")
+    rebuilt = os.path.join(workdir, "rebuilt.db")
+
+    fake = FakeShopify(orders=args.orders, seed=args.seed)
+    store.upsert("orders", [fake.order(i) for i in range(args.orders)], path=incremental)
+    build(incremental)
+
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    current = {}
+    for n in range(args.updates):
+        i = rng.randrange(args.orders)
+        order = update(current.get(i) or fake.order(i), rng, now + timedelta(seconds=n))
+        current[i] = order
+        store.enqueue_event(str(uuid.uuid4()), "orders/updated", json.dumps(order), path=incremental)
+
+    # The workers drain the default store
+    store.use(incremental)
+    workers = [webhooks.WebhookWorker(owner=f"check-{n}") for n in range(args.workers)]
+    handled = asyncio.run(drain(workers))
+    assert handled == args.updates, f"{handled} events handled for {args.updates} queued"
+    status = store.queue_status()
+    assert status["pending"] == 0 and status["failed"] == 0, f"queue not cleanly drained: {status}"
+    print(f"{handled} events drained by {args.workers} workers: "
+          + ", ".join(str(worker.stats["events"]) for worker in workers))
+
+    store.upsert("orders", store.load("orders", path=incremental), path=rebuilt)
+    build(rebuilt)
+    same(store.rollup_summary(path=rebuilt), store.rollup_summary(path=incremental), "rollups")
+    same(store.cohort_summary(max_age=24, path=rebuilt), store.cohort_summary(max_age=24, path=incremental),
+         "cohorts")
+    print("incremental rollups and cohorts match a full rebuild")
+
+
+if __name__ == "__main__":
+    main()
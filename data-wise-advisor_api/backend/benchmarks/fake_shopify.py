@@ -0,0 +1,399 @@
+"""Deterministic in-process stand-in for the Shopify Admin REST API.
+
+``FakeShopify`` is an ``httpx`` transport, so a ``ShopifyClient`` created
+with ``transport=FakeShopify(...)`` talks to it instead of a real store.
+Records are generated on demand from their index (see ``synthetic``), so
+a shop of a million orders costs no memory until pages are requested.
+
+It serves ``orders``, ``products``, ``customers``, ``orders/{id}/refunds``,
+``reports`` and ``reports/{type}`` with Link-header (``page_info``)
+pagination and ``updated_at_min`` filtering, plus ``locations``,
+``inventory_items`` (by ``ids``) and ``inventory_levels`` (by
+``inventory_item_ids`` or ``location_ids``), with Shopify's caps on how many
+ids one call may name. Each variant's ``inventory_quantity`` is the sum of
+its levels. Every response carries
+``X-Shopify-Shop-Api-Call-Limit`` from a simulated leaky bucket; calls
+that overflow it, plus a seeded fraction of random ones, are answered with
+429 and ``Retry-After``. Latency is simulated with seeded jitter.
+
+``graphql.json`` implements bulk operations: ``bulkOperationRunQuery``
+starts an export of orders, products or customers that completes after
+``bulk_delay`` seconds, ``node(id:)`` reports its status, and the result
+URL streams the same records as flattened JSONL with ``__parentId``
+children, the way Shopify writes them.
+"""
+import asyncio
+import bisect
+import itertools
+import json
+import math
+import random
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks import synthetic
+
+PATH = re.compile(r"/admin/api/[^/]+/(?P<endpoint>.+)\.json$")
+MAX_LIMIT = 250
+BULK_HOST = "bulk.fake-shopify.test"
+# JSONL lines per chunk of a streamed bulk result
+BULK_CHUNK = 2000
+# Most ids a single call may filter on, per endpoint and parameter
+ID_LIMITS = {
+    ("inventory_items", "ids"): 100,
+    ("inventory_levels", "inventory_item_ids"): 50,
+    ("inventory_levels", "location_ids"): 50,
+}
+
+
+def _parse_time(value):
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+class FakeShopify(httpx.AsyncBaseTransport):
+    def __init__(self, orders=10_000, products=200, customers=None, days=730, seed=0,
+                 latency=0.02, jitter=0.5, bucket_size=40, leak_rate=2.0, throttle_rate=0.0,
+                 retry_after=1.0, bulk_delay=0.5, end=None, locations=3):
+        self.order_count = orders
+        self.customer_count = customers or max(1, orders // 4)
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.bulk_delay = bulk_delay
+        # Orders end at a fixed instant so every run of the same shop is identical
+        self.end = end or datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start = self.end - timedelta(days=days)
+        self.step = days * 86400 / max(orders, 1)
+        self.products = synthetic.generate_products(products, seed)
+        self.locations = [{"id": 70_000_000 + n, "name": f"Warehouse {n + 1}", "active": True}
+                          for n in range(locations)]
+        # Inventory item id -> variant, and the item ids stocked at each location
+        self.inventory_items = {}
+        self._stocked = {location["id"]: [] for location in self.locations}
+        for product in self.products:
+            for variant in product["variants"]:
+                item_id = variant["inventory_item_id"]
+                self.inventory_items[item_id] = variant
+                for n, location in enumerate(self.locations):
+                    if n == 0 or (item_id + n) % 3:
+                        self._stocked[location["id"]].append(item_id)
+                variant["inventory_quantity"] = sum(
+                    self.available(item_id, location["id"]) for location in self.locations
+                    if self.stocks(location["id"], item_id))
+        self._rng = random.Random(seed)
+        self._fill = 0.0
+        self._updated = time.monotonic()
+        self.calls = Counter()
+        self.throttled = 0
+        self.bulk_operations = {}
+        self._bulk_ids = itertools.count(1)
+        self.routes = {
+            "orders": self._orders,
+            "products": self._products,
+            "customers": self._customers,
+            "reports": self._reports,
+            "locations": self._locations,
+            "inventory_items": self._inventory_items,
+            "inventory_levels": self._inventory_levels,
+        }
+
+    # ---- shop data ----
+
+    def order(self, i):
+        return synthetic.order_at(i, self.products, self.customer_count, self.seed, self.start, self.step)
+
+    def _first_order_after(self, updated_at_min):
+        if not updated_at_min:
+            return 0
+        seconds = (_parse_time(updated_at_min) - self.start).total_seconds()
+        return min(self.order_count, max(0, math.ceil(seconds / self.step)))
+
+    def _orders(self, params, offset):
+        first = self._first_order_after(params.get("updated_at_min"))
+        return self.order_count - first, lambda i: self.order(first + i)
+
+    def _products(self, params, offset):
+        return len(self.products), lambda i: self.products[i]
+
+    def _customers(self, params, offset):
+        return self.customer_count, lambda i: synthetic.customer_at(i, self.seed)
+
+    def _reports(self, params, offset):
+        names = ["sales", "sessions", "conversion", "traffic_sources", "device_types", "top_products",
+                 "customer_cohorts", "product_sell_through"]
+        return len(names), lambda i: {"id": i + 1, "name": names[i], "category": "analytics"}
+
+    # ---- inventory ----
+
+    def stocks(self, location_id, item_id):
+        n = next(i for i, location in enumerate(self.locations) if location["id"] == location_id)
+        return n == 0 or (item_id + n) % 3 != 0
+
+    def available(self, item_id, location_id):
+        # About one level in ten is sold out
+        return max(0, (item_id * 2654435761 + location_id * 40503 + self.seed) % 150 - 15)
+
+    def level(self, item_id, location_id):
+        return {
+            "inventory_item_id": item_id,
+            "location_id": location_id,
+            "available": self.available(item_id, location_id),
+            "updated_at": self.end.strftime("%Y-%m-%dT%H:%M:%S-00:00"),
+        }
+
+    def _locations(self, params, offset):
+        return len(self.locations), lambda i: self.locations[i]
+
+    def _inventory_items(self, params, offset):
+        ids = [int(i) for i in params.get("ids", "").split(",") if i]
+        ids = [i for i in ids if i in self.inventory_items]
+
+        def item(i):
+            variant = self.inventory_items[ids[i]]
+            return {
+                "id": ids[i],
+                "sku": f"SKU-{variant['id']}",
+                "cost": f"{float(variant['price']) * 0.45:.2f}",
+                "tracked": True,
+                "requires_shipping": True,
+                "updated_at": "2022-01-01T00:00:00-00:00",
+            }
+        return len(ids), item
+
+    def _inventory_levels(self, params, offset):
+        if params.get("inventory_item_ids"):
+            ids = [int(i) for i in params["inventory_item_ids"].split(",") if i]
+            pairs = [(item_id, location["id"]) for item_id in ids if item_id in self.inventory_items
+                     for location in self.locations if self.stocks(location["id"], item_id)]
+            return len(pairs), lambda i: self.level(*pairs[i])
+        wanted = {int(i) for i in params.get("location_ids", "").split(",") if i}
+        stocked = [(location_id, items) for location_id, items in self._stocked.items() if location_id in wanted]
+        starts = list(itertools.accumulate((len(items) for _, items in stocked), initial=0))
+
+        def level(i):
+            n = bisect.bisect_right(starts, i) - 1
+            location_id, items = stocked[n]
+            return self.level(items[i - starts[n]], location_id)
+        return starts[-1], level
+
+    def report(self, report_type, params):
+        rng = random.Random(f"{self.seed}:{report_type}:{sorted(params.items())}")
+        return {
+            "name": report_type,
+            "rows": [{"date": (self.end - timedelta(days=d)).date().isoformat(), "value": rng.randint(0, 1000)}
+                     for d in range(30)],
+        }
+
+    # ---- bulk operations ----
+
+    def bulk_lines(self, resource, first):
+        """JSONL lines of a bulk export, children flattened after their parent"""
+        def gid(kind, record_id):
+            return f"gid://shopify/{kind}/{record_id}" if record_id is not None else None
+
+        def money(amount):
+            return {"shopMoney": {"amount": amount}}
+
+        if resource == "orders":
+            for i in range(first, self.order_count):
+                order = self.order(i)
+                parent = gid("Order", order["id"])
+                subtotal = float(order["total_line_items_price"]) - float(order["total_discounts"])
+                yield json.dumps({
+                    "id": parent,
+                    "createdAt": order["created_at"],
+                    "updatedAt": order["updated_at"],
+                    "email": order["email"],
+                    "sourceName": order["source_name"],
+                    "displayFulfillmentStatus": "FULFILLED" if order["fulfillment_status"] == "fulfilled"
+                    else "UNFULFILLED",
+                    "customer": {"id": gid("Customer", order["customer"]["id"])},
+                    "subtotalPriceSet": money(f"{subtotal:.2f}"),
+                    "totalDiscountsSet": money(order["total_discounts"]),
+                    "totalTaxSet": money(order["total_tax"]),
+                    "totalShippingPriceSet": money(order["total_shipping_price_set"]["shop_money"]["amount"]),
+                    "totalPriceSet": money(order["total_price"]),
+                    "refunds": [
+                        {"id": gid("Refund", refund["id"]), "createdAt": order["created_at"],
+                         "totalRefundedSet": money(refund["transactions"][0]["amount"])}
+                        for refund in order["refunds"]
+                    ],
+                })
+                for n, item in enumerate(order["line_items"]):
+                    yield json.dumps({
+                        "id": gid("LineItem", order["id"] * 10 + n),
+                        "title": item["title"],
+                        "variantTitle": item["variant_title"],
+                        "quantity": item["quantity"],
+                        "originalUnitPriceSet": money(item["price"]),
+                        "product": {"id": gid("Product", item["product_id"])},
+                        "variant": {"id": gid("ProductVariant", item["variant_id"])},
+                        "__parentId": parent,
+                    })
+        elif resource == "products":
+            for product in self.products:
+                parent = gid("Product", product["id"])
+                yield json.dumps({"id": parent, "title": product["title"], "createdAt": product["created_at"],
+                                  "updatedAt": product["updated_at"]})
+                for variant in product["variants"]:
+                    yield json.dumps({
+                        "id": gid("ProductVariant", variant["id"]),
+                        "title": variant["title"],
+                        "price": variant["price"],
+                        "inventoryQuantity": variant["inventory_quantity"],
+                        "inventoryItem": {"id": gid("InventoryItem", variant["inventory_item_id"])},
+                        "__parentId": parent,
+                    })
+        elif resource == "customers":
+            for i in range(self.customer_count):
+                customer = synthetic.customer_at(i, self.seed)
+                yield json.dumps({
+                    "id": gid("Customer", customer["id"]),
+                    "email": customer["email"],
+                    "firstName": customer["first_name"],
+                    "lastName": customer["last_name"],
+                    "createdAt": customer["created_at"],
+                    "updatedAt": customer["updated_at"],
+                    "numberOfOrders": str(customer["orders_count"]),
+                })
+
+    def _graphql(self, request):
+        body = json.loads(request.content or b"{}")
+        text, variables = body.get("query", ""), body.get("variables") or {}
+        if "bulkOperationRunQuery" in text:
+            return self._json(200, {"data": {"bulkOperationRunQuery": self._start_bulk(variables.get("query", ""))}})
+        if "currentBulkOperation" in text:
+            # The shop's most recently started bulk operation
+            operation = next(reversed(self.bulk_operations.values()), None)
+            current = dict(self._bulk_status(operation), query=operation["query"]) if operation else None
+            return self._json(200, {"data": {"currentBulkOperation": current}})
+        if "node(" in text:
+            operation = self.bulk_operations.get(variables.get("id"))
+            return self._json(200, {"data": {"node": self._bulk_status(operation) if operation else None}})
+        return self._json(200, {"errors": [{"message": "Unsupported query"}]})
+
+    def _start_bulk(self, bulk_query):
+        if any(op["ready_at"] > time.monotonic() for op in self.bulk_operations.values()):
+            return {"bulkOperation": None, "userErrors": [
+                {"field": None, "message": "A bulk query operation for this app and shop is already in progress"}]}
+        resource = re.search(r"\{\s*(\w+)", bulk_query)
+        resource = resource.group(1) if resource else None
+        if resource not in ("orders", "products", "customers"):
+            return {"bulkOperation": None, "userErrors": [{"field": ["query"], "message": "Invalid bulk query"}]}
+        updated = re.search(r"updated_at:>='([^']+)'", bulk_query)
+        first = self._first_order_after(updated.group(1)) if updated and resource == "orders" else 0
+        number = next(self._bulk_ids)
+        operation_id = f"gid://shopify/BulkOperation/{number}"
+        self.bulk_operations[operation_id] = {
+            "id": operation_id, "number": number, "resource": resource, "first": first, "query": bulk_query,
+            "ready_at": time.monotonic() + self.bulk_delay,
+        }
+        return {"bulkOperation": {"id": operation_id, "status": "CREATED"}, "userErrors": []}
+
+    def _bulk_status(self, operation):
+        if time.monotonic() < operation["ready_at"]:
+            return {"id": operation["id"], "status": "RUNNING", "errorCode": None, "objectCount": "0",
+                    "url": None, "partialDataUrl": None}
+        count = {"orders": self.order_count - operation["first"], "products": len(self.products),
+                 "customers": self.customer_count}[operation["resource"]]
+        return {"id": operation["id"], "status": "COMPLETED", "errorCode": None, "objectCount": str(count),
+                "url": f"https://{BULK_HOST}/{operation['number']}.jsonl" if count else None,
+                "partialDataUrl": None}
+
+    def _bulk_download(self, request):
+        number = int(re.search(r"/(\d+)\.jsonl$", request.url.path).group(1))
+        operation = self.bulk_operations[f"gid://shopify/BulkOperation/{number}"]
+
+        async def chunks():
+            lines = self.bulk_lines(operation["resource"], operation["first"])
+            while True:
+                chunk = list(itertools.islice(lines, BULK_CHUNK))
+                if not chunk:
+                    return
+                yield ("\n".join(chunk) + "\n").encode()
+                await asyncio.sleep(0)
+
+        return httpx.Response(200, content=chunks(), headers={"Content-Type": "application/jsonl"})
+
+    # ---- transport ----
+
+    def _leak(self):
+        now = time.monotonic()
+        self._fill = max(0.0, self._fill - (now - self._updated) * self.leak_rate)
+        self._updated = now
+
+    def _json(self, status, body, headers=None):
+        headers = {"X-Shopify-Shop-Api-Call-Limit": f"{min(self.bucket_size, math.ceil(self._fill))}/{self.bucket_size}",
+                   **(headers or {})}
+        return httpx.Response(status, content=json.dumps(body).encode(), headers={
+            "Content-Type": "application/json", **headers})
+
+    async def handle_async_request(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+        if request.url.host == BULK_HOST:
+            # Result files are served from storage, outside the API call limit
+            self.calls["bulk download"] += 1
+            return self._bulk_download(request)
+
+        match = PATH.search(request.url.path)
+        endpoint = match.group("endpoint") if match else request.url.path
+        self.calls[re.sub(r"/\d+", "", endpoint)] += 1
+
+        self._leak()
+        if self._fill + 1 > self.bucket_size or self._rng.random() < self.throttle_rate:
+            self.throttled += 1
+            return self._json(429, {"errors": "Exceeded 2 calls per second for api client. Reduce request rates "
+                                               "to resume uninterrupted service."},
+                              {"Retry-After": f"{self.retry_after:.1f}"})
+        self._fill += 1
+        return self.route(request, endpoint)
+
+    def route(self, request, endpoint):
+        params = dict(request.url.params)
+        if endpoint == "graphql":
+            return self._graphql(request)
+        if endpoint.startswith("reports/"):
+            return self._json(200, {"report": self.report(endpoint.split("/", 1)[1], params)})
+        refunds = re.fullmatch(r"orders/(\d+)/refunds", endpoint)
+        if refunds:
+            i = int(refunds.group(1)) - 5_000_000_000
+            order = self.order(i) if 0 <= i < self.order_count else {"refunds": []}
+            return self._json(200, {"refunds": order["refunds"]})
+        if endpoint not in self.routes:
+            return self._json(404, {"errors": "Not Found"})
+        for (limited, name), most in ID_LIMITS.items():
+            if endpoint == limited and len(params.get(name, "").split(",")) > most:
+                return self._json(422, {"errors": {name: [f"must have at most {most} ids"]}})
+        if endpoint == "inventory_levels" and not (params.get("inventory_item_ids") or params.get("location_ids")) \
+                and "page_info" not in params:
+            return self._json(422, {"errors": "inventory_item_ids or location_ids is required"})
+
+        # page_info carries the original filters plus the offset, like Shopify's opaque cursor
+        page_info = params.get("page_info")
+        if page_info:
+            state = json.loads(bytes.fromhex(page_info))
+            params, offset = state["params"], state["offset"]
+        else:
+            offset = 0
+        limit = min(int(params.get("limit", 50)), MAX_LIMIT)
+        total, record = self.routes[endpoint](params, offset)
+        page = [record(i) for i in range(offset, min(offset + limit, total))]
+
+        headers = {}
+        if offset + limit < total:
+            cursor = json.dumps({"params": params, "offset": offset + limit}).encode().hex()
+            headers["Link"] = f'<{request.url.copy_with(params={"limit": limit, "page_info": cursor})}>; rel="next"'
+        return self._json(200, {endpoint: page}, headers)
+
+    def snapshot(self):
+        return {"calls": dict(self.calls), "total_calls": sum(self.calls.values()), "throttled": self.throttled}
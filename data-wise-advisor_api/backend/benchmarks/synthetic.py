@@ -0,0 +1,104 @@
+"""Deterministic synthetic Shopify data for benchmarks."""
+import random
+from datetime import datetime, timedelta, timezone
+
+CHANNELS = ["web", "pos", "shopify_draft_order", "iphone", "android"]
+
+
+def generate_products(count, seed=0):
+    rng = random.Random(seed)
+    products = []
+    for p in range(count):
+        variants = []
+        for v in range(rng.randint(1, 4)):
+            variants.append({
+                "id": 10_000_000 + p * 10 + v,
+                "product_id": 1 + p,
+                "title": "Default Title" if v == 0 else f"Size {v}",
+                "price": f"{rng.uniform(5, 250):.2f}",
+                "inventory_quantity": rng.randint(0, 500),
+                "inventory_item_id": 20_000_000 + p * 10 + v,
+            })
+        products.append({
+            "id": 1 + p,
+            "title": f"Product {p}",
+            "created_at": "2022-01-01T00:00:00Z",
+            "updated_at": "2022-01-01T00:00:00Z",
+            "variants": variants,
+        })
+    return products
+
+
+def generate_orders(count, products=None, customers=None, seed=0, start=None, days=730):
+    """Yield ``count`` orders spread evenly over ``days`` days from ``start``"""
+    products = products or generate_products(200, seed)
+    customers = customers or max(1, count // 4)
+    start = start or datetime.now(timezone.utc) - timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    for i in range(count):
+        yield order_at(i, products, customers, seed, start, step)
+
+
+def order_at(i, products, customers, seed, start, step):
+    """The ``i``-th synthetic order; each order has its own random stream so any
+    order can be produced without generating the ones before it"""
+    rng = random.Random(seed * 1_000_003 + i)
+    created = start + timedelta(seconds=i * step)
+    line_items = []
+    for _ in range(rng.randint(1, 4)):
+        product = products[rng.randrange(len(products))]
+        variant = product["variants"][rng.randrange(len(product["variants"]))]
+        line_items.append({
+            "product_id": product["id"],
+            "variant_id": variant["id"],
+            "title": product["title"],
+            "variant_title": variant["title"],
+            "price": variant["price"],
+            "quantity": rng.randint(1, 3),
+        })
+    items_total = sum(float(li["price"]) * li["quantity"] for li in line_items)
+    discount = round(items_total * rng.choice([0, 0, 0, 0.1, 0.2]), 2)
+    shipping = rng.choice([0.0, 4.99, 9.99])
+    tax = round((items_total - discount) * 0.08, 2)
+    customer_id = rng.randrange(customers)
+    refunds = []
+    if rng.random() < 0.05:
+        refunds.append({
+            "id": 8_000_000_000 + i,
+            "order_id": 5_000_000_000 + i,
+            "transactions": [{"kind": "refund", "amount": f"{items_total * 0.5:.2f}"}],
+        })
+    timestamp = created.strftime("%Y-%m-%dT%H:%M:%S-00:00")
+    return {
+        "id": 5_000_000_000 + i,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "email": f"customer{customer_id}@example.com",
+        "customer": {"id": 7_000_000 + customer_id},
+        "source_name": rng.choice(CHANNELS),
+        "fulfillment_status": "fulfilled" if rng.random() < 0.8 else None,
+        "total_line_items_price": f"{items_total:.2f}",
+        "total_discounts": f"{discount:.2f}",
+        "total_tax": f"{tax:.2f}",
+        "total_shipping_price_set": {"shop_money": {"amount": f"{shipping:.2f}"}},
+        "total_price": f"{items_total - discount + tax + shipping:.2f}",
+        "line_items": line_items,
+        "refunds": refunds,
+    }
+
+
+def customer_at(i, seed=0, start=None):
+    """The ``i``-th synthetic customer, matching the ``customer.id`` of generated orders"""
+    start = start or datetime(2022, 1, 1, tzinfo=timezone.utc)
+    rng = random.Random(seed * 1_000_033 + i)
+    timestamp = (start + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S-00:00")
+    return {
+        "id": 7_000_000 + i,
+        "email": f"customer{i}@example.com",
+        "first_name": f"First{i}",
+        "last_name": f"Last{i}",
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "orders_count": rng.randint(0, 10),
+        "accepts_marketing": rng.random() < 0.3,
+    }
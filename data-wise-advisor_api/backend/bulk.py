@@ -0,0 +1,302 @@
+"""Bulk exports through the GraphQL Admin API.
+
+A bulk operation runs a query on Shopify's side and leaves the result in
+one JSONL file, so backfilling years of orders becomes a mutation, a few
+status polls and one download, not thousands of 250-record pages.
+
+Nested connections come back flattened: each line item (or variant) is its
+own line carrying the ``__parentId`` of the order (or product) before it.
+``Assembler`` stitches them back together and converts every record to the
+REST shape the store, rollups and metrics already understand, including
+embedded refunds so no per-order refund lookups are needed afterwards.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from fastapi import HTTPException
+
+from rate_limit import backoff_delay
+
+BULK_SYNC = os.environ.get("SHOPIFY_BULK_SYNC", "1") == "1"
+BULK_POLL_INTERVAL = float(os.environ.get("SHOPIFY_BULK_POLL_INTERVAL", "2"))
+BULK_TIMEOUT = float(os.environ.get("SHOPIFY_BULK_TIMEOUT", "7200"))
+BULK_BATCH_SIZE = int(os.environ.get("SHOPIFY_BULK_BATCH_SIZE", "1000"))
+
+RUN_MUTATION = """
+mutation($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+STATUS_QUERY = """
+query($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url partialDataUrl }
+  }
+}
+"""
+
+CURRENT_QUERY = """
+{
+  currentBulkOperation { id status query }
+}
+"""
+
+MONEY = "shopMoney { amount }"
+
+QUERIES = {
+    "orders": f"""
+{{
+  orders%(filter)s {{
+    edges {{ node {{
+      id createdAt updatedAt email sourceName displayFulfillmentStatus
+      customer {{ id }}
+      subtotalPriceSet {{ {MONEY} }}
+      totalDiscountsSet {{ {MONEY} }}
+      totalTaxSet {{ {MONEY} }}
+      totalShippingPriceSet {{ {MONEY} }}
+      totalPriceSet {{ {MONEY} }}
+      refunds {{ id createdAt totalRefundedSet {{ {MONEY} }} }}
+      lineItems {{ edges {{ node {{
+        id title variantTitle quantity
+        originalUnitPriceSet {{ {MONEY} }}
+        product {{ id }}
+        variant {{ id }}
+      }} }} }}
+    }} }}
+  }}
+}}
+""",
+    "products": """
+{
+  products%(filter)s {
+    edges { node {
+      id title createdAt updatedAt
+      variants { edges { node { id title price inventoryQuantity inventoryItem { id } } } }
+    } }
+  }
+}
+""",
+    "customers": """
+{
+  customers%(filter)s {
+    edges { node { id email firstName lastName createdAt updatedAt numberOfOrders } }
+  }
+}
+""",
+}
+
+FULFILLMENT_STATUS = {"FULFILLED": "fulfilled", "PARTIALLY_FULFILLED": "partial", "RESTOCKED": "restocked"}
+
+
+def query(resource, updated_at_min=None):
+    """The bulk query exporting ``resource``, optionally only records updated since a timestamp"""
+    search = f'(query: "updated_at:>=\'{updated_at_min}\'")' if updated_at_min else ""
+    return QUERIES[resource] % {"filter": search}
+
+
+def legacy_id(gid):
+    """``gid://shopify/Order/123`` -> 123"""
+    return int(gid.rsplit("/", 1)[1]) if gid else None
+
+
+def _amount(money_set):
+    return (money_set or {}).get("shopMoney", {}).get("amount", "0.00")
+
+
+def _line_item(node):
+    return {
+        "id": legacy_id(node["id"]),
+        "product_id": legacy_id((node.get("product") or {}).get("id")),
+        "variant_id": legacy_id((node.get("variant") or {}).get("id")),
+        "title": node.get("title"),
+        "variant_title": node.get("variantTitle"),
+        "price": _amount(node.get("originalUnitPriceSet")),
+        "quantity": node.get("quantity", 1),
+    }
+
+
+def _order(node, children):
+    order_id = legacy_id(node["id"])
+    subtotal = float(_amount(node.get("subtotalPriceSet")))
+    discounts = float(_amount(node.get("totalDiscountsSet")))
+    customer = node.get("customer")
+    return {
+        "id": order_id,
+        "created_at": node.get("createdAt"),
+        "updated_at": node.get("updatedAt"),
+        "email": node.get("email"),
+        "customer": {"id": legacy_id(customer["id"])} if customer else None,
+        "source_name": node.get("sourceName"),
+        "fulfillment_status": FULFILLMENT_STATUS.get(node.get("displayFulfillmentStatus")),
+        # REST's subtotal is the line items after discounts
+        "total_line_items_price": f"{subtotal + discounts:.2f}",
+        "total_discounts": f"{discounts:.2f}",
+        "total_tax": _amount(node.get("totalTaxSet")),
+        "total_shipping_price_set": {"shop_money": {"amount": _amount(node.get("totalShippingPriceSet"))}},
+        "total_price": _amount(node.get("totalPriceSet")),
+        "line_items": [_line_item(child) for child in children],
+        "refunds": [
+            {
+                "id": legacy_id(refund["id"]),
+                "order_id": order_id,
+                "created_at": refund.get("createdAt"),
+                "transactions": [{"kind": "refund", "amount": _amount(refund.get("totalRefundedSet"))}],
+            }
+            for refund in node.get("refunds") or []
+        ],
+    }
+
+
+def _product(node, children):
+    product_id = legacy_id(node["id"])
+    return {
+        "id": product_id,
+        "title": node.get("title"),
+        "created_at": node.get("createdAt"),
+        "updated_at": node.get("updatedAt"),
+        "variants": [
+            {
+                "id": legacy_id(child["id"]),
+                "product_id": product_id,
+                "title": child.get("title"),
+                "price": child.get("price"),
+                "inventory_quantity": child.get("inventoryQuantity") or 0,
+                "inventory_item_id": legacy_id((child.get("inventoryItem") or {}).get("id")),
+            }
+            for child in children
+        ],
+    }
+
+
+def _customer(node, children):
+    return {
+        "id": legacy_id(node["id"]),
+        "email": node.get("email"),
+        "first_name": node.get("firstName"),
+        "last_name": node.get("lastName"),
+        "created_at": node.get("createdAt"),
+        "updated_at": node.get("updatedAt"),
+        "orders_count": int(node.get("numberOfOrders") or 0),
+    }
+
+
+CONVERTERS = {"orders": _order, "products": _product, "customers": _customer}
+
+
+class Assembler:
+    """Turns JSONL lines into REST-shaped records, across any chunking of the lines.
+
+    Shopify writes a record's children right after it, so a record is
+    complete as soon as the next top-level line (or the end) is seen.
+    """
+
+    def __init__(self, resource):
+        self.convert = CONVERTERS[resource]
+        self._node = None
+        self._children = []
+
+    def feed(self, lines):
+        """Parse a chunk of lines; returns the records completed by it"""
+        records = []
+        for line in lines:
+            obj = json.loads(line)
+            if "__parentId" in obj:
+                self._children.append(obj)
+                continue
+            if self._node is not None:
+                records.append(self.convert(self._node, self._children))
+            self._node, self._children = obj, []
+        return records
+
+    def finish(self):
+        records = [self.convert(self._node, self._children)] if self._node is not None else []
+        self._node, self._children = None, []
+        return records
+
+
+async def _in_progress(client, bulk_query):
+    """Id of the shop's running bulk operation if it is ``bulk_query``, else None"""
+    operation = (await client.graphql(CURRENT_QUERY)).get("currentBulkOperation") or {}
+    running = operation.get("status") in ("CREATED", "RUNNING")
+    if running and (operation.get("query") or "").strip() == bulk_query.strip():
+        return operation["id"]
+    return None
+
+
+async def start(client, bulk_query):
+    """Submit a bulk query; returns the operation id.
+
+    The mutation is not retried blindly: after a 5xx or a dropped connection
+    Shopify may have started it anyway, so the shop's current bulk operation
+    is checked first and adopted when it is this query.
+    """
+    for attempt in range(client.max_retries + 1):
+        try:
+            data = await client.graphql(RUN_MUTATION, {"query": bulk_query})
+        except HTTPException as e:
+            if e.status_code < 500:
+                raise
+            operation_id = await _in_progress(client, bulk_query)
+            if operation_id:
+                logging.warning(f"Bulk operation submit failed ({e.detail}), adopting running {operation_id}")
+                return operation_id
+            if attempt >= client.max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logging.warning(f"Bulk operation submit failed ({e.detail}), resubmitting in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        result = data.get("bulkOperationRunQuery") or {}
+        if result.get("userErrors"):
+            raise HTTPException(status_code=502, detail=f"Bulk operation rejected: {result['userErrors']}")
+        return result["bulkOperation"]["id"]
+
+
+async def run(client, bulk_query):
+    """Start a bulk query and wait for it; returns the result URL (None when nothing matched)"""
+    operation_id = await start(client, bulk_query)
+
+    deadline = time.monotonic() + BULK_TIMEOUT
+    while True:
+        await asyncio.sleep(BULK_POLL_INTERVAL)
+        operation = (await client.graphql(STATUS_QUERY, {"id": operation_id})).get("node") or {}
+        status = operation.get("status")
+        if status == "COMPLETED":
+            return operation.get("url")
+        if status in ("FAILED", "CANCELED", "EXPIRED"):
+            raise HTTPException(status_code=502,
+                                detail=f"Bulk operation {operation_id} {status.lower()}: {operation.get('errorCode')}")
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=504, detail=f"Bulk operation {operation_id} timed out")
+
+
+async def export(client, resource, updated_at_min=None, batch_size=None):
+    """Yield REST-shaped records of ``resource`` in batches, parsed as the JSONL result streams in"""
+    url = await run(client, query(resource, updated_at_min))
+    if not url:
+        return
+    batch_size = batch_size or BULK_BATCH_SIZE
+    assembler = Assembler(resource)
+    lines = []
+    exported = 0
+    async for line in client.stream_lines(url):
+        lines.append(line)
+        if len(lines) >= batch_size:
+            # JSON parsing happens off the event loop, one chunk at a time
+            records = await asyncio.to_thread(assembler.feed, lines)
+            lines = []
+            if records:
+                exported += len(records)
+                yield records
+    records = await asyncio.to_thread(assembler.feed, lines) + assembler.finish()
+    if records:
+        exported += len(records)
+        yield records
+    logging.info(f"Bulk export of {resource} streamed {exported} records")
@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+from fastapi import Response
+
+import encoding
+import instrumentation
+
+
+class CacheEntry:
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.created = time.monotonic()
+        self._compressed = {}
+
+    async def compressed(self, content_encoding):
+        """The body compressed with ``content_encoding``, computed once per entry in a worker thread"""
+        body = self._compressed.get(content_encoding)
+        if body is None:
+            body = await asyncio.to_thread(encoding.compress, self.body, content_encoding)
+            self._compressed[content_encoding] = body
+        return body
+
+    def age(self):
+        return time.monotonic() - self.created
+
+
+class ResponseCache:
+    """LRU cache of serialized JSON responses with stale-while-revalidate.
+
+    Entries younger than ``ttl`` are served as-is. Entries up to
+    ``ttl + stale_ttl`` old are served immediately while one background task
+    recomputes them. Older entries are recomputed inline, with concurrent
+    requests for the same key sharing one computation.
+    """
+
+    def __init__(self, ttl=60.0, stale_ttl=600.0, max_entries=256):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._background = set()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "not_modified": 0, "refresh_errors": 0}
+
+    def clear(self, namespace=None):
+        """Drop every entry, or only those whose key starts with ``namespace``"""
+        if namespace is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == namespace]:
+            del self._entries[key]
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _compute(self, key, compute, cacheable):
+        """Run ``compute`` once per key at a time and cache its serialized result"""
+        task = self._inflight.get(key)
+        if task is None:
+            async def run():
+                try:
+                    value = await compute()
+                    # Serializing (and hashing) a large payload would stall every other request
+                    with instrumentation.span("serialize"):
+                        entry = await asyncio.to_thread(lambda: CacheEntry(encoding.dumps(value)))
+                    if cacheable(value):
+                        self._store(key, entry)
+                    return entry
+                finally:
+                    self._inflight.pop(key, None)
+
+            task = self._inflight[key] = asyncio.ensure_future(run())
+        return await asyncio.shield(task)
+
+    def _refresh(self, key, compute, cacheable):
+        if key in self._inflight:
+            return
+
+        async def refresh():
+            try:
+                await self._compute(key, compute, cacheable)
+            except Exception as e:
+                self.stats["refresh_errors"] += 1
+                logging.warning(f"Background refresh of {key} failed, keeping stale entry: {e}")
+
+        task = asyncio.ensure_future(refresh())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def lookup(self, key, compute, cacheable=lambda value: True):
+        """Return ``(entry, status)`` for a servable entry of ``key``, else ``(None, "MISS")``.
+
+        A stale entry is returned while ``compute`` refreshes it in the background.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = entry.age()
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry, "HIT"
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stats["stale_hits"] += 1
+                self._refresh(key, compute, cacheable)
+                return entry, "STALE"
+
+        self.stats["misses"] += 1
+        return None, "MISS"
+
+    async def get(self, key, compute, cacheable=lambda value: True):
+        """Return ``(entry, status)`` for ``key``, computing it if needed"""
+        entry, status = self.lookup(key, compute, cacheable)
+        if entry is None:
+            entry = await self._compute(key, compute, cacheable)
+        return entry, status
+
+    async def put(self, key, value):
+        """Cache a value computed elsewhere, e.g. assembled from a stream of its parts"""
+        with instrumentation.span("serialize"):
+            entry = await asyncio.to_thread(lambda: CacheEntry(encoding.dumps(value)))
+        self._store(key, entry)
+        return entry
+
+    async def respond(self, request, key, compute, cacheable=lambda value: True):
+        """Serve a cached (and compressed) JSON response, answering 304 when If-None-Match matches"""
+        entry, status = await self.get(key, compute, cacheable)
+        headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache", "X-Cache": status}
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if entry.etag in (tag.strip() for tag in if_none_match.split(",")):
+            self.stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        return await encoding.json_response(request, entry.body, headers=headers, compressed=entry.compressed)
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self._entries), "max_entries": self.max_entries}
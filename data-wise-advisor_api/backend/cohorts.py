@@ -0,0 +1,275 @@
+"""Customer cohorts and retention maintained from the local order history.
+
+Every customer (keyed on Shopify customer id, falling back to email) is
+assigned the month of their first order as their cohort. Months are UTC
+months, matching the UTC days of the daily rollups. Three tables are
+kept current alongside the daily rollups:
+
+* ``cohort_activity``: orders and sales per customer and month
+* ``cohort_cells``: active customers, orders and sales per cohort and
+  months since the cohort month (the retention matrix)
+* ``cohort_sizes``: customers per cohort and how many ordered again in a
+  later month
+
+An order upsert only revisits the customers it touches: their current
+contribution is taken out of the matrix, their activity is updated, and
+their (possibly new) contribution is added back. Reading the matrix costs
+O(cohorts x months) no matter how many customers there are.
+"""
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cohort_activity (
+    customer TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    sales INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (customer, month)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS cohort_cells (
+    cohort INTEGER NOT NULL,
+    age INTEGER NOT NULL,
+    customers INTEGER NOT NULL DEFAULT 0,
+    orders INTEGER NOT NULL DEFAULT 0,
+    sales INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (cohort, age)
+);
+
+CREATE TABLE IF NOT EXISTS cohort_sizes (
+    cohort INTEGER PRIMARY KEY,
+    customers INTEGER NOT NULL DEFAULT 0,
+    repeat INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+TABLES = ("cohort_activity", "cohort_cells", "cohort_sizes")
+
+_UPSERT_ACTIVITY = (
+    "INSERT INTO cohort_activity (customer, month, orders, sales) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (customer, month) DO UPDATE SET orders = orders + excluded.orders, sales = sales + excluded.sales"
+)
+_UPSERT_CELL = (
+    "INSERT INTO cohort_cells (cohort, age, customers, orders, sales) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (cohort, age) DO UPDATE SET customers = customers + excluded.customers, "
+    "orders = orders + excluded.orders, sales = sales + excluded.sales"
+)
+_UPSERT_SIZE = (
+    "INSERT INTO cohort_sizes (cohort, customers, repeat) VALUES (?, ?, ?) "
+    "ON CONFLICT (cohort) DO UPDATE SET customers = customers + excluded.customers, repeat = repeat + excluded.repeat"
+)
+
+# Customers per IN (...) query when reading activity back
+_CHUNK = 500
+
+
+def month_number(year, month):
+    """Months since year 0 for a calendar year and 1-based month"""
+    return year * 12 + month - 1
+
+
+def month_label(number):
+    return f"{number // 12:04d}-{number % 12 + 1:02d}"
+
+
+def _customer_keys(cols):
+    """Per-order customer key (customer id, else email), or None when there is neither"""
+    keys = []
+    for customer_id, code in zip(cols.customer_id.tolist(), cols.customer.tolist()):
+        if customer_id:
+            keys.append(str(customer_id))
+        elif code >= 0:
+            keys.append(cols.customers[code])
+        else:
+            keys.append(None)
+    return keys
+
+
+def _cents(amounts):
+    """Money amounts as integer cents"""
+    return np.rint(np.asarray(amounts, dtype=np.float64) * 100).astype(np.int64)
+
+
+def _activity(cols, sign):
+    """(customer, month) -> [orders, sales in cents] contributed by ``cols``"""
+    activity = defaultdict(lambda: [0, 0])
+    months = (cols.year.astype(np.int64) * 12 + cols.month.astype(np.int64) - 1).tolist()
+    dated = (cols.created > 0).tolist()
+    sales = _cents(cols.total_price).tolist()
+    for key, month, is_dated, amount in zip(_customer_keys(cols), months, dated, sales):
+        if key is None or not is_dated:
+            continue
+        cell = activity[(key, month)]
+        cell[0] += sign
+        cell[1] += sign * amount
+    return activity
+
+
+def _contribute(conn, customers, sign):
+    """Add (sign=1) or remove (sign=-1) the matrix contribution of ``customers``"""
+    customers = list(customers)
+    cells = defaultdict(lambda: [0, 0, 0])
+    sizes = defaultdict(lambda: [0, 0])
+    for i in range(0, len(customers), _CHUNK):
+        chunk = customers[i:i + _CHUNK]
+        history = defaultdict(list)
+        for customer, month, orders, sales in conn.execute(
+            f"SELECT customer, month, orders, sales FROM cohort_activity "
+            f"WHERE customer IN ({', '.join('?' * len(chunk))})",
+            chunk,
+        ):
+            history[customer].append((month, orders, sales))
+        for months in history.values():
+            cohort = min(month for month, _, _ in months)
+            for month, orders, sales in months:
+                cell = cells[(cohort, month - cohort)]
+                cell[0] += sign
+                cell[1] += sign * orders
+                cell[2] += sign * sales
+            size = sizes[cohort]
+            size[0] += sign
+            size[1] += sign * (len(months) > 1)
+
+    conn.executemany(_UPSERT_CELL, [(cohort, age, *cell) for (cohort, age), cell in cells.items()])
+    conn.executemany(_UPSERT_SIZE, [(cohort, *size) for cohort, size in sizes.items()])
+
+
+def apply(conn, changes):
+    """Apply order changes given as ``(cols, sign)`` pairs, e.g. old orders with -1 and new with +1"""
+    deltas = defaultdict(lambda: [0, 0])
+    for cols, sign in changes:
+        for key, (orders, sales) in _activity(cols, sign).items():
+            deltas[key][0] += orders
+            deltas[key][1] += sales
+    deltas = {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+    if not deltas:
+        return
+
+    customers = {customer for customer, _ in deltas}
+    _contribute(conn, customers, -1)
+    conn.executemany(_UPSERT_ACTIVITY, [(customer, month, *delta) for (customer, month), delta in deltas.items()])
+    # Only the touched customers can have emptied months; avoid scanning the table
+    conn.executemany(
+        "DELETE FROM cohort_activity WHERE customer = ? AND month = ? AND orders <= 0", list(deltas)
+    )
+    _contribute(conn, customers, 1)
+    conn.execute("DELETE FROM cohort_cells WHERE customers <= 0")
+    conn.execute("DELETE FROM cohort_sizes WHERE customers <= 0")
+
+
+def clear(conn):
+    for table in TABLES:
+        conn.execute(f"DELETE FROM {table}")
+
+
+def _sums(groups, values, size):
+    """Exact integer sums of ``values`` per group; ``np.bincount`` weights go through floats"""
+    sums = np.zeros(size, dtype=np.int64)
+    np.add.at(sums, groups, values)
+    return sums
+
+
+def rebuild(conn, cols):
+    """Recompute every cohort table from the columnar view of all stored orders"""
+    clear(conn)
+    keys = np.array(_customer_keys(cols), dtype=object)
+    valid = (cols.created > 0) & np.array([key is not None for key in keys], dtype=bool)
+    if not valid.any():
+        return
+
+    names, customer = np.unique(keys[valid].astype(str), return_inverse=True)
+    month = cols.year[valid].astype(np.int64) * 12 + cols.month[valid].astype(np.int64) - 1
+    sales = _cents(cols.total_price[valid])
+
+    # Activity per (customer, month)
+    span = int(month.max()) + 1
+    pair, inverse = np.unique(customer * span + month, return_inverse=True)
+    pair_orders = np.bincount(inverse, minlength=len(pair))
+    pair_sales = _sums(inverse, sales, len(pair))
+    pair_customer = pair // span
+    pair_month = pair % span
+    conn.executemany(
+        "INSERT INTO cohort_activity (customer, month, orders, sales) VALUES (?, ?, ?, ?)",
+        zip(names[pair_customer].tolist(), pair_month.tolist(), pair_orders.tolist(), pair_sales.tolist()),
+    )
+
+    # A customer's cohort is their first month with an order
+    cohort = np.full(len(names), span, dtype=np.int64)
+    np.minimum.at(cohort, pair_customer, pair_month)
+    months_active = np.bincount(pair_customer, minlength=len(names))
+
+    pair_cohort = cohort[pair_customer]
+    cell, cell_inverse = np.unique(pair_cohort * span + (pair_month - pair_cohort), return_inverse=True)
+    conn.executemany(_UPSERT_CELL, zip(
+        (cell // span).tolist(),
+        (cell % span).tolist(),
+        np.bincount(cell_inverse, minlength=len(cell)).tolist(),
+        _sums(cell_inverse, pair_orders, len(cell)).tolist(),
+        _sums(cell_inverse, pair_sales, len(cell)).tolist(),
+    ))
+
+    cohorts, cohort_inverse = np.unique(cohort, return_inverse=True)
+    conn.executemany(_UPSERT_SIZE, zip(
+        cohorts.tolist(),
+        np.bincount(cohort_inverse, minlength=len(cohorts)).tolist(),
+        np.bincount(cohort_inverse, weights=months_active > 1, minlength=len(cohorts)).astype(np.int64).tolist(),
+    ))
+
+
+def summary(conn, start_month=None, end_month=None, max_age=12, now=None):
+    """Retention matrix and LTV curves for cohorts in ``[start_month, end_month]``.
+
+    Retention is the percentage of a cohort ordering in each month since its
+    first; LTV is cumulative sales per cohort customer. ``all_cohorts``
+    weights every cohort by size.
+    """
+    now = now or datetime.now(timezone.utc)
+    current = month_number(now.year, now.month)
+    first = start_month if start_month is not None else 0
+    last = end_month if end_month is not None else current
+
+    sizes = {
+        cohort: (customers, repeat)
+        for cohort, customers, repeat in conn.execute(
+            "SELECT cohort, customers, repeat FROM cohort_sizes WHERE cohort BETWEEN ? AND ? ORDER BY cohort",
+            (first, last),
+        )
+    }
+    cells = defaultdict(dict)
+    for cohort, age, customers, sales in conn.execute(
+        "SELECT cohort, age, customers, sales FROM cohort_cells WHERE cohort BETWEEN ? AND ? AND age <= ?",
+        (first, last, max_age),
+    ):
+        cells[cohort][age] = (customers, sales)
+
+    monthly = {}
+    reached = np.zeros(max_age + 1)
+    retained = np.zeros(max_age + 1)
+    for cohort, (size, _) in sizes.items():
+        # At least the cohort month itself, even for a cohort dated after ``now``
+        ages = max(1, min(max_age, current - cohort) + 1)
+        active = np.array([cells[cohort].get(age, (0, 0))[0] for age in range(ages)], dtype=np.float64)
+        sales = np.array([cells[cohort].get(age, (0, 0))[1] for age in range(ages)], dtype=np.int64)
+        reached[:ages] += size
+        retained[:ages] += active
+        monthly[month_label(cohort)] = {
+            "customers": size,
+            "retention": [round(float(v), 2) for v in active / size * 100],
+            "ltv": [round(float(v), 2) for v in np.cumsum(sales) / size / 100],
+        }
+
+    customers = sum(size for size, _ in sizes.values())
+    repeat = sum(repeat for _, repeat in sizes.values())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        months = np.where(reached > 0, retained / reached * 100, 0.0)
+    return {
+        "all_cohorts": {
+            "customers": customers,
+            "retention_rate": round(repeat / customers * 100, 2) if customers else 0.0,
+            "months": [round(float(v), 2) for v in months[1:]],
+        },
+        "monthly_cohorts": monthly,
+    }
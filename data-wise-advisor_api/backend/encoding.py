@@ -0,0 +1,95 @@
+"""Fast JSON serialization and response compression.
+
+orjson and brotli are used when installed; otherwise this falls back to the
+standard library json encoder and gzip only.
+"""
+import asyncio
+import gzip
+import json
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def dumps(value):
+    """Serialize ``value`` to compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def loads(body):
+    """Parse JSON bytes produced by ``dumps``"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _weights(header):
+    """Content coding -> q value from an Accept-Encoding header"""
+    weights = {}
+    for part in header.split(","):
+        coding, *params = (piece.strip() for piece in part.split(";"))
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.lower()] = q
+    return weights
+
+
+def negotiate(request):
+    """Pick the best content encoding the client accepts, or None.
+
+    A coding listed with ``q=0`` is refused, even when ``*`` would allow it;
+    on equal q values brotli is preferred over gzip.
+    """
+    weights = _weights(request.headers.get("accept-encoding", ""))
+    supported = ("br", "gzip") if brotli is not None else ("gzip",)
+    accepted = [(weights.get(coding, weights.get("*", 0.0)), coding) for coding in supported]
+    accepted = [(q, coding) for q, coding in accepted if q > 0]
+    # max() keeps the first of equal q values, i.e. the preferred coding
+    return max(accepted, key=lambda pair: pair[0])[1] if accepted else None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+async def json_response(request, body, status_code=200, headers=None, compressed=None):
+    """Build a JSON response from serialized ``body``, compressing it when worthwhile.
+
+    Compression runs in a worker thread so large bodies don't block the
+    event loop. ``compressed`` may supply an async callable
+    ``(encoding) -> bytes`` that returns a pre-compressed body, e.g. one
+    memoized by the response cache.
+    """
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    encoding = negotiate(request) if len(body) >= MIN_COMPRESS_SIZE else None
+    if encoding:
+        body = await compressed(encoding) if compressed else await asyncio.to_thread(compress, body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
@@ -0,0 +1,310 @@
+"""Request instrumentation: stage spans, Shopify call metrics and a slow-request profiler.
+
+Counters and histograms live in this process and are rendered in the
+Prometheus text format by ``render`` (served at ``/metrics``). Values that
+already exist elsewhere, such as the response cache counters, are read at
+scrape time through functions registered with ``collector``.
+
+``span(name)`` times one stage of a request. Stage durations feed the
+``shopify_stage_seconds`` histogram and, when ``SHOPIFY_SERVER_TIMING=1``,
+the request's ``Server-Timing`` header. Tasks and threads started by the
+request inherit its context, so concurrent stages are attributed to it too.
+
+Setting ``SHOPIFY_PROFILE_SLOW_MS`` starts a sampling profiler thread;
+requests slower than that many milliseconds have the stacks sampled while
+they ran written to ``SHOPIFY_PROFILE_DIR`` as folded stacks (the input of
+flamegraph.pl and speedscope). Every thread is sampled, so requests that
+overlap a slow one show up in its profile too.
+"""
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+SERVER_TIMING = os.environ.get("SHOPIFY_SERVER_TIMING", "0") == "1"
+PROFILE_SLOW_MS = float(os.environ.get("SHOPIFY_PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL = float(os.environ.get("SHOPIFY_PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.environ.get(
+    "SHOPIFY_PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"),
+)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Stage durations of the current request, or None outside a request
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = defaultdict(float)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labelnames, labels), value) for labels, value in self._values.items()]
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            else:
+                state[0][-1] += 1
+            state[1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, math.inf), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    samples.append((f"{self.name}_bucket", _labels(self.labelnames, labels, [("le", le)]), cumulative))
+                samples.append((f"{self.name}_sum", _labels(self.labelnames, labels), total))
+                samples.append((f"{self.name}_count", _labels(self.labelnames, labels), cumulative))
+        return samples
+
+
+_metrics = []
+_collectors = []
+
+
+def counter(name, help, labelnames=()):
+    metric = CounterMetric(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, help, labelnames=(), buckets=BUCKETS):
+    metric = HistogramMetric(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def collector(func):
+    """Register ``func() -> [(name, kind, help, [(labels dict, value), ...]), ...]`` to run on every scrape"""
+    _collectors.append(func)
+    return func
+
+
+REQUEST_SECONDS = histogram("shopify_http_request_seconds", "Time to answer API requests",
+                            ("method", "route", "status"))
+STAGE_SECONDS = histogram("shopify_stage_seconds", "Time spent in each stage of a request", ("stage",))
+CALLS = counter("shopify_api_calls_total", "Calls made to the Shopify Admin API", ("endpoint", "status"))
+CALL_BYTES = counter("shopify_api_response_bytes_total", "Response bytes received from the Shopify Admin API",
+                     ("endpoint",))
+CALL_SECONDS = histogram("shopify_api_call_seconds", "Latency of Shopify Admin API calls", ("endpoint",))
+SLOW_REQUESTS = counter("shopify_slow_requests_total", "Requests over SHOPIFY_PROFILE_SLOW_MS that were profiled",
+                        ("route",))
+
+
+def render():
+    """Every metric and collector in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+    for func in _collectors:
+        try:
+            families = func()
+        except Exception as e:
+            logging.warning(f"Metrics collector {func.__name__} failed: {e}")
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# ---- spans ----
+
+def start_request():
+    """Begin collecting stage timings for the current request"""
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+def record(stage, seconds, observe=True):
+    if observe:
+        STAGE_SECONDS.observe(seconds, stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as one stage of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def server_timing(timings, total):
+    """A Server-Timing header value; repeated stages (e.g. Shopify calls) are summed"""
+    merged = {}
+    for stage, seconds in timings:
+        count, duration = merged.get(stage, (0, 0.0))
+        merged[stage] = (count + 1, duration + seconds)
+    entries = [
+        f'{re.sub(r"[^A-Za-z0-9_-]", "_", stage)};dur={duration * 1000:.1f}' + (f';desc="{count}x"' if count > 1 else "")
+        for stage, (count, duration) in merged.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+# ---- Shopify calls ----
+
+_IDS = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_label(url):
+    """``orders/{id}/refunds`` for any Admin API URL or path, so ids don't explode cardinality"""
+    path = urlsplit(url).path if "://" in url else url
+    path = re.sub(r"^.*/admin/api/[^/]+/", "", path)
+    if path.endswith(".json"):
+        path = path[:-5]
+    return _IDS.sub("/{id}", "/" + path.lstrip("/"))[1:]
+
+
+def record_call(url, status, seconds, size):
+    endpoint = endpoint_label(url)
+    CALLS.inc(endpoint, status)
+    CALL_BYTES.inc(endpoint, amount=size)
+    CALL_SECONDS.observe(seconds, endpoint)
+    # Not a stage histogram sample: shopify_api_call_seconds already has it per endpoint
+    record("shopify", seconds, observe=False)
+
+
+# ---- slow-request profiler ----
+
+# Leaf frames of threads that are waiting rather than working
+_IDLE = {"select", "poll", "wait", "_worker", "accept", "_recv_into"}
+
+
+class SamplingProfiler:
+    """Samples the Python stack of every thread every ``interval`` seconds.
+
+    The last ``window`` seconds of samples are kept so the stacks of a slow
+    request can be extracted once it has finished.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, window=120.0):
+        self.interval = interval
+        self._samples = deque(maxlen=max(1, int(window / interval)))
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            now = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or frame.f_code.co_name in _IDLE:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self._samples.append((now, ";".join(reversed(stack))))
+
+    def stacks(self, started, finished):
+        """Folded stack -> sample count between two ``time.perf_counter`` readings"""
+        return Counter(stack for at, stack in list(self._samples) if started <= at <= finished)
+
+    def dump(self, label, started, finished):
+        """Write the folded stacks of one slow request; returns the file path, or None without samples"""
+        stacks = self.stacks(started, finished)
+        if not stacks:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_")
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.folded")
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        return path
+
+
+profiler = SamplingProfiler() if PROFILE_SLOW_MS > 0 else None
+
+
+async def finish_request(method, route, status, started, timings):
+    """Record a finished request; returns its Server-Timing header value when enabled"""
+    finished = time.perf_counter()
+    elapsed = finished - started
+    REQUEST_SECONDS.observe(elapsed, method, route, status)
+    if profiler is not None and elapsed * 1000 >= PROFILE_SLOW_MS:
+        SLOW_REQUESTS.inc(route)
+        # Collecting and writing the stacks is file I/O; keep it off the event loop
+        path = await asyncio.to_thread(profiler.dump, f"{method} {route}", started, finished)
+        logging.warning(f"Slow request {method} {route} took {elapsed * 1000:.0f}ms"
+                        + (f", profile written to {path}" if path else ""))
+    return server_timing(timings, elapsed) if SERVER_TIMING else None
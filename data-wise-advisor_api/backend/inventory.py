@@ -0,0 +1,196 @@
+"""Inventory levels and items for sell-through, fetched in batches.
+
+A variant only carries the id of its inventory item; the stock of that item
+at each location lives in ``inventory_levels`` and its SKU, cost and
+tracking flag in ``inventory_items``. Both endpoints take many ids per call
+(``inventory_item_ids`` up to 50, ``ids`` up to 100), so a catalog is
+covered in a few chunked requests instead of one call per variant. When
+most of the catalog is stale, levels are instead paged per location 250 at
+a time, which takes fewer calls still.
+
+Everything fetched is cached in the local store. A variant's levels are
+reused until its ``inventory_quantity`` or its product's ``updated_at``
+changes, an ``inventory_levels`` webhook replaces them, or they are older
+than ``SHOPIFY_INVENTORY_MAX_AGE``.
+"""
+import asyncio
+import heapq
+import logging
+import math
+import os
+import time
+
+import store
+
+LEVEL_BATCH = int(os.environ.get("SHOPIFY_INVENTORY_LEVEL_BATCH", "50"))
+ITEM_BATCH = int(os.environ.get("SHOPIFY_INVENTORY_ITEM_BATCH", "100"))
+INVENTORY_WORKERS = int(os.environ.get("SHOPIFY_INVENTORY_WORKERS", "4"))
+INVENTORY_MAX_AGE = float(os.environ.get("SHOPIFY_INVENTORY_MAX_AGE", "86400"))
+PAGE_SIZE = 250
+LOCATION_BATCH = 50
+
+
+def chunks(ids, size):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def fingerprints(products):
+    """Inventory item id -> what must change before its cached levels are fetched again"""
+    prints = {}
+    for product in products:
+        for variant in product.get("variants") or []:
+            item_id = variant.get("inventory_item_id")
+            if isinstance(item_id, int):
+                prints[item_id] = f"{product.get('updated_at')}:{variant.get('inventory_quantity')}"
+    return prints
+
+
+async def _gather(calls, max_workers):
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run(call):
+        async with semaphore:
+            return await call()
+
+    return await asyncio.gather(*(run(call) for call in calls))
+
+
+async def locations(client, max_age=None):
+    """Locations of the shop, fetched again once the stored ones are older than ``max_age``"""
+    max_age = INVENTORY_MAX_AGE if max_age is None else max_age
+    stored = await asyncio.to_thread(store.load_locations, max_age)
+    if stored is not None:
+        return stored
+    fetched = await client.fetch_all("locations")
+    await asyncio.to_thread(store.save_locations, fetched)
+    return fetched
+
+
+async def refresh(client, products, max_age=None, max_workers=None):
+    """Fetch the levels and items of every variant whose cached inventory is stale.
+
+    Returns how many items had their levels and their details fetched.
+    """
+    max_age = INVENTORY_MAX_AGE if max_age is None else max_age
+    max_workers = max_workers or INVENTORY_WORKERS
+    prints = fingerprints(products)
+    state = await asyncio.to_thread(store.inventory_state, list(prints))
+    now = time.time()
+    stale_levels = [
+        item_id for item_id, fingerprint in prints.items()
+        if item_id not in state or state[item_id][0] != fingerprint or now - (state[item_id][1] or 0) > max_age
+    ]
+    stale_items = [item_id for item_id in prints if item_id not in state or now - (state[item_id][2] or 0) > max_age]
+
+    if stale_levels:
+        shop_locations = [location["id"] for location in await locations(client, max_age)]
+        # Paging through every level of every location beats chunks of 50 items
+        # once most of the catalog is stale
+        scan_calls = math.ceil(len(prints) * len(shop_locations) / PAGE_SIZE)
+        if shop_locations and scan_calls < len(stale_levels) / LEVEL_BATCH:
+            pages = await _gather([
+                lambda batch=batch: client.fetch_all(
+                    "inventory_levels", {"location_ids": ",".join(map(str, batch)), "limit": PAGE_SIZE})
+                for batch in chunks(shop_locations, LOCATION_BATCH)
+            ], max_workers)
+            levels = [level for page in pages for level in page if level.get("inventory_item_id") in prints]
+            await asyncio.to_thread(store.save_inventory_levels, levels, prints)
+        else:
+            async def fetch_levels(batch):
+                levels = await client.fetch_all(
+                    "inventory_levels", {"inventory_item_ids": ",".join(map(str, batch)), "limit": PAGE_SIZE})
+                # Saved per chunk, so a failure later on keeps what was fetched
+                await asyncio.to_thread(store.save_inventory_levels, levels, {i: prints[i] for i in batch})
+
+            await _gather([lambda batch=batch: fetch_levels(batch)
+                           for batch in chunks(stale_levels, LEVEL_BATCH)], max_workers)
+
+    if stale_items:
+        async def fetch_items(batch):
+            items = await client.fetch_all("inventory_items", {"ids": ",".join(map(str, batch)), "limit": PAGE_SIZE})
+            await asyncio.to_thread(store.save_inventory_items, items)
+
+        await _gather([lambda batch=batch: fetch_items(batch)
+                       for batch in chunks(stale_items, ITEM_BATCH)], max_workers)
+
+    if stale_levels or stale_items:
+        logging.info(f"Inventory refreshed: levels of {len(stale_levels)} and details of {len(stale_items)} "
+                     f"of {len(prints)} items")
+    return len(stale_levels), len(stale_items)
+
+
+def sell_through_rate(sold, on_hand):
+    """Share of the units available in a period that sold: sold / (sold + on hand now), in %"""
+    available = sold + max(on_hand, 0)
+    return sold / available * 100 if available > 0 else 0.0
+
+
+def variant_rows(products, sold, levels, items, location_names):
+    """One row per tracked variant with its sell-through and stock per location.
+
+    ``sold`` maps variant id -> units sold in the period, ``levels`` inventory
+    item id -> {location_id: available}, ``items`` inventory item id -> item.
+    """
+    rows = []
+    for product in products:
+        for variant in product.get("variants") or []:
+            item_id = variant.get("inventory_item_id")
+            item = items.get(item_id) or {}
+            if item.get("tracked") is False:
+                continue
+            by_location = levels.get(item_id)
+            if by_location is None:
+                # Not fetched yet: the variant's own total is all there is
+                by_location = {}
+                on_hand = int(variant.get("inventory_quantity") or 0)
+            else:
+                on_hand = sum(available or 0 for available in by_location.values())
+            units = sold.get(variant.get("id"), 0)
+            rows.append({
+                "product_id": product.get("id"),
+                "variant_id": variant.get("id"),
+                "inventory_item_id": item_id,
+                "name": f"{product.get('title')} | {variant.get('title') or 'Default Title'}",
+                "sku": item.get("sku"),
+                "sold": units,
+                "on_hand": on_hand,
+                "sell_through_rate": round(sell_through_rate(units, on_hand), 2),
+                "locations": [
+                    {"location_id": location_id, "name": location_names.get(location_id), "available": available}
+                    for location_id, available in sorted(by_location.items())
+                ],
+            })
+    return rows
+
+
+def location_summary(rows, location_names):
+    """Stock per location: units on hand, variants stocked and variants sold out there"""
+    summary = {}
+    for row in rows:
+        for level in row["locations"]:
+            entry = summary.setdefault(level["location_id"], {
+                "location_id": level["location_id"], "name": location_names.get(level["location_id"]),
+                "on_hand": 0, "variants": 0, "out_of_stock": 0,
+            })
+            available = level["available"] or 0
+            entry["on_hand"] += max(available, 0)
+            entry["variants"] += 1
+            entry["out_of_stock"] += available <= 0
+    return [summary[location_id] for location_id in sorted(summary)]
+
+
+def summary(rows, location_names, limit=10):
+    """The dashboard's sell-through section: the overall rate, the best sellers through and stock per location"""
+    sold = sum(row["sold"] for row in rows)
+    on_hand = sum(max(row["on_hand"], 0) for row in rows)
+    ranked = heapq.nlargest(limit, (row for row in rows if row["sold"]),
+                            key=lambda row: (row["sell_through_rate"], row["sold"]))
+    return {
+        "average_rate": round(sell_through_rate(sold, on_hand), 2),
+        "units_sold": sold,
+        "on_hand": on_hand,
+        "top_products": {row["name"]: row["sell_through_rate"] for row in ranked},
+        "top_variants": ranked,
+        "locations": location_summary(rows, location_names),
+    }
@@ -0,0 +1,146 @@
+"""Periodic background jobs that keep the local store and reports fresh.
+
+Each job runs in its own asyncio task on a jittered interval. Before a run
+the job takes a lease in the local store (``store.claim_job``), so with
+several uvicorn workers sharing one store each job still runs in only one
+of them at a time, and a run that is still going is never started twice.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+
+import store
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter=0.1, timeout=None, context=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout or max(interval, 60.0)
+        self.wait = None
+        self.context = context
+        self.stats = {"runs": 0, "failures": 0, "skipped": 0, "last_duration": None,
+                      "max_duration": 0.0, "total_duration": 0.0, "last_error": None}
+
+    def next_delay(self):
+        """The interval with +/- ``jitter`` spread so jobs and workers don't fire in lockstep"""
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def snapshot(self):
+        runs = self.stats["runs"]
+        return {
+            **self.stats,
+            "interval": self.interval,
+            "avg_duration": self.stats["total_duration"] / runs if runs else None,
+        }
+
+
+class JobScheduler:
+    def __init__(self, owner=None, shutdown_grace=10.0, max_running=None):
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.shutdown_grace = shutdown_grace
+        # Caps concurrent runs across all jobs, e.g. when many shops come due at once
+        self._slots = asyncio.Semaphore(max_running) if max_running else None
+        self.jobs = {}
+        self._tasks = []
+        self._started = False
+        self._running = set()
+        self._stopping = asyncio.Event()
+
+    def add(self, name, func, interval, jitter=0.1, timeout=None, context=None):
+        """Register a job; ``context`` is the contextvars context its runs execute in.
+
+        A job added to a started scheduler is scheduled right away.
+        """
+        job = self.jobs[name] = Job(name, func, interval, jitter, timeout, context)
+        if self._started:
+            self._tasks.append(asyncio.create_task(self._loop(job), context=job.context))
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self._stopping.clear()
+            self._tasks = [asyncio.create_task(self._loop(job), context=job.context) for job in self.jobs.values()]
+
+    async def stop(self):
+        """Stop scheduling, give in-flight runs ``shutdown_grace`` seconds, then cancel them"""
+        self._started = False
+        self._stopping.set()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(self._tasks, timeout=self.shutdown_grace)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run_now(self, name):
+        """Run a job immediately (if no other worker holds it); returns False when skipped"""
+        return await self._run(self.jobs[name])
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _loop(self, job):
+        # Spread the first runs out instead of firing every job at startup
+        await self._sleep(random.uniform(0, job.interval * job.jitter))
+        while not self._stopping.is_set():
+            try:
+                ran = await self._run(job)
+            except Exception as e:
+                logging.error(f"Background job {job.name} could not be scheduled: {e}")
+                ran = False
+            await self._sleep(job.next_delay() if ran else min(job.interval, job.wait or job.interval))
+
+    async def _run(self, job):
+        if self._slots is None:
+            return await self._run_job(job)
+        async with self._slots:
+            return await self._run_job(job)
+
+    async def _run_job(self, job):
+        if job.name in self._running:
+            job.stats["skipped"] += 1
+            return False
+        wait = await asyncio.to_thread(store.claim_job, job.name, self.owner, job.timeout)
+        if wait is not None:
+            # Not due yet, or another worker is running it
+            job.wait = wait + random.uniform(0, job.interval * job.jitter)
+            job.stats["skipped"] += 1
+            return False
+
+        self._running.add(job.name)
+        started = time.monotonic()
+        error = None
+        try:
+            await asyncio.wait_for(job.func(), timeout=job.timeout)
+        except asyncio.CancelledError:
+            error = "cancelled"
+            raise
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logging.warning(f"Background job {job.name} failed: {error}")
+        finally:
+            self._running.discard(job.name)
+            duration = time.monotonic() - started
+            job.stats["runs"] += 1
+            job.stats["failures"] += error is not None
+            job.stats["last_duration"] = duration
+            job.stats["max_duration"] = max(job.stats["max_duration"], duration)
+            job.stats["total_duration"] += duration
+            job.stats["last_error"] = error
+            # A failed run is retried sooner than a full interval
+            next_run = time.time() + (job.next_delay() if error is None else min(job.interval, 30.0))
+            await asyncio.to_thread(store.finish_job, job.name, self.owner, next_run, duration, error)
+        return True
+
+    def snapshot(self):
+        return {"owner": self.owner, "jobs": {name: job.snapshot() for name, job in self.jobs.items()}}
@@ -0,0 +1,1232 @@
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+import asyncio
+import logging
+import os
+import time
+
+import bulk
+import cohorts
+import encoding
+import instrumentation
+import inventory
+import jobs
+import metrics
+import parallel
+import product_sales
+import refunds
+import rollups
+import shops
+import snapshot
+import store
+import webhooks
+from cache import ResponseCache
+from rate_limit import FairShare
+from shopify_client import ShopifyClient
+
+SHOPIFY_API_KEY = os.environ.get("SHOPIFY_API_KEY", "")
+SHOPIFY_API_SECRET = os.environ.get("SHOPIFY_API_SECRET", "")
+SHOPIFY_ACCESS_TOKEN = os.environ.get("SHOPIFY_ACCESS_TOKEN", "")
+SHOPIFY_SHOP = shops.DEFAULT_SHOP
+SHOPIFY_API_VERSION = os.environ.get("SHOPIFY_API_VERSION", "2023-10")  # Updated to latest version
+# Bearer token callers of this API present for the default shop
+SHOPIFY_DASHBOARD_TOKEN = os.environ.get("SHOPIFY_DASHBOARD_TOKEN", "")
+SHOPIFY_MAX_CONCURRENCY = int(os.environ.get("SHOPIFY_MAX_CONCURRENCY", "8"))
+SHOPIFY_GLOBAL_CONCURRENCY = int(os.environ.get("SHOPIFY_GLOBAL_CONCURRENCY", "64"))
+CACHE_TTL = float(os.environ.get("SHOPIFY_CACHE_TTL", "60"))
+CACHE_STALE_TTL = float(os.environ.get("SHOPIFY_CACHE_STALE_TTL", "600"))
+CACHE_SIZE = int(os.environ.get("SHOPIFY_CACHE_SIZE", "256"))
+BACKGROUND_REFRESH = os.environ.get("SHOPIFY_BACKGROUND_REFRESH", "1") == "1"
+ORDERS_REFRESH_INTERVAL = float(os.environ.get("SHOPIFY_ORDERS_REFRESH_INTERVAL", "300"))
+CATALOG_REFRESH_INTERVAL = float(os.environ.get("SHOPIFY_CATALOG_REFRESH_INTERVAL", "900"))
+REPORTS_REFRESH_INTERVAL = float(os.environ.get("SHOPIFY_REPORTS_REFRESH_INTERVAL", "900"))
+MAX_RUNNING_JOBS = int(os.environ.get("SHOPIFY_MAX_RUNNING_JOBS", "16"))
+
+# Every shop's client shares the process-wide pool of in-flight call slots
+fair_share = FairShare(SHOPIFY_GLOBAL_CONCURRENCY)
+
+
+def create_client(domain, creds):
+    return ShopifyClient(
+        domain,
+        creds.get("access_token", ""),
+        api_key=creds.get("api_key", ""),
+        api_secret=creds.get("api_secret", ""),
+        api_version=creds.get("api_version", SHOPIFY_API_VERSION),
+        max_concurrency=SHOPIFY_MAX_CONCURRENCY,
+        fair_share=fair_share,
+    )
+
+
+registry = shops.ShopRegistry(
+    create_client,
+    SHOPIFY_SHOP,
+    {
+        "access_token": SHOPIFY_ACCESS_TOKEN,
+        "api_key": SHOPIFY_API_KEY,
+        "api_secret": SHOPIFY_API_SECRET,
+        "webhook_secret": webhooks.WEBHOOK_SECRET,
+        "dashboard_token": SHOPIFY_DASHBOARD_TOKEN,
+    },
+    credentials=shops.load_credentials(),
+)
+
+# One cache for all shops; every key starts with the shop domain
+response_cache = ResponseCache(ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL, max_entries=CACHE_SIZE)
+
+webhook_workers = {}
+
+scheduler = jobs.JobScheduler(max_running=MAX_RUNNING_JOBS)
+
+
+def shopify():
+    """Shopify client of the shop the current request is for"""
+    return shops.current().client
+
+
+def cache_key(*parts):
+    return (shops.current().domain, *parts)
+
+
+def start_shop(shop):
+    """Start the webhook worker and refresh jobs of ``shop`` the first time it is served.
+
+    Shops that are never requested and get no webhooks cost no client,
+    worker or jobs. Events a shop queued before a restart are drained once
+    its next request or webhook arrives.
+    """
+    if shop.domain in webhook_workers:
+        return
+    # Applied webhook events change stored data, so the shop's cached responses are dropped
+    worker = webhook_workers[shop.domain] = webhooks.WebhookWorker(
+        on_applied=lambda domain=shop.domain: response_cache.clear(domain)
+    )
+    worker.start(shop.context())
+    if BACKGROUND_REFRESH:
+        add_refresh_jobs(shop)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if BACKGROUND_REFRESH:
+        scheduler.start()
+    # The environment-configured shop is prefetched as before; the others start on demand
+    start_shop(registry.get())
+    if instrumentation.profiler is not None:
+        instrumentation.profiler.start()
+    yield
+    if instrumentation.profiler is not None:
+        instrumentation.profiler.stop()
+    await scheduler.stop()
+    for worker in webhook_workers.values():
+        await worker.stop()
+    await registry.aclose()
+    parallel.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Served without a dashboard token
+PUBLIC_PATHS = {"/metrics", app.docs_url, app.redoc_url, app.openapi_url, app.swagger_ui_oauth2_redirect_url}
+
+
+def bearer_token(request):
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else None
+
+
+@app.middleware("http")
+async def resolve_shop(request: Request, call_next):
+    """Serve each request from the shop its credential belongs to.
+
+    API requests carry the shop's dashboard token as ``Authorization:
+    Bearer``; one naming another shop in X-Shopify-Shop-Domain or ?shop= is
+    refused. Webhook deliveries are authenticated by their HMAC instead,
+    which is checked against the secret of the shop they name. /metrics is
+    process-wide and belongs to no shop, and the API docs are public.
+
+    A single-shop deployment without SHOPIFY_DASHBOARD_TOKEN serves its
+    shop to every caller, as before tokens existed.
+    """
+    if request.url.path in PUBLIC_PATHS:
+        return await call_next(request)
+    domain = request.headers.get("x-shopify-shop-domain") or request.query_params.get("shop")
+    if request.method == "POST" and request.url.path.startswith("/api/shopify/webhooks/"):
+        shop = registry.get(domain)
+        if shop is None:
+            return JSONResponse(status_code=404, content={"detail": f"Unknown shop: {domain}"})
+    else:
+        shop = registry.authenticate(bearer_token(request))
+        if shop is None:
+            return JSONResponse(status_code=401, content={"detail": "Missing or invalid dashboard token"},
+                                headers={"WWW-Authenticate": "Bearer"})
+        if domain and domain.strip().lower() != shop.domain:
+            return JSONResponse(status_code=403, content={"detail": f"Not authorized for shop {domain}"})
+    shops.activate(shop)
+    start_shop(shop)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Time every request (and the stages recorded with instrumentation.span) for /metrics"""
+    started = time.perf_counter()
+    timings = instrumentation.start_request()
+    response = await call_next(request)
+    # The route template, not the raw path, so ids and topics don't each get a series
+    route = request.scope.get("route")
+    server_timing = await instrumentation.finish_request(
+        request.method, getattr(route, "path", "unmatched"), response.status_code, started, timings
+    )
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@instrumentation.collector
+def collect_cache_metrics():
+    stats = response_cache.snapshot()
+    lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+    return [
+        ("shopify_cache_lookups_total", "counter", "Response cache lookups by result",
+         [({"result": result}, stats[key]) for result, key in
+          (("hit", "hits"), ("stale", "stale_hits"), ("miss", "misses"), ("not_modified", "not_modified"))]),
+        ("shopify_cache_hit_ratio", "gauge", "Fresh or stale cache hits over all lookups",
+         [({}, (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0)]),
+        ("shopify_cache_entries", "gauge", "Responses held in the cache", [({}, stats["entries"])]),
+    ]
+
+
+@instrumentation.collector
+def collect_rate_limit_metrics():
+    # Summed over shops: /metrics is unauthenticated, so it names no tenant
+    limits = [shop.client.scheduler.snapshot() for shop in registry.active()]
+    process = fair_share.snapshot()
+    return [
+        ("shopify_throttled_total", "counter", "429 responses from Shopify",
+         [({}, sum(stats["throttled"] for stats in limits))]),
+        ("shopify_retries_total", "counter", "Retried Shopify calls",
+         [({}, sum(stats["retries"] for stats in limits))]),
+        ("shopify_rate_limit_wait_seconds_total", "counter", "Time spent waiting for the call-limit bucket",
+         [({}, sum(stats["wait_seconds"] for stats in limits))]),
+        ("shopify_bucket_fill", "gauge", "Estimated fill of the fullest Shopify call-limit bucket",
+         [({}, max((stats["bucket_fill"] for stats in limits), default=0))]),
+        ("shopify_inflight_calls", "gauge", "Shopify calls in flight across every shop",
+         [({}, process["active"])]),
+        ("shopify_waiting_calls", "gauge", "Shopify calls waiting for a process-wide slot",
+         [({}, process["waiting"])]),
+    ]
+
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Adjust for production
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+ANALYTICS_REPORTS = {
+    "sessions": "sessions",
+    "conversions": "conversion",
+    "traffic_sources": "traffic_sources",
+    "device_types": "device_types",
+    "landing_pages": "top_landing_pages",
+    "referrers": "top_referrers",
+    "social_referrers": "social_referrers",
+    "marketing_attribution": "marketing_attribution",
+    "customer_cohorts": "customer_cohorts",
+    "product_sell_through": "product_sell_through",
+}
+
+
+async def fetch_all_shopify(endpoint, params=None):
+    """Fetch all pages of data from Shopify API with pagination handling"""
+    return await shopify().fetch_all(endpoint, params)
+
+
+# Stored reports older than this are fetched again instead of served
+REPORT_MAX_AGE = REPORTS_REFRESH_INTERVAL * 3
+
+# Reports (and the query parameters the endpoints ask for by default) kept
+# fresh by the background jobs
+PREFETCH_REPORTS = [
+    *((report, {}) for report in ANALYTICS_REPORTS.values()),
+    ("sales", {}),
+    ("sessions", {"group_by": "day"}),
+]
+
+
+async def fetch_analytics_data(report_type, query_params=None):
+    """Fetch data from Shopify Analytics API, preferring a report stored by the background jobs"""
+    stored = await asyncio.to_thread(store.load_report, report_type, query_params, REPORT_MAX_AGE)
+    if stored is not None:
+        return stored
+    report = await shopify().fetch_report(report_type, query_params)
+    await asyncio.to_thread(store.save_report, report_type, query_params, report)
+    return report
+
+
+async def fetch_analytics_reports(report_types, query_params=None):
+    """Fetch several analytics reports, only going to Shopify for those not stored.
+
+    Failed reports come back as empty dicts and are not stored.
+    """
+    reports = {}
+    for report_type in report_types:
+        reports[report_type] = await asyncio.to_thread(store.load_report, report_type, query_params, REPORT_MAX_AGE)
+    missing = [report_type for report_type, report in reports.items() if report is None]
+    if missing:
+        fetched = await shopify().fetch_reports(missing, query_params)
+        for report_type, report in fetched.items():
+            if report:
+                await asyncio.to_thread(store.save_report, report_type, query_params, report)
+        reports.update(fetched)
+    return reports
+
+
+SYNC_PARAMS = {
+    "orders": {"status": "any", "limit": 250},
+    "products": {"limit": 250},
+    "customers": {"limit": 250},
+}
+
+STREAM_BATCH_SIZE = int(os.environ.get("SHOPIFY_STREAM_BATCH_SIZE", "1000"))
+
+# Incremental syncs re-read this many seconds before the watermark; upserts
+# are idempotent, so the overlap only costs a few repeated records
+SYNC_OVERLAP = float(os.environ.get("SHOPIFY_SYNC_OVERLAP", "300"))
+
+
+def capped_watermark(newest, started):
+    """The watermark a sync that started at ``started`` may record.
+
+    A record changed while later pages were still being fetched can be
+    stamped older than records those pages returned; capping at the start
+    of the sync makes the next one ask for it again.
+    """
+    return min(newest, started) if newest else newest
+
+
+def updated_at_min(watermark):
+    """The updated_at_min of an incremental sync from ``watermark``, less the overlap"""
+    since = datetime.fromisoformat(watermark) - timedelta(seconds=SYNC_OVERLAP)
+    return since.strftime("%Y-%m-%dT%H:%M:%S") + "-00:00"
+
+async def sync_resource(resource, full=False):
+    """Sync one resource into the local store; returns the number of records that changed.
+
+    Pages are written to the store as they arrive, so memory stays bounded by
+    one page. The watermark only moves once every page has been stored, and
+    never past the moment the sync started.
+    """
+    async with shops.current().lock(f"sync:{resource}"):
+        return await _sync_resource(resource, full)
+
+
+async def _sync_resource(resource, full):
+    if full:
+        await asyncio.to_thread(store.reset, resource)
+    watermark = await asyncio.to_thread(store.get_watermark, resource)
+    # Backfills and full resyncs are one bulk export instead of thousands of pages
+    if bulk.BULK_SYNC and not watermark:
+        try:
+            return await _bulk_sync_resource(resource)
+        except Exception as e:
+            logging.warning(f"Bulk export of {resource} failed, falling back to paginated sync: {e}")
+
+    params = dict(SYNC_PARAMS[resource])
+    if watermark:
+        params["updated_at_min"] = updated_at_min(watermark)
+
+    started = store.utc_now()
+    changed = 0
+    newest = watermark
+    async for page in shopify().iter_pages(resource, params):
+        page_newest, written = await asyncio.to_thread(store.upsert, resource, page)
+        newest = max(filter(None, [newest, page_newest]), default=None)
+        # Records re-read by the overlap come back unchanged and aren't written
+        changed += written
+    await asyncio.to_thread(store.set_watermark, resource, capped_watermark(newest, started))
+    return changed
+
+
+async def _bulk_sync_resource(resource):
+    # Shopify runs one bulk query per shop at a time
+    async with shops.current().lock("bulk"):
+        started = store.utc_now()
+        changed = 0
+        newest = None
+        async for batch in bulk.export(shopify(), resource):
+            page_newest, written = await asyncio.to_thread(store.upsert, resource, batch)
+            newest = max(filter(None, [newest, page_newest]), default=None)
+            changed += written
+        await asyncio.to_thread(store.set_watermark, resource, capped_watermark(newest, started))
+        return changed
+
+
+async def iter_stored(resource, start_date=None, end_date=None, batch_size=None):
+    """Stream stored records in id-ordered batches instead of loading the whole table"""
+    after_id = None
+    while True:
+        batch = await asyncio.to_thread(
+            store.load_page, resource, start_date, end_date, after_id, batch_size or STREAM_BATCH_SIZE
+        )
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1]["id"]
+
+
+async def sync_shopify_store(full=False):
+    """Bring the local store up to date using updated_at watermarks.
+
+    An incremental sync only asks Shopify for records updated since the last
+    watermark; ``full=True`` drops the local copy and downloads everything.
+    Orders, products and customers are synced concurrently, and a failure of
+    one resource does not discard the others.
+    """
+    counts = await asyncio.gather(
+        *(sync_resource(r, full) for r in store.RESOURCES), return_exceptions=True
+    )
+
+    summary = {}
+    for resource, result in zip(store.RESOURCES, counts):
+        if isinstance(result, Exception):
+            # Keep the other resources' progress; this one retries from its old watermark
+            logging.warning(f"Shopify sync of {resource} failed: {result}")
+            summary[resource] = {"error": str(result)}
+        else:
+            summary[resource] = result
+    return summary
+
+
+async def order_columns():
+    """Columnar view of every stored order, rebuilt only when the store has changed.
+
+    Orders are streamed out of the store into a ``metrics.OrderColumnsBuilder``
+    together with their refund totals and written as a snapshot that later
+    requests (and other workers) memory-map instead of re-parsing JSON.
+    Large shops are built by time range over the ``parallel`` process pool.
+    """
+    async with shops.current().lock("snapshot"):
+        version = await asyncio.to_thread(store.version, "orders")
+        cols = await asyncio.to_thread(snapshot.load, "orders", version)
+        if cols is not None:
+            cols.version = version
+            return cols
+
+        ranges = await asyncio.to_thread(store.created_ranges, "orders", parallel.WORKERS, parallel.MIN_ORDERS)
+        if len(ranges) > 1:
+            with instrumentation.span("columns"):
+                cols, complete = await parallel.build_columns(store.current_path(), ranges, fetch_all_shopify)
+        else:
+            builder = metrics.OrderColumnsBuilder()
+            complete = True
+            async for batch in iter_stored("orders"):
+                with instrumentation.span("refunds"):
+                    totals = await refunds.refund_totals(batch, fetch_all_shopify)
+                complete = complete and all(o["id"] in totals for o in batch)
+                with instrumentation.span("columns"):
+                    await asyncio.to_thread(builder.extend, batch, totals)
+            cols = builder.build()
+        cols.version = version
+
+        # A failed refund lookup must be retried, so don't persist that result
+        if complete:
+            with instrumentation.span("snapshot_write"):
+                cols.directory = await asyncio.to_thread(snapshot.write, "orders", cols, version)
+        return cols
+
+
+async def ensure_rollups(attempts=3):
+    """Backfill the daily rollups from the order snapshot the first time they are needed.
+
+    Returns False if the store kept changing underneath every rebuild attempt.
+    """
+    for _ in range(attempts):
+        if await asyncio.to_thread(store.rollups_built):
+            return True
+        cols = await order_columns()
+        # Large shops compute the rows in the process pool, before the write lock is taken
+        rows = await parallel.rollup_rows(cols)
+        if await asyncio.to_thread(store.rebuild_rollups, cols, cols.version, rows):
+            return True
+    return False
+
+
+async def refresh_resource(resource):
+    """Background job: pull changes to one resource and precompute what the endpoints serve"""
+    changed = await sync_resource(resource)
+    if resource == "orders":
+        # Synced orders already reached the rollups inside store.upsert; the
+        # snapshot is only built when a rollup rebuild or the fallback needs it
+        await ensure_rollups()
+    if resource == "products" and any(await refresh_inventory()):
+        changed = True
+    if changed:
+        response_cache.clear(shops.current().domain)
+
+
+async def refresh_report(report_type, params):
+    """Background job: fetch one analytics report into the store"""
+    report = await shopify().fetch_report(report_type, params)
+    await asyncio.to_thread(store.save_report, report_type, params, report)
+
+
+def add_refresh_jobs(shop):
+    """Register the periodic sync and report jobs of one shop"""
+    context = shop.context()
+    scheduler.add(f"{shop.domain}/sync:orders", lambda: refresh_resource("orders"),
+                  ORDERS_REFRESH_INTERVAL, context=context)
+    for resource in ("products", "customers"):
+        scheduler.add(f"{shop.domain}/sync:{resource}", lambda r=resource: refresh_resource(r),
+                      CATALOG_REFRESH_INTERVAL, context=context)
+    for report, params in PREFETCH_REPORTS:
+        name = ":".join(["report", report, *(f"{k}={v}" for k, v in sorted(params.items()))])
+        scheduler.add(f"{shop.domain}/{name}", lambda r=report, p=params: refresh_report(r, p),
+                      REPORTS_REFRESH_INTERVAL, context=context)
+
+
+def cohort_range(start_date=None, end_date=None):
+    """Cohort month numbers covering a YYYY-MM-DD range; ValueError for a malformed date"""
+    def month(value):
+        if not value:
+            return None
+        parsed = date.fromisoformat(value)
+        return cohorts.month_number(parsed.year, parsed.month)
+    return month(start_date), month(end_date)
+
+
+def day_range(start_date=None, end_date=None):
+    """Rollup day numbers of an inclusive YYYY-MM-DD range, None for an open end"""
+    return (rollups.day_number(start_date) if start_date else None,
+            rollups.day_number(end_date) if end_date else None)
+
+
+@app.get("/api/shopify/data")
+async def get_shopify_data(
+    request: Request,
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    include_analytics: bool = Query(True, description="Include detailed analytics data"),
+    include_raw: bool = Query(False, description="Include raw orders, products and customers")
+):
+    try:
+        day_range(start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return await response_cache.respond(
+            request,
+            cache_key("data", start_date, end_date, include_analytics, include_raw),
+            lambda: build_shopify_data(start_date, end_date, include_analytics, include_raw),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.exception(f"Building Shopify data failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+STREAM_MEDIA_TYPES = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+
+@app.get("/api/shopify/data/stream")
+async def stream_shopify_data_endpoint(
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    include_analytics: bool = Query(True, description="Include detailed analytics data"),
+    include_raw: bool = Query(False, description="Include raw orders, products and customers"),
+    format: str = Query("sse", description="sse (server-sent events) or ndjson")
+):
+    """Stream the /api/shopify/data payload one section at a time, each as soon as it is computed.
+
+    Every SSE event is named after its section; every NDJSON line is
+    ``{"section": ..., "data": ...}``. The last one is ``done`` (or ``error``).
+    """
+    if format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported stream format: {format}")
+    try:
+        day_range(start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # A fresh (or stale) /api/shopify/data result is streamed from the cache instead of recomputed
+    entry, status = response_cache.lookup(
+        cache_key("data", start_date, end_date, include_analytics, include_raw),
+        lambda: build_shopify_data(start_date, end_date, include_analytics, include_raw),
+    )
+    if entry is not None:
+        sections = cached_shopify_data(entry)
+    else:
+        sections = stream_shopify_data(start_date, end_date, include_analytics, include_raw)
+
+    async def body():
+        async for section, value in sections:
+            payload = await asyncio.to_thread(encoding.dumps, value)
+            if format == "sse":
+                yield b"event: " + section.encode() + b"\ndata: " + payload + b"\n\n"
+            else:
+                yield b'{"section":"' + section.encode() + b'","data":' + payload + b"}\n"
+
+    return StreamingResponse(body(), media_type=STREAM_MEDIA_TYPES[format],
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": status})
+
+
+async def sync_if_needed():
+    """Pull only what changed since the last sync before reading from the local store.
+
+    The background jobs keep the store current; only a store that has never
+    been synced is filled inline.
+    """
+    if BACKGROUND_REFRESH and await asyncio.to_thread(store.get_watermark, "orders"):
+        return
+    try:
+        with instrumentation.span("sync"):
+            await sync_shopify_store()
+    except Exception as e:
+        logging.warning(f"Incremental Shopify sync failed, serving stored data: {e}")
+
+
+async def refresh_inventory(products=None):
+    """Fetch the inventory of the variants whose cached levels are stale; returns the counts fetched"""
+    async with shops.current().lock("inventory"):
+        if products is None:
+            products = await asyncio.to_thread(store.load, "products")
+        return await inventory.refresh(shopify(), products)
+
+
+async def sell_through_rows(products, start_date=None, end_date=None):
+    """Sell-through of every tracked variant over a date range, and the location names.
+
+    Units sold come from the product sales index and stock from the cached
+    inventory levels, which the background jobs keep current; only a shop
+    whose inventory was never fetched is fetched inline.
+    """
+    if not BACKGROUND_REFRESH or await asyncio.to_thread(store.load_locations) is None:
+        try:
+            await refresh_inventory(products)
+        except Exception as e:
+            logging.warning(f"Inventory refresh failed, using cached levels: {e}")
+    first, last = day_range(start_date, end_date)
+
+    def compute():
+        sold = store.product_sales_index().units_by_variant(first, last) if store.rollups_built() else {}
+        levels, items = store.load_inventory()
+        names = {location["id"]: location.get("name") for location in store.load_locations() or []}
+        return inventory.variant_rows(products, sold, levels, items, names), names
+
+    return await asyncio.to_thread(compute)
+
+
+async def dashboard_analytics(start_date=None, end_date=None):
+    """The analytics reports embedded in the dashboard payload, {} if unavailable"""
+    sessions_params = {"date_min": start_date, "date_max": end_date} if start_date and end_date else {}
+    try:
+        with instrumentation.span("analytics"):
+            reports = await fetch_analytics_reports(list(ANALYTICS_REPORTS.values()), sessions_params)
+        return {name: reports[report] for name, report in ANALYTICS_REPORTS.items()}
+    except Exception as e:
+        logging.warning(f"Shopify analytics endpoints unavailable or failed: {e}")
+        return {}
+
+
+async def dashboard_metrics(start_date=None, end_date=None):
+    """Order summary and customer cohorts for a date range.
+
+    Any date range is answered from the pre-aggregated daily rollups; the
+    columnar snapshot is the fallback while they cannot be built.
+    """
+    customer_cohort = {
+        "all_cohorts": {"customers": 0, "retention_rate": 0.0, "months": [0.0] * 12},
+        "monthly_cohorts": {},
+    }
+    with instrumentation.span("rollups"):
+        rollups_built = await ensure_rollups()
+    if rollups_built:
+        with instrumentation.span("metrics"):
+            summary = await asyncio.to_thread(store.rollup_summary, start_date, end_date)
+        with instrumentation.span("cohorts"):
+            customer_cohort = await asyncio.to_thread(store.cohort_summary, *cohort_range(start_date, end_date))
+    else:
+        cols = await order_columns()
+        with instrumentation.span("metrics"):
+            summary = await asyncio.to_thread(lambda: metrics.compute_metrics(cols.between(start_date, end_date)))
+    return summary, customer_cohort
+
+
+def summary_sections(summary):
+    """Dashboard sections computed from the order summary alone, cheapest first"""
+    return {
+        "orders_summary": {
+            "count": summary["order_count"],
+            "fulfilled": summary["orders_fulfilled"],
+            "growth_percentage": 11  # From dashboard
+        },
+        "sales_summary": {
+            "gross_sales": summary["gross_sales"],
+            "growth_percentage": 120,  # From dashboard
+            "discounts": summary["discounts"],
+            "returns": summary["returns"],
+            "net_sales": summary["net_sales"],
+            "shipping": summary["shipping"],
+            "taxes": summary["taxes"],
+            "total_sales": summary["total_sales"]
+        },
+        "customer_metrics": {
+            "returning_customer_rate": summary["returning_customer_rate"],
+            "growth_percentage": 66.67  # From dashboard
+        },
+        "average_order_value": {
+            "value": summary["aov"],
+            "growth_percentage": 145,  # From dashboard
+            "by_month": {
+                "current_year": {"Jan": 0, "Feb": 0, "Mar": 618.50, "Apr": 1600, "May": 2300, 
+                                "Jun": 0, "Jul": 1400, "Aug": 2600, "Sep": 0, "Oct": 0, "Nov": 0, "Dec": 0},
+                "previous_year": {"Jan": 239, "Feb": 781.73}
+            }
+        },
+        "sales_over_time": {
+            **summary["sales_over_time"],
+            "total": summary["total_sales"]
+        },
+        "sales_by_channel": summary["sales_by_channel"],
+        "sales_by_product": summary["sales_by_product"],
+    }
+
+
+async def catalog_sections(analytics_data, start_date=None, end_date=None):
+    """Dashboard sections built from the stored products, their inventory and the analytics reports.
+
+    Returns the sections and the products they were built from.
+    """
+    with instrumentation.span("products"):
+        products = await asyncio.to_thread(store.load, "products")
+
+    # Calculate session data by month if not coming from analytics
+    if not analytics_data.get("sessions"):
+        # This is a fallback if we don't have real analytics data
+        sessions_by_month = {
+            "current_year": [35, 552, 328, 364, 293, 475, 368, 161, 21, 26, 132, 1],
+            "previous_year": [4, 13, 38, 173, 0, 352, 32, 52, 0, 0, 0, 8]
+        }
+    else:
+        sessions_by_month = analytics_data.get("sessions")
+
+    # Calculate conversion rate if not from analytics
+    conversion_rate = 0.15  # From dashboard
+
+    with instrumentation.span("inventory"):
+        rows, location_names = await sell_through_rows(products, start_date, end_date)
+
+    sections = {
+        "sessions": {
+            "total": 2756,  # From dashboard
+            "growth_percentage": 310,  # From dashboard
+            "by_month": sessions_by_month,
+            "by_device": {
+                "Desktop": 2800,  # From dashboard
+                "Mobile": 3  # From dashboard
+            },
+            "by_landing_page": {
+                "Homepage · /": 155,
+                "Cart · /cart": 29,
+                "Custom Page · /pages/custom-form": 20,
+                "Checkout · /checkouts/cn/Z2NwLWFzaWEtc291dGhlYXN0MTowMUhXWUc2VFhXRjBYRDM0QTEyVkFYM1AzRw/information": 8,
+                "Custom Page · /pages/remote-fitting": 7,
+                "Product · /products/3-numbers-white-on-black-zz9100": 7,
+                "Custom Page · /pages/order-list": 6,
+                "Custom Page · /pages/order-details": 4,
+                "Product · /products/1-slingshot-extreme-soft-shackle": 4,
+                "Custom Page · /pages/aboutus2": 3
+            },
+            "by_referrer": {
+                "top_referrers": {
+                    "admin.shopify.com": 12,
+                    "2w754eagovaga3yu-52847476913.shopifypreview.com": 2,
+                    "vtxxwxzzy852axlp-52847476913.shopifypreview.com": 1,
+                    "terms-albania-lexus-ps.trycloudflare.com": 1,
+                    "sh.customily.com": 1
+                },
+                "social_referrers": {}  # Empty from dashboard
+            }
+        },
+        "conversion_rate": {
+            "rate": conversion_rate,
+            "growth_percentage": 2,  # From dashboard
+            "by_month": {
+                "current_year": {"Jan": 0, "Feb": 0, "Mar": 0.3, "Apr": 0, "May": 0, 
+                                 "Jun": 0, "Jul": 0.5, "Aug": 0.6, "Sep": 0, "Oct": 0, "Nov": 0, "Dec": 0},
+                "previous_year": {"Jan": 0, "Feb": 0, "Mar": 0, "Apr": 0.6, "May": 0, 
+                                 "Jun": 0, "Jul": 0, "Aug": 0, "Sep": 0, "Oct": 0, "Nov": 0, "Dec": 0}
+            }
+        },
+        "sales_by_social_referrer": {},  # Empty from dashboard
+        "sales_attributed_to_marketing": {},  # Not provided in dashboard
+        "product_sell_through": {
+            **inventory.summary(rows, location_names),
+            "growth_percentage": 68,  # From dashboard
+        },
+    }
+    return sections, products
+
+
+# Order of the sections in the "data" object of /api/shopify/data
+DATA_SECTIONS = (
+    "orders_summary", "sales_summary", "customer_metrics", "sales_over_time", "average_order_value",
+    "sessions", "conversion_rate", "sales_by_channel", "sales_by_product", "sales_by_social_referrer",
+    "sales_attributed_to_marketing", "product_sell_through", "customer_cohort",
+)
+
+
+async def raw_data(products, start_date=None, end_date=None):
+    with instrumentation.span("raw"):
+        return {
+            "orders": await asyncio.to_thread(store.load, "orders", start_date, end_date),
+            "products": products,
+            # Customers (filtered by creation date if needed)
+            "customers": await asyncio.to_thread(store.load, "customers", start_date, end_date)
+        }
+
+
+async def build_shopify_data(start_date=None, end_date=None, include_analytics=True, include_raw=False):
+    """Compute the dashboard payload served by /api/shopify/data.
+
+    Raw records are only embedded when ``include_raw`` is set; otherwise use
+    the paginated /api/shopify/records endpoint.
+    """
+    async def analytics():
+        return await dashboard_analytics(start_date, end_date) if include_analytics else {}
+
+    async def order_metrics():
+        await sync_if_needed()
+        return await dashboard_metrics(start_date, end_date)
+
+    # The store sync and every analytics report run concurrently
+    (summary, customer_cohort), analytics_data = await asyncio.gather(order_metrics(), analytics())
+    sections = summary_sections(summary)
+    catalog, products = await catalog_sections(analytics_data, start_date, end_date)
+    sections.update(catalog, customer_cohort=customer_cohort)
+    raw = await raw_data(products, start_date, end_date) if include_raw else None
+    return shopify_data(sections, analytics_data if include_analytics else {}, raw)
+
+
+def shopify_data(sections, analytics_data, raw=None):
+    """Assemble the /api/shopify/data payload from its computed sections"""
+    result = {
+        "data": {name: sections[name] for name in DATA_SECTIONS},
+        "analytics_data": analytics_data
+    }
+    if raw is not None:
+        result["raw_data"] = raw
+    return result
+
+
+async def cached_shopify_data(entry):
+    """Yield the sections of a cached /api/shopify/data result like ``stream_shopify_data`` does"""
+    result = await asyncio.to_thread(encoding.loads, entry.body)
+    for name in DATA_SECTIONS:
+        yield name, result["data"][name]
+    yield "analytics_data", result["analytics_data"]
+    if "raw_data" in result:
+        yield "raw_data", result["raw_data"]
+    yield "done", {"sections": [*DATA_SECTIONS, "analytics_data"]}
+
+
+async def stream_shopify_data(start_date=None, end_date=None, include_analytics=True, include_raw=False):
+    """Yield ``(section, value)`` pairs of the dashboard payload as each is ready.
+
+    The order summary sections come first, as soon as the rollups answer;
+    ``analytics_data`` is sent whenever the reports arrive, which may be
+    before or after them. Sections needing both follow, and ``done`` ends
+    the stream (``error`` replaces it if the order metrics fail). A complete
+    stream leaves the assembled payload in the cache for /api/shopify/data.
+    """
+    queue = asyncio.Queue()
+    sections = {}
+
+    async def order_metrics():
+        await sync_if_needed()
+        summary, customer_cohort = await dashboard_metrics(start_date, end_date)
+        for name, value in summary_sections(summary).items():
+            queue.put_nowait((name, value))
+        queue.put_nowait(("customer_cohort", customer_cohort))
+
+    async def analytics():
+        analytics_data = await dashboard_analytics(start_date, end_date) if include_analytics else {}
+        queue.put_nowait(("analytics_data", analytics_data))
+        return analytics_data
+
+    async def run(coro):
+        try:
+            return await coro
+        finally:
+            queue.put_nowait(None)
+
+    tasks = [asyncio.ensure_future(run(order_metrics())), asyncio.ensure_future(run(analytics()))]
+    try:
+        finished = 0
+        while finished < len(tasks):
+            item = await queue.get()
+            if item is None:
+                finished += 1
+            else:
+                sections[item[0]] = item[1]
+                yield item
+        try:
+            tasks[0].result()
+            analytics_data = tasks[1].result()
+            catalog, products = await catalog_sections(analytics_data, start_date, end_date)
+            for name, value in catalog.items():
+                sections[name] = value
+                yield name, value
+            raw = None
+            if include_raw:
+                raw = await raw_data(products, start_date, end_date)
+                yield "raw_data", raw
+        except Exception as e:
+            logging.error(f"Streaming Shopify data failed: {e}")
+            yield "error", {"error": str(e)}
+            return
+        await response_cache.put(cache_key("data", start_date, end_date, include_analytics, include_raw),
+                                 shopify_data(sections, analytics_data, raw))
+        yield "done", {"sections": [*DATA_SECTIONS, "analytics_data"]}
+    finally:
+        # The client may go away mid-stream
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/api/shopify/sync")
+async def sync_shopify(full: bool = Query(False, description="Drop the local store and resync everything")):
+    """Run an incremental (or, on demand, full) sync of the local store"""
+    try:
+        synced = await sync_shopify_store(full=full)
+        if full:
+            response_cache.clear(shops.current().domain)
+        return {"synced": synced, "full": full, "status": await asyncio.to_thread(store.sync_status)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/sync")
+def get_sync_status():
+    """Get watermarks and record counts of the local store"""
+    return store.sync_status()
+
+
+@app.get("/api/shopify/jobs")
+async def get_job_status():
+    """Get background job timings in this worker and the run history shared by all workers"""
+    prefix = f"{shops.current().domain}/"
+    local = {name[len(prefix):]: job for name, job in scheduler.snapshot()["jobs"].items() if name.startswith(prefix)}
+    return {
+        "owner": scheduler.owner,
+        "enabled": BACKGROUND_REFRESH,
+        "jobs": local,
+        "shared": {name[len(prefix):]: run for name, run in (await asyncio.to_thread(store.job_status)).items()
+                   if name.startswith(prefix)},
+    }
+
+
+@app.get("/api/shopify/rate_limit")
+def get_rate_limit_status():
+    """Get request scheduler counters: waits, throttles, retries and bucket fill"""
+    return {**shopify().scheduler.snapshot(), "process": fair_share.snapshot()}
+
+
+@app.get("/api/shopify/records/{resource}")
+async def get_records(
+    request: Request,
+    resource: str,
+    cursor: int = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(250, ge=1, le=1000, description="Records per page"),
+    fields: str = Query(None, description="Comma-separated top-level fields to return"),
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD")
+):
+    """Get stored orders, products or customers one cursor page at a time"""
+    if resource not in store.RESOURCES:
+        raise HTTPException(status_code=404, detail=f"Unknown resource: {resource}")
+    try:
+        day_range(start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    records = await asyncio.to_thread(store.load_page, resource, start_date, end_date, cursor, limit)
+    next_cursor = records[-1]["id"] if len(records) == limit else None
+    if fields:
+        wanted = [f.strip() for f in fields.split(",") if f.strip()]
+        records = [{f: r[f] for f in wanted if f in r} for r in records]
+
+    body = await asyncio.to_thread(encoding.dumps, {"records": records, "next_cursor": next_cursor})
+    return await encoding.json_response(request, body)
+
+
+@app.post("/api/shopify/webhooks/{topic:path}")
+async def receive_webhook(request: Request, topic: str):
+    """Verify a Shopify webhook and queue it for the background worker"""
+    shop = shops.current()
+    body = await request.body()
+    if not webhooks.verify(body, request.headers.get("x-shopify-hmac-sha256"), shop.webhook_secret):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    if topic not in webhooks.TOPICS:
+        raise HTTPException(status_code=404, detail=f"Unsupported webhook topic: {topic}")
+
+    # Shopify retries deliveries with the same webhook id, which makes queueing idempotent
+    webhook_id = request.headers.get("x-shopify-webhook-id") or webhooks.sign(body, shop.webhook_secret)
+    queued = await asyncio.to_thread(store.enqueue_event, webhook_id, topic, body.decode())
+    if queued and shop.domain in webhook_workers:
+        webhook_workers[shop.domain].notify()
+    return {"queued": queued}
+
+
+@app.get("/api/shopify/webhooks")
+async def get_webhook_status():
+    """Get webhook queue depth and worker counters"""
+    worker = webhook_workers.get(shops.current().domain)
+    return {**await asyncio.to_thread(store.queue_status), **(worker.stats if worker else {})}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Request, stage, Shopify call and cache metrics in the Prometheus text format"""
+    return PlainTextResponse(instrumentation.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/shopify/cache")
+def get_cache_status():
+    """Get response cache counters"""
+    return response_cache.snapshot()
+
+
+@app.get("/api/shopify/reports")
+async def get_available_reports():
+    """Get list of available analytics reports"""
+    try:
+        resp = await shopify().get("reports")
+        
+        if resp.status_code != 200:
+            raise HTTPException(status_code=resp.status_code,
+                                detail=f"Shopify API error: {resp.text}")
+                                
+        return resp.json()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/sales_analytics")
+async def get_sales_analytics(
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD")
+):
+    """Get detailed sales analytics data"""
+    try:
+        date_params = {}
+        if start_date:
+            date_params["date_min"] = start_date
+        if end_date:
+            date_params["date_max"] = end_date
+            
+        return await fetch_analytics_data("sales", date_params)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/sessions")
+async def get_sessions_data(
+    request: Request,
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    group_by: str = Query("day", description="Group by: day, week, month")
+):
+    """Get sessions data with optional grouping"""
+    try:
+        params = {"group_by": group_by}
+        if start_date:
+            params["date_min"] = start_date
+        if end_date:
+            params["date_max"] = end_date
+            
+        return await response_cache.respond(
+            request,
+            cache_key("sessions", tuple(sorted(params.items()))),
+            lambda: fetch_analytics_data("sessions", params),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/device_types")
+async def get_device_data(
+    request: Request,
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD")
+):
+    """Get session data by device type"""
+    try:
+        params = {}
+        if start_date:
+            params["date_min"] = start_date
+        if end_date:
+            params["date_max"] = end_date
+            
+        return await response_cache.respond(
+            request,
+            cache_key("device_types", tuple(sorted(params.items()))),
+            lambda: fetch_analytics_data("device_types", params),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/top_products")
+async def get_top_products(
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    limit: int = Query(10, ge=1, le=1000, description="Number of products to return"),
+    by: str = Query("amount", description="Rank by: amount, quantity"),
+    level: str = Query("variant", description="Rank: variant, product")
+):
+    """Get top products by sales, ranked by the local product sales index"""
+    try:
+        if by not in product_sales.METRICS or level not in product_sales.LEVELS:
+            raise HTTPException(status_code=400, detail="by must be amount or quantity, level variant or product")
+        first, last = day_range(start_date, end_date)
+        if not await ensure_rollups():
+            raise HTTPException(status_code=503, detail="Order history is still being indexed")
+        products = await asyncio.to_thread(
+            lambda: store.product_sales_index().top(limit, by, level, first, last)
+        )
+        return {"by": by, "level": level, "products": products}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/products/search")
+async def search_products(
+    q: str = Query(..., min_length=1, description="Name prefix or title words"),
+    limit: int = Query(20, ge=1, le=200, description="Number of variants to return")
+):
+    """Find sold products by name prefix or title words, best sellers first"""
+    try:
+        if not await ensure_rollups():
+            raise HTTPException(status_code=503, detail="Order history is still being indexed")
+        products = await asyncio.to_thread(lambda: store.product_sales_index().search(q, limit))
+        return {"query": q, "products": products}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/products/{product_id}/sales")
+async def get_product_sales(
+    product_id: int,
+    variant_id: int = Query(None, description="Only this variant"),
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    bucket: str = Query("day", description="Group by: day, week, month")
+):
+    """Get the sales of one product (or variant) over time from the local product sales index"""
+    try:
+        if bucket not in product_sales.BUCKETS:
+            raise HTTPException(status_code=400, detail="bucket must be day, week or month")
+        first, last = day_range(start_date, end_date)
+        if not await ensure_rollups():
+            raise HTTPException(status_code=503, detail="Order history is still being indexed")
+        series = await asyncio.to_thread(
+            lambda: store.product_sales_index().series(product_id, variant_id, first, last, bucket)
+        )
+        if series is None:
+            raise HTTPException(status_code=404, detail=f"No sales recorded for product {product_id}")
+        return {"product_id": product_id, "variant_id": variant_id, "bucket": bucket, "sales": series}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# sort parameter of /api/shopify/inventory/sell_through -> row field, largest first
+SELL_THROUGH_SORTS = {"rate": "sell_through_rate", "sold": "sold", "on_hand": "on_hand"}
+
+
+@app.get("/api/shopify/inventory/sell_through")
+async def get_sell_through(
+    request: Request,
+    start_date: str = Query(None, description="YYYY-MM-DD"),
+    end_date: str = Query(None, description="YYYY-MM-DD"),
+    location_id: int = Query(None, description="Only variants stocked at this location"),
+    sort: str = Query("rate", description="Sort by: rate, sold, on_hand"),
+    limit: int = Query(100, ge=1, le=1000, description="Variants per page"),
+    offset: int = Query(0, ge=0)
+):
+    """Get sell-through per variant, with its stock at each location, from the cached inventory"""
+    try:
+        if sort not in SELL_THROUGH_SORTS:
+            raise HTTPException(status_code=400, detail="sort must be rate, sold or on_hand")
+        day_range(start_date, end_date)
+        if not await ensure_rollups():
+            raise HTTPException(status_code=503, detail="Order history is still being indexed")
+
+        async def compute():
+            products = await asyncio.to_thread(store.load, "products")
+            rows, location_names = await sell_through_rows(products, start_date, end_date)
+            if location_id is not None:
+                rows = [row for row in rows if any(level["location_id"] == location_id for level in row["locations"])]
+            field = SELL_THROUGH_SORTS[sort]
+            rows.sort(key=lambda row: (-row[field], row["variant_id"] or 0))
+            return {
+                "total": len(rows),
+                "offset": offset,
+                "variants": rows[offset:offset + limit],
+                "locations": inventory.location_summary(rows, location_names),
+            }
+
+        return await response_cache.respond(
+            request,
+            cache_key("sell_through", start_date, end_date, location_id, sort, limit, offset),
+            compute,
+        )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/shopify/customer_cohorts")
+async def get_customer_cohorts(
+    request: Request,
+    start_date: str = Query(None, description="First cohort month, YYYY-MM-DD"),
+    end_date: str = Query(None, description="Last cohort month, YYYY-MM-DD"),
+    months: int = Query(12, ge=1, le=120, description="Months of retention and LTV per cohort")
+):
+    """Get monthly customer cohorts with retention and LTV curves from the local order history"""
+    try:
+        start_month, end_month = cohort_range(start_date, end_date)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        if not await ensure_rollups():
+            raise HTTPException(status_code=503, detail="Order history is still being indexed")
+        return await response_cache.respond(
+            request,
+            cache_key("customer_cohorts", start_month, end_month, months),
+            lambda: asyncio.to_thread(store.cohort_summary, start_month, end_month, months),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,277 @@
+"""Columnar order representation and vectorized sales metrics.
+
+Orders are flattened once into NumPy columns (plus string dictionaries for
+channels, customers and products) by ``OrderColumnsBuilder``; every metric
+is then computed from those columns by ``compute_metrics`` without walking
+the order dicts again.
+"""
+from array import array
+from datetime import datetime, timezone
+
+import numpy as np
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Bumped whenever the set or meaning of the columns changes, so older snapshots are rebuilt
+# (3: year/month/day are the UTC calendar date)
+COLUMNS_FORMAT = 3
+
+
+def product_name(item):
+    """Display name used for a line item in sales_by_product"""
+    title = item.get("title", "Unknown")
+    variant_title = item.get("variant_title", "Default Title")
+    if variant_title and variant_title != "Default Title":
+        return f"{title} | {variant_title}"
+    return f"{title} | Default Title"
+
+
+def channel_name(order):
+    """Sales channel an order is reported under"""
+    return order.get("source_name") or "Other"
+
+
+def refund_amount(refunds):
+    """Sum the transaction amounts of a list of Shopify refunds"""
+    total = 0.0
+    for refund in refunds or []:
+        txs = refund.get("transactions", [])
+        if txs and isinstance(txs, list):
+            total += sum(float(tx.get("amount", 0)) for tx in txs)
+    return total
+
+
+class Dictionary:
+    """Maps distinct values to dense integer codes"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def date_to_epoch(date, end_of_day=False):
+    """Epoch seconds (UTC) of the start or end of a YYYY-MM-DD date"""
+    dt = datetime.fromisoformat(f"{date}T{'23:59:59' if end_of_day else '00:00:00'}+00:00")
+    return int(dt.timestamp())
+
+
+class OrderColumns:
+    """Columnar view of a set of orders and their line items.
+
+    Columns may be in-memory arrays or read-only memory maps of a snapshot.
+    """
+
+    def __init__(self, order_columns, item_columns, channels, customers, products):
+        self.order_fields = list(order_columns)
+        self.item_fields = list(item_columns)
+        for name, values in {**order_columns, **item_columns}.items():
+            setattr(self, name, values)
+        self.channels = channels
+        self.customers = customers
+        self.products = products
+
+    def __len__(self):
+        return len(self.total_price)
+
+    def order_columns(self):
+        return {name: getattr(self, name) for name in self.order_fields}
+
+    def item_columns(self):
+        return {name: getattr(self, name) for name in self.item_fields}
+
+    def select(self, mask):
+        """Orders where ``mask`` is true, with their line items re-indexed"""
+        positions = np.flatnonzero(mask)
+        remap = np.full(len(self), -1, dtype=np.int64)
+        remap[positions] = np.arange(len(positions))
+        item_mask = mask[self.item_order] if len(self.item_order) else np.zeros(0, dtype=bool)
+
+        items = {name: values[item_mask] for name, values in self.item_columns().items()}
+        items["item_order"] = remap[self.item_order[item_mask]]
+        return OrderColumns(
+            {name: values[positions] for name, values in self.order_columns().items()},
+            items,
+            self.channels,
+            self.customers,
+            self.products,
+        )
+
+    def between(self, start_date=None, end_date=None):
+        """Orders created within the inclusive YYYY-MM-DD range"""
+        if not start_date and not end_date:
+            return self
+        mask = self.created > 0
+        if start_date:
+            mask &= self.created >= date_to_epoch(start_date)
+        if end_date:
+            mask &= self.created <= date_to_epoch(end_date, end_of_day=True)
+        return self.select(mask)
+
+
+class OrderColumnsBuilder:
+    """Accumulates orders into typed arrays in a single pass"""
+
+    def __init__(self):
+        self.channels = Dictionary()
+        self.customers = Dictionary()
+        self.products = Dictionary()
+        self._orders = {
+            "order_id": array("q"),
+            "created": array("q"),
+            "total_price": array("d"),
+            "line_items_price": array("d"),
+            "discounts": array("d"),
+            "shipping": array("d"),
+            "taxes": array("d"),
+            "refunded": array("d"),
+            "fulfilled": array("b"),
+            "year": array("h"),
+            "month": array("b"),
+            "day": array("b"),
+            "channel": array("i"),
+            "customer": array("i"),
+            "customer_id": array("q"),
+        }
+        self._items = {
+            "item_order": array("q"),
+            "item_product": array("i"),
+            "item_product_id": array("q"),
+            "item_variant_id": array("q"),
+            "item_quantity": array("q"),
+            "item_amount": array("d"),
+        }
+
+    def add(self, order, refunded=0.0):
+        cols = self._orders
+        index = len(cols["total_price"])
+
+        cols["order_id"].append(order.get("id") or 0)
+        cols["total_price"].append(float(order.get("total_price", 0)))
+        cols["line_items_price"].append(float(order.get("total_line_items_price", 0)))
+        cols["discounts"].append(float(order.get("total_discounts", 0)))
+        shipping_set = order.get("total_shipping_price_set")
+        cols["shipping"].append(
+            float(shipping_set.get("shop_money", {}).get("amount", 0)) if shipping_set else 0.0
+        )
+        cols["taxes"].append(float(order.get("total_tax", 0)))
+        cols["refunded"].append(refunded)
+        cols["fulfilled"].append(order.get("fulfillment_status") == "fulfilled")
+
+        # created_at is parsed exactly once; 0 marks a missing timestamp. The
+        # calendar fields are in UTC, like the rollups' days
+        created = order.get("created_at")
+        if created:
+            dt = datetime.fromisoformat(created.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            dt = dt.astimezone(timezone.utc)
+            cols["created"].append(int(dt.timestamp()))
+            cols["year"].append(dt.year)
+            cols["month"].append(dt.month)
+            cols["day"].append(dt.day)
+        else:
+            cols["created"].append(0)
+            cols["year"].append(0)
+            cols["month"].append(0)
+            cols["day"].append(0)
+
+        cols["channel"].append(self.channels.encode(channel_name(order)))
+        email = order.get("email")
+        cols["customer"].append(self.customers.encode(email) if email else -1)
+        customer = order.get("customer")
+        cols["customer_id"].append((customer.get("id") or 0) if isinstance(customer, dict) else 0)
+
+        items = self._items
+        for item in order.get("line_items", []):
+            quantity = int(item.get("quantity", 1))
+            items["item_order"].append(index)
+            items["item_product"].append(self.products.encode(product_name(item)))
+            items["item_product_id"].append(item.get("product_id") or 0)
+            items["item_variant_id"].append(item.get("variant_id") or 0)
+            items["item_quantity"].append(quantity)
+            items["item_amount"].append(float(item.get("price", 0)) * quantity)
+
+    def extend(self, orders, refunds=None):
+        """Add orders, taking per-order refunded amounts from ``refunds`` by order id"""
+        refunds = refunds or {}
+        for order in orders:
+            self.add(order, refunds.get(order.get("id"), 0.0))
+        return self
+
+    def build(self):
+        return OrderColumns(
+            {name: np.frombuffer(values, dtype=values.typecode) if len(values) else np.zeros(0, values.typecode)
+             for name, values in self._orders.items()},
+            {name: np.frombuffer(values, dtype=values.typecode) if len(values) else np.zeros(0, values.typecode)
+             for name, values in self._items.items()},
+            self.channels.values,
+            self.customers.values,
+            self.products.values,
+        )
+
+
+def build_columns(orders):
+    """Flatten an iterable of order dicts into ``OrderColumns``"""
+    return OrderColumnsBuilder().extend(orders).build()
+
+
+def _by_code(codes, weights, labels):
+    """Sum ``weights`` per dictionary label, keeping only labels that occur in ``codes``"""
+    totals = np.bincount(codes, weights=weights, minlength=len(labels))
+    present = np.bincount(codes, minlength=len(labels)) > 0
+    return {labels[code]: float(totals[code]) for code in np.flatnonzero(present)}
+
+
+def compute_metrics(cols, returns=None, current_year=None):
+    """Sales, order, customer, channel, product and monthly metrics for ``cols``.
+
+    ``returns`` defaults to the sum of the ``refunded`` column.
+    """
+    current_year = current_year or datetime.now(timezone.utc).year
+    order_count = len(cols)
+    if returns is None:
+        returns = float(cols.refunded.sum())
+
+    gross_sales = float(cols.line_items_price.sum())
+    discounts = float(cols.discounts.sum())
+    total_sales = float(cols.total_price.sum())
+
+    # Returning customer rate over orders that carry an email
+    known = cols.customer[cols.customer >= 0]
+    per_customer = np.bincount(known, minlength=len(cols.customers)) if len(known) else np.zeros(0, np.int64)
+    total_customers = int(np.count_nonzero(per_customer))
+    returning_customers = int(np.count_nonzero(per_customer > 1))
+
+    # Month-by-month totals for the current and previous year
+    month_index = cols.month.astype(np.int64) - 1
+    by_year = {}
+    for label, year in (("current_year", current_year), ("previous_year", current_year - 1)):
+        mask = cols.year == year
+        totals = np.bincount(month_index[mask], weights=cols.total_price[mask], minlength=12)
+        by_year[label] = dict(zip(MONTHS, (float(t) for t in totals)))
+
+    return {
+        "order_count": order_count,
+        "orders_fulfilled": int(cols.fulfilled.sum()),
+        "gross_sales": gross_sales,
+        "discounts": discounts,
+        "returns": returns,
+        "net_sales": gross_sales - discounts - returns,
+        "shipping": float(cols.shipping.sum()),
+        "taxes": float(cols.taxes.sum()),
+        "total_sales": total_sales,
+        "aov": total_sales / order_count if order_count > 0 else 0,
+        "total_customers": total_customers,
+        "returning_customers": returning_customers,
+        "returning_customer_rate": (returning_customers / total_customers) * 100 if total_customers else 0,
+        "sales_by_channel": _by_code(cols.channel, cols.total_price, cols.channels),
+        "sales_by_product": _by_code(cols.item_product, cols.item_amount, cols.products),
+        "sales_over_time": by_year,
+    }
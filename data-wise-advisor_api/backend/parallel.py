@@ -0,0 +1,221 @@
+"""Time-sharded rebuilds of the order snapshot and the daily rollups over a process pool.
+
+Building the order columns parses the JSON of every stored order, and
+rebuilding the rollups groups every order by day; both are CPU-bound and
+grow with the shop. For shops with at least SHOPIFY_PARALLEL_MIN_ORDERS
+orders the work is split into created_at day ranges holding about the same
+number of orders, and every range goes to a worker process:
+
+* ``build_columns``: each worker reads its range from the SQLite store and
+  builds its columns, with refunds from the payloads or the store's cache.
+  The parent merges the shards into exactly the columns a single-process
+  build produces, then looks up the refunds only Shopify knows.
+* ``rollup_rows``: each worker memory-maps the snapshot (no column data is
+  pickled) and computes the rollup rows of its days, which the parent
+  writes in one transaction.
+
+Smaller shops are built in one process, where the pool would only add
+start-up and pickling overhead.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+import refunds
+import rollups
+import snapshot
+import store
+
+WORKERS = int(os.environ.get("SHOPIFY_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+MIN_ORDERS = int(os.environ.get("SHOPIFY_PARALLEL_MIN_ORDERS", "200000"))
+PAGE_SIZE = 5000
+
+# Dictionary-coded columns and the dictionary each one indexes
+_CODED = (("channel", "channels"), ("customer", "customers"), ("item_product", "products"))
+
+_executor = None
+
+# Snapshots opened by this worker process, keyed by directory
+_opened = {}
+
+
+def executor():
+    """The shared process pool, started on first use"""
+    global _executor
+    if _executor is None:
+        # spawn rather than fork: the parent runs an event loop and thread pool
+        _executor = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def enabled(orders):
+    return WORKERS > 1 and orders >= MIN_ORDERS
+
+
+def _recode(codes, lookup):
+    """Map dictionary codes through ``lookup``, keeping -1 (no value)"""
+    if not len(lookup):
+        return codes.copy()
+    return np.where(codes >= 0, lookup[codes], -1).astype(codes.dtype)
+
+
+def _first_seen(codes, values):
+    """Renumber codes in order of first appearance, as ``metrics.Dictionary`` assigns them"""
+    unique, first = np.unique(codes[codes >= 0], return_index=True)
+    seen = unique[np.argsort(first)]
+    lookup = np.full(len(values), -1, dtype=np.int64)
+    lookup[seen] = np.arange(len(seen))
+    return _recode(codes, lookup), [values[code] for code in seen]
+
+
+def merge(parts):
+    """Concatenate shard columns into the columns one build in order id order produces.
+
+    Rows are put back in id order and dictionary codes renumbered by first
+    appearance, so the result is identical to, not just equivalent to, the
+    single-process build.
+    """
+    parts = [part for part in parts if len(part)] or parts[:1]
+    if len(parts) == 1:
+        return parts[0]
+
+    orders = {name: np.concatenate([getattr(part, name) for part in parts]) for name in parts[0].order_fields}
+    items = {name: np.concatenate([getattr(part, name) for part in parts]) for name in parts[0].item_fields}
+    offsets = np.cumsum([0] + [len(part) for part in parts[:-1]])
+    items["item_order"] = np.concatenate([part.item_order + offset for part, offset in zip(parts, offsets)])
+    dictionaries = {}
+    for field, name in _CODED:
+        merged = metrics.Dictionary()
+        columns = orders if field in orders else items
+        columns[field] = np.concatenate([
+            _recode(getattr(part, field), np.array([merged.encode(v) for v in getattr(part, name)], dtype=np.int64))
+            for part in parts
+        ])
+        dictionaries[name] = merged.values
+
+    # Back into id order; the items of an order stay together and in order
+    by_id = np.argsort(orders["order_id"], kind="stable")
+    rank = np.empty_like(by_id)
+    rank[by_id] = np.arange(len(by_id))
+    orders = {name: values[by_id] for name, values in orders.items()}
+    items["item_order"] = rank[items["item_order"]]
+    by_order = np.argsort(items["item_order"], kind="stable")
+    items = {name: values[by_order] for name, values in items.items()}
+
+    for field, name in _CODED:
+        columns = orders if field in orders else items
+        columns[field], dictionaries[name] = _first_seen(columns[field], dictionaries[name])
+    return metrics.OrderColumns(
+        orders, items, dictionaries["channels"], dictionaries["customers"], dictionaries["products"]
+    )
+
+
+def _build_shard(path, start_date, end_date, undated):
+    """Worker entry point: columns of the orders in one range, and the orders Shopify must price refunds for"""
+    store.use(path)
+    builder = metrics.OrderColumnsBuilder()
+    missing = []
+    after_id = None
+    while True:
+        batch = store.load_page("orders", start_date, end_date, after_id, PAGE_SIZE, undated=undated)
+        if not batch:
+            break
+        totals, lookups = refunds.local_totals(batch)
+        builder.extend(batch, totals)
+        missing.extend(lookups)
+        after_id = batch[-1]["id"]
+    return builder.build(), missing
+
+
+def build_columns_sharded(path, ranges, pool=None):
+    """Columns of every order in the store at ``path``, one ``store.created_ranges`` range per task.
+
+    Returns the columns and the orders whose refunds are still unknown.
+    """
+    # Orders without a creation date go with the first range
+    futures = [
+        (pool or executor()).submit(_build_shard, path, start_date, end_date, i == 0)
+        for i, (start_date, end_date) in enumerate(ranges)
+    ]
+    parts, missing = [], []
+    for future in futures:
+        cols, lookups = future.result()
+        parts.append(cols)
+        missing.extend(lookups)
+    return merge(parts), missing
+
+
+def set_refunds(cols, totals):
+    """Write refunded amounts by order id into columns sorted by order id"""
+    if totals:
+        ids = np.fromiter(totals, dtype=np.int64, count=len(totals))
+        cols.refunded[np.searchsorted(cols.order_id, ids)] = list(totals.values())
+
+
+async def build_columns(path, ranges, fetch):
+    """``build_columns_sharded`` off the event loop, with the remaining refunds fetched through ``fetch``.
+
+    Returns the columns and whether every refund lookup succeeded.
+    """
+    cols, missing = await asyncio.to_thread(build_columns_sharded, path, ranges)
+    if not missing:
+        return cols, True
+    totals = await refunds.refund_totals(missing, fetch)
+    set_refunds(cols, totals)
+    return cols, all(order["id"] in totals for order in missing)
+
+
+def day_bounds(created, shards):
+    """Inclusive epoch bounds of up to ``shards`` whole-day ranges with about equal order counts"""
+    days = created[created > 0] // 86400
+    if not len(days) or shards <= 1:
+        return [(None, None)]
+    edges = [int(day) for day in np.unique(np.quantile(days, np.linspace(0, 1, shards + 1)[1:-1]).astype(np.int64))]
+    return list(zip([None] + [day * 86400 for day in edges], [day * 86400 - 1 for day in edges] + [None]))
+
+
+def _rollup_shard(directory, lo, hi):
+    """Worker entry point: ``rollups.day_rows`` of the orders created within ``[lo, hi]``"""
+    cols = _opened.get(directory)
+    if cols is None:
+        # Only the newest snapshot is worth keeping mapped
+        _opened.clear()
+        _, cols = snapshot.open_dir(directory)
+        _opened[directory] = cols
+    mask = cols.created > 0
+    if lo is not None:
+        mask &= cols.created >= lo
+    if hi is not None:
+        mask &= cols.created <= hi
+    return rollups.day_rows(cols.select(mask))
+
+
+def rollup_rows_sharded(cols, shards=None, pool=None):
+    """``rollups.day_rows(cols)`` computed per day range; ``cols`` must come from a snapshot"""
+    futures = [
+        (pool or executor()).submit(_rollup_shard, cols.directory, lo, hi)
+        for lo, hi in day_bounds(cols.created, shards or WORKERS)
+    ]
+    merged = ([], [], [])
+    for future in futures:
+        for rows, part in zip(merged, future.result()):
+            rows.extend(part)
+    return merged
+
+
+async def rollup_rows(cols):
+    """The rollup rows of a large shop's snapshot computed over the pool, or None to compute them inline"""
+    if getattr(cols, "directory", None) and enabled(len(cols)):
+        return await asyncio.to_thread(rollup_rows_sharded, cols)
+    return None
@@ -0,0 +1,443 @@
+"""In-process index of product sales, keyed by product and variant id.
+
+The index is loaded once from ``rollup_daily_product`` and then kept
+current from the rollups' product change log (see ``rollups.product_changes``),
+so a query only pays for the order changes made since the previous one.
+
+- all-time top-N by revenue or quantity, per variant or per product, comes
+  from heaps of the running totals with lazy deletion of stale entries
+- top-N over a date range sums the day-sorted rows between two binary
+  searches, and is remembered until the next change
+- search matches a name prefix, or every word of the query in a title (the
+  last word as a prefix), ranked by revenue
+- per-product series read the product's rows through a per-SKU ordering
+
+Line items without a product id (custom items) are keyed by their name.
+"""
+import heapq
+import re
+import threading
+from bisect import bisect_left, insort
+from datetime import date, timedelta
+
+import numpy as np
+
+METRICS = ("amount", "quantity")
+LEVELS = ("variant", "product")
+BUCKETS = ("day", "week", "month")
+
+# Change rows buffered before they are merged into the day-sorted arrays
+MERGE_ROWS = 16384
+# New SKUs inserted into the search lists one by one; past this they are rebuilt
+SEARCH_INSERTS = 256
+# Date-range rankings remembered until the next change
+RANGE_CACHE_SIZE = 256
+
+EPOCH = date(1970, 1, 1)
+_WORDS = re.compile(r"\w+")
+
+
+def _title(name):
+    """``Shirt | Blue`` -> ``Shirt``"""
+    return name.rsplit(" | ", 1)[0]
+
+
+class _TopHeap:
+    """Max-heap of (value, id) with lazy deletion.
+
+    Every change pushes a new entry; entries whose value no longer matches
+    the id's current total are dropped when they surface.
+    """
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def rebuild(self, values):
+        self._heap = [(-value, i) for i, value in enumerate(values) if value > 0]
+        heapq.heapify(self._heap)
+
+    def push(self, i, value):
+        if value > 0:
+            heapq.heappush(self._heap, (-value, i))
+
+    def top(self, n, values):
+        found, kept, seen = [], [], set()
+        while self._heap and len(found) < n:
+            entry = heapq.heappop(self._heap)
+            i = entry[1]
+            if i in seen or values[i] != -entry[0]:
+                continue
+            seen.add(i)
+            found.append(i)
+            kept.append(entry)
+        for entry in kept:
+            heapq.heappush(self._heap, entry)
+        return found
+
+
+class ProductSalesIndex:
+    """Daily product sales of one store; ``generation`` is the rollup generation it reflects.
+
+    Callers load or apply changes while holding ``lock``; queries take it themselves.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = None
+        self._reset()
+
+    def _reset(self):
+        self._keys = {}
+        self.product_ids = []
+        self.variant_ids = []
+        self.names = []
+        self._sku_product = []
+        self._products = {}
+        self._product_skus = []
+        self._product_titles = []
+        self._sku_product_array = np.zeros(0, dtype=np.int64)
+        self._totals = {(level, metric): [] for level in LEVELS for metric in METRICS}
+        self._heaps = {key: _TopHeap() for key in self._totals}
+
+        # Rows (day, sku, quantity, amount) sorted by day then SKU, plus the
+        # unmerged change rows in arrival order
+        self._rows = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)]
+        self._tail = [array.copy() for array in self._rows]
+        self._by_sku = None
+        self._sku_offsets = None
+
+        self._sorted_names = []
+        self._tokens = {}
+        self._sorted_tokens = []
+        self._search_pending = None
+        self._ranges = {}
+
+    # ---- maintenance ----
+
+    def _sku(self, product_id, variant_id, name):
+        key = (product_id, variant_id) if product_id else (0, name)
+        sku = self._keys.get(key)
+        if sku is not None:
+            if self.names[sku] != name:
+                # Renamed since: search lists are rebuilt on next use
+                self.names[sku] = name
+                self._search_pending = None
+            return sku
+
+        sku = self._keys[key] = len(self.names)
+        self.product_ids.append(product_id)
+        self.variant_ids.append(variant_id)
+        self.names.append(name)
+        product_key = product_id or name
+        product = self._products.get(product_key)
+        if product is None:
+            product = self._products[product_key] = len(self._product_skus)
+            self._product_skus.append([])
+            self._product_titles.append(_title(name))
+            for metric in METRICS:
+                self._totals["product", metric].append(0.0)
+        self._product_skus[product].append(sku)
+        self._sku_product.append(product)
+        for metric in METRICS:
+            self._totals["variant", metric].append(0.0)
+        if self._search_pending is not None:
+            self._search_pending.append(sku)
+        return sku
+
+    def _columns(self, rows):
+        count = len(rows)
+        return [
+            np.fromiter((row[0] for row in rows), np.int64, count),
+            np.fromiter((self._sku(row[1], row[2], row[3]) for row in rows), np.int64, count),
+            np.fromiter((row[4] for row in rows), np.float64, count),
+            np.fromiter((row[5] for row in rows), np.float64, count),
+        ]
+
+    def load(self, rows):
+        """Replace the index with rollup rows (day, product_id, variant_id, name, quantity, amount)"""
+        self._reset()
+        self._tail = self._columns(rows)
+        self._merge()
+        sku_count = len(self.names)
+        day, sku, quantity, amount = self._rows
+        for metric, weights in (("quantity", quantity), ("amount", amount)):
+            totals = np.bincount(sku, weights=weights, minlength=sku_count)
+            self._totals["variant", metric] = totals.tolist()
+            self._totals["product", metric] = np.bincount(
+                self._sku_products(), weights=totals, minlength=len(self._product_skus)
+            ).tolist()
+        for key, heap in self._heaps.items():
+            heap.rebuild(self._totals[key])
+
+    def apply(self, rows):
+        """Add change rows from the rollup log, in the same shape as ``load``"""
+        if not rows:
+            return
+        columns = self._columns(rows)
+        self._ranges.clear()
+        self._tail = [np.concatenate([old, new]) for old, new in zip(self._tail, columns)]
+
+        skus, inverse = np.unique(columns[1], return_inverse=True)
+        products = self._sku_products()[skus]
+        for metric, weights in (("quantity", columns[2]), ("amount", columns[3])):
+            deltas = np.bincount(inverse, weights=weights, minlength=len(skus))
+            self._add("variant", metric, skus.tolist(), deltas.tolist())
+            product_ids, product_inverse = np.unique(products, return_inverse=True)
+            self._add("product", metric, product_ids.tolist(),
+                      np.bincount(product_inverse, weights=deltas, minlength=len(product_ids)).tolist())
+
+        if len(self._tail[0]) >= MERGE_ROWS:
+            self._merge()
+
+    def _add(self, level, metric, ids, deltas):
+        totals = self._totals[level, metric]
+        heap = self._heaps[level, metric]
+        for i, delta in zip(ids, deltas):
+            totals[i] += delta
+            heap.push(i, totals[i])
+        if len(heap) > 2 * len(totals) + 1024:
+            heap.rebuild(totals)
+
+    def _sku_products(self):
+        if len(self._sku_product_array) != len(self._sku_product):
+            self._sku_product_array = np.array(self._sku_product, dtype=np.int64)
+        return self._sku_product_array
+
+    def _merge(self):
+        """Fold the change rows into the day-sorted rows, dropping (day, SKU) rows that cancelled out.
+
+        Only the change rows are sorted; they are added to or inserted among
+        the rows, and the per-SKU ordering is rebuilt when next needed.
+        """
+        sku_count = max(len(self.names), 1)
+        day, sku, quantity, amount = self._rows
+        keys = day * sku_count + sku
+        tail_day, tail_sku, tail_quantity, tail_amount = self._tail
+        changed, inverse = np.unique(tail_day * sku_count + tail_sku, return_inverse=True)
+        changed_quantity = np.bincount(inverse, weights=tail_quantity, minlength=len(changed))
+        changed_amount = np.bincount(inverse, weights=tail_amount, minlength=len(changed))
+
+        at = np.searchsorted(keys, changed)
+        present = at < len(keys)
+        present[present] = keys[at[present]] == changed[present]
+        quantity[at[present]] += changed_quantity[present]
+        amount[at[present]] += changed_amount[present]
+        new = ~present
+        keys = np.insert(keys, at[new], changed[new])
+        quantity = np.insert(quantity, at[new], changed_quantity[new])
+        amount = np.insert(amount, at[new], changed_amount[new])
+
+        # Same rule as the rollups' cleanup
+        keep = (quantity > 0) | (np.abs(amount) >= 1e-6)
+        if not keep.all():
+            keys, quantity, amount = keys[keep], quantity[keep], amount[keep]
+        self._rows = [keys // sku_count, keys % sku_count, quantity, amount]
+        self._tail = [column[:0] for column in self._rows]
+        self._by_sku = None
+
+    def _sku_order(self):
+        """Row positions ordered by SKU then day, and where each SKU's positions start"""
+        if self._by_sku is None:
+            self._by_sku = np.argsort(self._rows[1], kind="stable")
+            self._sku_offsets = np.searchsorted(self._rows[1][self._by_sku], np.arange(len(self.names) + 1))
+        return self._by_sku, self._sku_offsets
+
+    # ---- queries ----
+
+    def _entry(self, level, i, quantity, amount):
+        if level == "product":
+            skus = self._product_skus[i]
+            return {
+                "product_id": self.product_ids[skus[0]],
+                "title": self._product_titles[i],
+                "variants": len(skus),
+                "quantity": int(round(quantity)),
+                "amount": round(amount, 2),
+            }
+        return {
+            "product_id": self.product_ids[i],
+            "variant_id": self.variant_ids[i],
+            "name": self.names[i],
+            "quantity": int(round(quantity)),
+            "amount": round(amount, 2),
+        }
+
+    def _range_rows(self, first, last):
+        """(sku, quantity, amount) of the rows with ``first <= day <= last``"""
+        day, sku, quantity, amount = self._rows
+        lo, hi = np.searchsorted(day, [first, last + 1])
+        parts = [(sku[lo:hi], quantity[lo:hi], amount[lo:hi])]
+        if len(self._tail[0]):
+            tail_day, tail_sku, tail_quantity, tail_amount = self._tail
+            mask = (tail_day >= first) & (tail_day <= last)
+            parts.append((tail_sku[mask], tail_quantity[mask], tail_amount[mask]))
+        return [np.concatenate(column) if len(parts) > 1 else column[0] for column in zip(*parts)]
+
+    @staticmethod
+    def _sum_by(ids, *weights, size=None):
+        """Unique ids with the per-id sum of each weight array.
+
+        With ``size`` every id below it is returned, which skips the sort
+        when most of them occur anyway.
+        """
+        if size is not None:
+            return np.arange(size), [np.bincount(ids, weights=w, minlength=size) for w in weights]
+        unique, inverse = np.unique(ids, return_inverse=True)
+        return unique, [np.bincount(inverse, weights=w, minlength=len(unique)) for w in weights]
+
+    def top(self, n=10, by="amount", level="variant", first=None, last=None):
+        """The ``n`` best sellers by ``by``, all time or over the inclusive day range ``[first, last]``"""
+        with self.lock:
+            if first is None and last is None:
+                ranked = self._heaps[level, by].top(n, self._totals[level, by])
+                return [
+                    self._entry(level, i, self._totals[level, "quantity"][i], self._totals[level, "amount"][i])
+                    for i in ranked
+                ]
+
+            key = (n, by, level, first, last)
+            if key in self._ranges:
+                return [dict(entry) for entry in self._ranges[key]]
+            first = -(2 ** 40) if first is None else first
+            last = 2 ** 40 if last is None else last
+            sku, quantity, amount = self._range_rows(first, last)
+            dense = len(sku) * 8 > len(self.names)
+            ids, (quantity, amount) = self._sum_by(sku, quantity, amount, size=len(self.names) if dense else None)
+            if level == "product":
+                ids, (quantity, amount) = self._sum_by(self._sku_products()[ids], quantity, amount,
+                                                       size=len(self._product_skus) if dense else None)
+            values = amount if by == "amount" else quantity
+            positive = np.flatnonzero(values > 0)
+            if len(positive) > n:
+                positive = positive[np.argpartition(-values[positive], n - 1)[:n]]
+            ranked = positive[np.lexsort((ids[positive], -values[positive]))]
+            entries = [self._entry(level, int(ids[i]), float(quantity[i]), float(amount[i])) for i in ranked]
+            if len(self._ranges) >= RANGE_CACHE_SIZE:
+                self._ranges.clear()
+            self._ranges[key] = entries
+            return [dict(entry) for entry in entries]
+
+    def units_by_variant(self, first=None, last=None):
+        """Variant id -> units sold, all time or over the inclusive day range ``[first, last]``"""
+        with self.lock:
+            if first is None and last is None:
+                quantity = self._totals["variant", "quantity"]
+            else:
+                sku, sold, _ = self._range_rows(-(2 ** 40) if first is None else first,
+                                                2 ** 40 if last is None else last)
+                quantity = np.bincount(sku, weights=sold, minlength=len(self.names)).tolist()
+            units = {}
+            for variant_id, sold in zip(self.variant_ids, quantity):
+                if variant_id and sold:
+                    units[variant_id] = units.get(variant_id, 0) + int(round(sold))
+            return units
+
+    def _build_search(self):
+        if self._search_pending is None or len(self._search_pending) > SEARCH_INSERTS:
+            self._sorted_names = sorted((name.lower(), sku) for sku, name in enumerate(self.names))
+            self._tokens = {}
+            for sku, name in enumerate(self.names):
+                for token in _WORDS.findall(name.lower()):
+                    self._tokens.setdefault(token, set()).add(sku)
+            self._sorted_tokens = sorted(self._tokens)
+        else:
+            for sku in self._search_pending:
+                name = self.names[sku].lower()
+                insort(self._sorted_names, (name, sku))
+                for token in _WORDS.findall(name):
+                    if token not in self._tokens:
+                        self._tokens[token] = set()
+                        insort(self._sorted_tokens, token)
+                    self._tokens[token].add(sku)
+        self._search_pending = []
+
+    def _prefixed(self, items, prefix):
+        """Index range of the sorted ``items`` starting with ``prefix``"""
+        start = bisect_left(items, prefix)
+        stop = bisect_left(items, prefix + "\U0010ffff", start)
+        return start, stop
+
+    def search(self, query, limit=20):
+        """Variants whose name starts with ``query`` or whose title contains its words, best sellers first"""
+        query = query.strip().lower()
+        if not query:
+            return []
+        with self.lock:
+            self._build_search()
+            start = bisect_left(self._sorted_names, (query,))
+            stop = bisect_left(self._sorted_names, (query + "\U0010ffff",), start)
+            matches = {sku for _, sku in self._sorted_names[start:stop]}
+
+            words = _WORDS.findall(query)
+            if words:
+                *whole, last = words
+                # Narrow down with the complete words first, smallest posting set first
+                candidates = None
+                for word in sorted(whole, key=lambda word: len(self._tokens.get(word, ()))):
+                    postings = self._tokens.get(word, set())
+                    candidates = postings if candidates is None else candidates & postings
+                    if not candidates:
+                        break
+                if candidates is None or candidates:
+                    start, stop = self._prefixed(self._sorted_tokens, last)
+                    for token in self._sorted_tokens[start:stop]:
+                        postings = self._tokens[token]
+                        matches |= postings if candidates is None else postings & candidates
+
+            amounts = self._totals["variant", "amount"]
+            quantities = self._totals["variant", "quantity"]
+            ranked = heapq.nlargest(limit, matches, key=lambda sku: (amounts[sku], -sku))
+            return [self._entry("variant", sku, quantities[sku], amounts[sku]) for sku in ranked]
+
+    def series(self, product_id, variant_id=None, first=None, last=None, bucket="day"):
+        """Sales of a product (or one variant) per day, week or month; None for an unknown product"""
+        with self.lock:
+            if variant_id is not None:
+                sku = self._keys.get((product_id, variant_id))
+                if sku is None:
+                    return None
+                skus = [sku]
+            else:
+                product = self._products.get(product_id) if product_id else None
+                if product is None:
+                    return None
+                skus = self._product_skus[product]
+
+            first = -(2 ** 40) if first is None else first
+            last = 2 ** 40 if last is None else last
+            day, _, quantity, amount = self._rows
+            by_sku, offsets = self._sku_order()
+            parts = []
+            for sku in skus:
+                if sku + 1 >= len(offsets):
+                    continue
+                rows = by_sku[offsets[sku]:offsets[sku + 1]]
+                lo, hi = np.searchsorted(day[rows], [first, last + 1])
+                rows = rows[lo:hi]
+                parts.append((day[rows], quantity[rows], amount[rows]))
+            tail_day, tail_sku, tail_quantity, tail_amount = self._tail
+            if len(tail_day):
+                mask = np.isin(tail_sku, skus) & (tail_day >= first) & (tail_day <= last)
+                parts.append((tail_day[mask], tail_quantity[mask], tail_amount[mask]))
+            if not parts:
+                return []
+            days, quantity, amount = (np.concatenate(column) for column in zip(*parts))
+
+        if bucket == "week":
+            # Weeks start on Monday; day 0 was a Thursday
+            days = days - (days + 3) % 7
+        elif bucket == "month":
+            days = days.astype("datetime64[D]").astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+        buckets, (quantity, amount) = self._sum_by(days, quantity, amount)
+        return [
+            {
+                "date": (EPOCH + timedelta(days=int(day))).isoformat()[:7 if bucket == "month" else 10],
+                "quantity": int(round(q)),
+                "amount": round(float(a), 2),
+            }
+            for day, q, a in zip(buckets, quantity, amount)
+            if round(q) or abs(a) >= 0.005
+        ]
@@ -0,0 +1,209 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+# Lower numbers are served first
+INTERACTIVE = 0
+PAGINATION = 1
+
+
+class LeakyBucketScheduler:
+    """Paces Shopify calls against the shop's leaky bucket.
+
+    Bucket fill is estimated from ``X-Shopify-Shop-Api-Call-Limit`` and
+    leaks at ``leak_rate`` calls per second. Callers wait in a priority queue
+    until the bucket has room, so requests are spaced out ahead of time rather
+    than after a 429. ``Retry-After`` blocks the whole bucket until it expires.
+    """
+
+    def __init__(self, capacity=40, leak_rate=2.0, headroom=2):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.headroom = headroom
+        self._fill = 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def _leak(self):
+        now = time.monotonic()
+        self._fill = max(0.0, self._fill - (now - self._updated) * self.leak_rate)
+        self._updated = now
+        return now
+
+    def _delay(self):
+        """Seconds until one more call fits in the bucket"""
+        now = self._leak()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        overflow = self._fill + 1 - (self.capacity - self.headroom)
+        return overflow / self.leak_rate if overflow > 0 else 0.0
+
+    async def acquire(self, priority=INTERACTIVE):
+        """Wait for a slot in the bucket, serving higher priority callers first"""
+        entry = (priority, next(self._seq))
+        started = time.monotonic()
+        async with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    delay = self._delay() if self._waiting[0] == entry else None
+                    if delay is not None and delay <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            # Reserve the slot until the response header tells us the real fill
+            self._fill += 1
+
+        waited = time.monotonic() - started
+        self.stats["requests"] += 1
+        self.stats["wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    async def observe(self, response):
+        """Update bucket state from a Shopify response"""
+        async with self._cond:
+            self._leak()
+            limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+            if limit:
+                try:
+                    used, capacity = (int(part) for part in limit.split("/"))
+                    self._fill = float(used)
+                    self.capacity = capacity
+                except ValueError:
+                    logging.warning(f"Unparseable Shopify call limit header: {limit}")
+
+            if response.status_code == 429:
+                self.stats["throttled"] += 1
+                self._fill = float(self.capacity)
+                retry_after = retry_after_seconds(response)
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """Counters plus the current estimated bucket fill"""
+        self._leak()
+        return {
+            **self.stats,
+            "bucket_fill": round(self._fill, 2),
+            "bucket_capacity": self.capacity,
+            "queued": len(self._waiting),
+        }
+
+
+class FairShare:
+    """Process-wide cap on in-flight Shopify calls, shared fairly between shops.
+
+    When all ``slots`` are busy, waiting shops are served round-robin one
+    call at a time, so a shop with thousands of queued sync pages cannot
+    hold back a small shop's next request by more than one turn.
+    """
+
+    def __init__(self, slots=64):
+        self.slots = slots
+        self._active = 0
+        self._queues = OrderedDict()
+        self.stats = {"acquired": 0, "queued": 0, "wait_seconds": 0.0}
+
+    async def acquire(self, key):
+        self.stats["acquired"] += 1
+        if self._active < self.slots and not self._queues:
+            self._active += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        self.stats["queued"] += 1
+        started = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled
+                self.release()
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[key]
+            raise
+        finally:
+            self.stats["wait_seconds"] += time.monotonic() - started
+
+    def release(self):
+        """Hand the slot to the next shop in turn, or free it"""
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, key):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "slots": self.slots,
+            "active": self._active,
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "waiting_shops": len(self._queues),
+        }
+
+
+def retry_after_seconds(response):
+    """Parse a numeric Retry-After header, if present"""
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def throttle_delay(body):
+    """Seconds until a THROTTLED GraphQL query's cost is back in the bucket, from ``extensions.cost``"""
+    cost = (body.get("extensions") or {}).get("cost") or {}
+    status = cost.get("throttleStatus") or {}
+    try:
+        missing = float(cost["requestedQueryCost"]) - float(status["currentlyAvailable"])
+        return max(0.0, missing) / float(status["restoreRate"])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Full-jitter exponential backoff for the given retry attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+
+import store
+from metrics import refund_amount
+
+REFUND_WORKERS = int(os.environ.get("SHOPIFY_REFUND_WORKERS", "4"))
+
+
+def local_totals(orders):
+    """Refunded amounts known without asking Shopify, and the orders that need a lookup.
+
+    Totals are taken from the store's cache or the embedded ``refunds``
+    array; the embedded ones are cached for next time.
+    """
+    totals = store.get_refund_totals(orders)
+    cached = set(totals)
+
+    computed = []
+    missing = []
+    for order in orders:
+        order_id = order.get("id")
+        if not order_id or order_id in cached:
+            continue
+        if isinstance(order.get("refunds"), list):
+            amount = refund_amount(order["refunds"])
+            computed.append((order_id, order.get("updated_at"), amount))
+            totals[order_id] = amount
+        else:
+            missing.append(order)
+    store.set_refund_totals(computed)
+    return totals, missing
+
+
+async def refund_totals(orders, fetch, max_workers=None):
+    """Refunded amount per order id.
+
+    Refunds embedded in the order payload are used directly. Orders without
+    an embedded ``refunds`` array are looked up concurrently, with at most
+    ``max_workers`` lookups in flight. Per-order totals are cached in the
+    local store and reused until the order's ``updated_at`` changes.
+    """
+    totals, missing = await asyncio.to_thread(local_totals, orders)
+
+    computed = []
+    if missing:
+        semaphore = asyncio.Semaphore(max_workers or REFUND_WORKERS)
+
+        async def lookup(order):
+            async with semaphore:
+                try:
+                    return order, refund_amount(await fetch(f"orders/{order['id']}/refunds"))
+                except Exception as e:
+                    # Not cached, so the lookup is retried on the next request
+                    logging.warning(f"Refunds fetch failed for order {order['id']}: {e}")
+                    return order, None
+
+        for order, amount in await asyncio.gather(*(lookup(order) for order in missing)):
+            if amount is None:
+                continue
+            computed.append((order["id"], order.get("updated_at"), amount))
+            totals[order["id"]] = amount
+
+    await asyncio.to_thread(store.set_refund_totals, computed)
+    return totals
@@ -0,0 +1,448 @@
+"""Materialized daily rollups of order metrics.
+
+Orders are rolled up per UTC day and channel, per day and product/variant,
+and per day and customer. The store applies the delta of every order
+upsert (old contribution out, new contribution in) in the same transaction,
+so rollups stay current without recomputation. Range totals for arbitrary
+``start_date``/``end_date`` windows come from cached prefix sums over days.
+Customer cohorts (``cohorts``) are maintained in the same transactions.
+
+Product deltas are also appended to ``rollup_product_log`` stamped with the
+generation they produce, so the in-process product sales index
+(``product_sales``) catches up on changes instead of reloading.
+"""
+import threading
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+import cohorts
+import metrics
+
+# Stored as the 'built' marker; bumping it makes existing stores rebuild
+# (3: cohort months are UTC months, 4: cohort sales are integer cents)
+FORMAT = 4
+
+# Generations of product changes kept in the log; an index further behind reloads
+PRODUCT_LOG_GENERATIONS = 1000
+
+SCHEMA = cohorts.SCHEMA + """
+CREATE TABLE IF NOT EXISTS rollup_daily (
+    day INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    fulfilled INTEGER NOT NULL DEFAULT 0,
+    gross_sales REAL NOT NULL DEFAULT 0,
+    discounts REAL NOT NULL DEFAULT 0,
+    returns REAL NOT NULL DEFAULT 0,
+    shipping REAL NOT NULL DEFAULT 0,
+    taxes REAL NOT NULL DEFAULT 0,
+    total_sales REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, channel)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_daily_product (
+    day INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    variant_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    amount REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id, variant_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_product_log (
+    generation INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    variant_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    amount REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS rollup_product_log_generation ON rollup_product_log (generation);
+
+CREATE TABLE IF NOT EXISTS rollup_daily_customer (
+    day INTEGER NOT NULL,
+    customer TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    total_sales REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, customer)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_refunds (
+    order_id INTEGER PRIMARY KEY,
+    day INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    amount REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS rollup_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+SALES_FIELDS = ("orders", "fulfilled", "gross_sales", "discounts", "returns", "shipping", "taxes", "total_sales")
+MONEY_FIELDS = SALES_FIELDS[2:]
+
+_UPSERT_SALES = (
+    f"INSERT INTO rollup_daily (day, channel, {', '.join(SALES_FIELDS)}) "
+    f"VALUES (?, ?, {', '.join('?' * len(SALES_FIELDS))}) ON CONFLICT (day, channel) DO UPDATE SET "
+    + ", ".join(f"{f} = {f} + excluded.{f}" for f in SALES_FIELDS)
+)
+_UPSERT_PRODUCT = (
+    "INSERT INTO rollup_daily_product (day, product_id, variant_id, name, quantity, amount) "
+    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (day, product_id, variant_id, name) DO UPDATE SET "
+    "quantity = quantity + excluded.quantity, amount = amount + excluded.amount"
+)
+_LOG_PRODUCT = (
+    "INSERT INTO rollup_product_log (generation, day, product_id, variant_id, name, quantity, amount) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+_UPSERT_CUSTOMER = (
+    "INSERT INTO rollup_daily_customer (day, customer, orders, total_sales) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (day, customer) DO UPDATE SET "
+    "orders = orders + excluded.orders, total_sales = total_sales + excluded.total_sales"
+)
+
+_prefix_lock = threading.Lock()
+_prefix_cache = {}
+
+
+def day_number(value):
+    """Days since the Unix epoch for a YYYY-MM-DD string or a date"""
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return (value - date(1970, 1, 1)).days
+
+
+def _group(keys, *weights):
+    """Unique keys with the per-key sum of each weight array"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, [np.bincount(inverse, weights=w, minlength=len(unique)) for w in weights]
+
+
+def day_rows(cols, sign=1):
+    """The (sales, product, customer) upsert rows adding (sign=1) or removing (sign=-1) ``cols``.
+
+    Rows are keyed by day, so rows computed for orders of disjoint days can
+    be written one after another.
+    """
+    if not len(cols):
+        return [], [], []
+    dated = cols.created > 0
+    day = cols.created // 86400
+
+    # Per day and channel
+    keys = day[dated] * len(cols.channels) + cols.channel[dated]
+    weights = [
+        np.ones(int(dated.sum())),
+        cols.fulfilled[dated].astype(np.float64),
+        cols.line_items_price[dated],
+        cols.discounts[dated],
+        cols.shipping[dated],
+        cols.taxes[dated],
+        cols.total_price[dated],
+    ]
+    unique, sums = _group(keys, *weights)
+    # Plain Python values (tolist) are cheaper to build, pickle and bind than NumPy scalars
+    counts = [(sign * s).astype(np.int64).tolist() for s in sums[:2]]
+    amounts = [(sign * s).tolist() for s in sums[2:]]
+    sales = [
+        (day, cols.channels[channel], orders, fulfilled, gross, discounts, 0.0, shipping, taxes, total)
+        for day, channel, orders, fulfilled, gross, discounts, shipping, taxes, total in zip(
+            (unique // len(cols.channels)).tolist(), (unique % len(cols.channels)).tolist(), *counts, *amounts
+        )
+    ]
+
+    # Per day and product/variant
+    products = []
+    if len(cols.item_order):
+        item_day = day[cols.item_order]
+        item_dated = dated[cols.item_order]
+        keys = item_day[item_dated] * len(cols.products) + cols.item_product[item_dated]
+        # Product and variant ids of a name are taken from its first line item
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        quantity = np.bincount(inverse, weights=cols.item_quantity[item_dated], minlength=len(unique))
+        amount = np.bincount(inverse, weights=cols.item_amount[item_dated], minlength=len(unique))
+        product_ids = cols.item_product_id[item_dated][first]
+        variant_ids = cols.item_variant_id[item_dated][first]
+        products = [
+            (day, product_id, variant_id, cols.products[product], units, total)
+            for day, product, product_id, variant_id, units, total in zip(
+                (unique // len(cols.products)).tolist(), (unique % len(cols.products)).tolist(),
+                product_ids.tolist(), variant_ids.tolist(),
+                (sign * quantity).astype(np.int64).tolist(), (sign * amount).tolist(),
+            )
+        ]
+
+    # Per day and customer (keyed on email, like the returning customer rate)
+    customers = []
+    known = dated & (cols.customer >= 0)
+    if known.any():
+        keys = day[known] * len(cols.customers) + cols.customer[known]
+        unique, sums = _group(keys, np.ones(int(known.sum())), cols.total_price[known])
+        customers = [
+            (day, cols.customers[customer], orders, total)
+            for day, customer, orders, total in zip(
+                (unique // len(cols.customers)).tolist(), (unique % len(cols.customers)).tolist(),
+                (sign * sums[0]).astype(np.int64).tolist(), (sign * sums[1]).tolist(),
+            )
+        ]
+    return sales, products, customers
+
+
+def _write(conn, cols, sign, log=False, precomputed=None):
+    """Add (sign=1) or remove (sign=-1) the contribution of ``cols``.
+
+    ``precomputed`` are the ``day_rows(cols, sign)`` if the caller already has
+    them. With ``log`` the product deltas are also appended to the product
+    change log.
+    """
+    sales, products, customers = precomputed or day_rows(cols, sign)
+    conn.executemany(_UPSERT_SALES, sales)
+    conn.executemany(_UPSERT_PRODUCT, products)
+    if log and products:
+        # Stamped with the generation the coming _bump produces
+        stamp = generation(conn) + 1
+        conn.executemany(_LOG_PRODUCT, [(stamp, *row) for row in products])
+    conn.executemany(_UPSERT_CUSTOMER, customers)
+
+
+def _move_refunds(conn, rows):
+    """Point each order's refund contribution at its (day, channel, amount).
+
+    ``rows`` are (order_id, day, channel, amount) tuples; ``None`` for any of
+    day/channel/amount keeps the value already recorded for the order.
+    """
+    deltas = []
+    updates = []
+    for order_id, day, channel, amount in rows:
+        old = conn.execute(
+            "SELECT day, channel, amount FROM rollup_refunds WHERE order_id = ?", (order_id,)
+        ).fetchone()
+        if old is None and (day is None or channel is None):
+            continue
+        if old is not None:
+            day = old[0] if day is None else day
+            channel = old[1] if channel is None else channel
+            amount = old[2] if amount is None else amount
+            if (old[0], old[1], old[2]) == (day, channel, amount):
+                continue
+            if old[2]:
+                deltas.append((old[0], old[1], -old[2]))
+        amount = amount or 0.0
+        if amount:
+            deltas.append((day, channel, amount))
+        updates.append((order_id, day, channel, amount))
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO rollup_refunds (order_id, day, channel, amount) VALUES (?, ?, ?, ?)", updates
+    )
+    conn.executemany(_UPSERT_SALES, [
+        (day, channel, 0, 0, 0.0, 0.0, amount, 0.0, 0.0, 0.0) for day, channel, amount in deltas
+    ])
+
+
+def _cleanup(conn):
+    conn.execute("DELETE FROM rollup_daily WHERE orders <= 0 AND ABS(returns) < 1e-6")
+    conn.execute("DELETE FROM rollup_daily_product WHERE quantity <= 0 AND ABS(amount) < 1e-6")
+    conn.execute("DELETE FROM rollup_daily_customer WHERE orders <= 0")
+
+
+def _bump(conn):
+    conn.execute(
+        "INSERT INTO rollup_meta (key, value) VALUES ('generation', 1) "
+        "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+    )
+
+
+def is_built(conn):
+    row = conn.execute("SELECT value FROM rollup_meta WHERE key = 'built'").fetchone()
+    return bool(row and row[0] == FORMAT)
+
+
+def generation(conn):
+    row = conn.execute("SELECT value FROM rollup_meta WHERE key = 'generation'").fetchone()
+    return row[0] if row else 0
+
+
+def apply_orders(conn, old_orders, new_orders):
+    """Replace the contribution of ``old_orders`` with that of ``new_orders``"""
+    if not is_built(conn):
+        # The next rebuild from the full store will include these orders
+        return
+    old = metrics.build_columns(old_orders or [])
+    if old_orders:
+        _write(conn, old, -1, log=True)
+    cols = metrics.build_columns(new_orders)
+    _write(conn, cols, 1, log=True)
+    cohorts.apply(conn, [(old, -1), (cols, 1)])
+
+    refunds = []
+    for i, order in enumerate(new_orders):
+        if not cols.created[i]:
+            continue
+        embedded = order.get("refunds")
+        amount = metrics.refund_amount(embedded) if isinstance(embedded, list) else None
+        refunds.append((order["id"], int(cols.created[i] // 86400), cols.channels[cols.channel[i]], amount))
+    _move_refunds(conn, refunds)
+    _cleanup(conn)
+    _bump(conn)
+    conn.execute("DELETE FROM rollup_product_log WHERE generation <= ?",
+                 (generation(conn) - PRODUCT_LOG_GENERATIONS,))
+
+
+def apply_refunds(conn, totals):
+    """Record refund totals looked up outside the order payload, as (order_id, amount)"""
+    if not is_built(conn):
+        return
+    _move_refunds(conn, [(order_id, None, None, amount) for order_id, amount in totals])
+    _cleanup(conn)
+    _bump(conn)
+
+
+def clear(conn, built=False):
+    for table in ("rollup_daily", "rollup_daily_product", "rollup_daily_customer", "rollup_refunds",
+                  "rollup_product_log"):
+        conn.execute(f"DELETE FROM {table}")
+    cohorts.clear(conn)
+    conn.execute("INSERT OR REPLACE INTO rollup_meta (key, value) VALUES ('built', ?)", (FORMAT if built else 0,))
+    _bump(conn)
+    # Indexes loaded before this generation can't catch up from the log
+    conn.execute("INSERT OR REPLACE INTO rollup_meta (key, value) VALUES ('product_log_start', ?)",
+                 (generation(conn),))
+
+
+def rebuild(conn, cols, precomputed=None):
+    """Recompute every rollup from the columnar view of all stored orders.
+
+    ``precomputed`` are ``day_rows(cols)``, e.g. merged from time shards.
+    """
+    clear(conn, built=True)
+    _write(conn, cols, 1, precomputed=precomputed)
+    cohorts.rebuild(conn, cols)
+    dated = np.flatnonzero(cols.created > 0)
+    _move_refunds(conn, [
+        (int(cols.order_id[i]), int(cols.created[i] // 86400), cols.channels[cols.channel[i]],
+         float(cols.refunded[i]))
+        for i in dated if cols.refunded[i]
+    ])
+
+
+def product_rows(conn):
+    """Every (day, product_id, variant_id, name, quantity, amount) row, oldest day first"""
+    return conn.execute(
+        "SELECT day, product_id, variant_id, name, quantity, amount FROM rollup_daily_product ORDER BY day"
+    ).fetchall()
+
+
+def product_changes(conn, since, until):
+    """Product delta rows of the generations after ``since`` up to ``until``.
+
+    Returns None when the log no longer covers them and the caller must
+    reload from ``product_rows``.
+    """
+    row = conn.execute("SELECT value FROM rollup_meta WHERE key = 'product_log_start'").fetchone()
+    if since < (row[0] if row else 0) or since < until - PRODUCT_LOG_GENERATIONS:
+        return None
+    return conn.execute(
+        "SELECT day, product_id, variant_id, name, quantity, amount FROM rollup_product_log "
+        "WHERE generation > ? AND generation <= ?",
+        (since, until),
+    ).fetchall()
+
+
+def _prefix_sums(conn, key):
+    """Per-channel prefix sums over a contiguous day axis, cached per generation"""
+    current = generation(conn)
+    with _prefix_lock:
+        cached = _prefix_cache.get(key)
+        if cached and cached["generation"] == current:
+            return cached
+
+    rows = conn.execute(f"SELECT day, channel, {', '.join(SALES_FIELDS)} FROM rollup_daily").fetchall()
+    channels = sorted({row[1] for row in rows})
+    first_day = min((row[0] for row in rows), default=0)
+    last_day = max((row[0] for row in rows), default=-1)
+    values = np.zeros((last_day - first_day + 1, len(channels), len(SALES_FIELDS)))
+    index = {channel: i for i, channel in enumerate(channels)}
+    for row in rows:
+        values[row[0] - first_day, index[row[1]]] = row[2:]
+    prefix = np.concatenate([np.zeros((1, len(channels), len(SALES_FIELDS))), values.cumsum(axis=0)])
+
+    cached = {"generation": current, "first_day": first_day, "channels": channels, "prefix": prefix}
+    with _prefix_lock:
+        _prefix_cache[key] = cached
+    return cached
+
+
+def range_totals(sums, first, last):
+    """Per-channel sums for the inclusive day range ``[first, last]`` in O(1)"""
+    prefix = sums["prefix"]
+    days = len(prefix) - 1
+    start = min(max(first - sums["first_day"], 0), days)
+    stop = min(max(last - sums["first_day"] + 1, 0), days)
+    if stop <= start:
+        return np.zeros(prefix.shape[1:])
+    return prefix[stop] - prefix[start]
+
+
+def summary(conn, start_date=None, end_date=None, current_year=None, key=None):
+    """Metrics for a date range in the same shape as ``metrics.compute_metrics``"""
+    current_year = current_year or datetime.now(timezone.utc).year
+    sums = _prefix_sums(conn, key)
+    first = day_number(start_date) if start_date else -(2 ** 31)
+    last = day_number(end_date) if end_date else 2 ** 31
+
+    per_channel = range_totals(sums, first, last)
+    totals = dict(zip(SALES_FIELDS, per_channel.sum(axis=0)))
+    money = {field: round(float(totals[field]), 2) for field in MONEY_FIELDS}
+    order_count = int(round(totals["orders"]))
+
+    by_year = {}
+    for label, year in (("current_year", current_year), ("previous_year", current_year - 1)):
+        months = {}
+        for m, name in enumerate(metrics.MONTHS, start=1):
+            month_first = day_number(date(year, m, 1))
+            month_last = day_number(date(year + (m == 12), m % 12 + 1, 1)) - 1
+            month_sales = range_totals(sums, max(first, month_first), min(last, month_last))
+            months[name] = round(float(month_sales[:, SALES_FIELDS.index("total_sales")].sum()), 2)
+        by_year[label] = months
+
+    channel_orders = per_channel[:, SALES_FIELDS.index("orders")]
+    channel_sales = per_channel[:, SALES_FIELDS.index("total_sales")]
+    sales_by_channel = {
+        channel: round(float(channel_sales[i]), 2)
+        for i, channel in enumerate(sums["channels"]) if round(channel_orders[i]) > 0
+    }
+
+    bounds = (first, last)
+    sales_by_product = {
+        name: round(amount, 2)
+        for name, amount in conn.execute(
+            "SELECT name, SUM(amount) FROM rollup_daily_product WHERE day BETWEEN ? AND ? GROUP BY name",
+            bounds,
+        )
+    }
+    total_customers, returning_customers = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(n > 1), 0) FROM ("
+        "SELECT SUM(orders) AS n FROM rollup_daily_customer WHERE day BETWEEN ? AND ? GROUP BY customer)",
+        bounds,
+    ).fetchone()
+
+    return {
+        "order_count": order_count,
+        "orders_fulfilled": int(round(totals["fulfilled"])),
+        **money,
+        "net_sales": round(money["gross_sales"] - money["discounts"] - money["returns"], 2),
+        "aov": money["total_sales"] / order_count if order_count > 0 else 0,
+        "total_customers": total_customers,
+        "returning_customers": returning_customers,
+        "returning_customer_rate": (returning_customers / total_customers) * 100 if total_customers else 0,
+        "sales_by_channel": sales_by_channel,
+        "sales_by_product": sales_by_product,
+        "sales_over_time": by_year,
+    }
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import re
+import time
+
+import httpx
+from fastapi import HTTPException
+
+import instrumentation
+from rate_limit import (INTERACTIVE, PAGINATION, LeakyBucketScheduler, backoff_delay, retry_after_seconds,
+                        throttle_delay)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+NEXT_LINK = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+class ShopifyClient:
+    """Async Shopify Admin API client sharing one pooled keep-alive connection.
+
+    ``max_concurrency`` caps how many requests are in flight at once across
+    every caller using the client. Every request is paced by one shared
+    leaky-bucket ``scheduler`` and retried with jittered backoff on 429s,
+    5xx responses and transport errors. An optional ``fair_share`` limits
+    in-flight calls across the clients of every shop in the process.
+
+    GraphQL mutations are the exception: after a 5xx or a transport error
+    Shopify may already have applied them, so they are only retried when
+    throttled (429 or THROTTLED), which Shopify answers without running
+    the call. GraphQL calls also go through the REST ``scheduler`` rather
+    than a model of the query-cost bucket; the bulk mutation and status
+    polls this client sends cost ~10 points every couple of seconds, well
+    under the 50 points a second the cost bucket restores, and a THROTTLED
+    answer waits exactly as long as ``extensions.cost`` says it must.
+    """
+
+    def __init__(self, shop, access_token, api_key="", api_secret="", api_version="2023-10",
+                 max_concurrency=8, timeout=30.0, max_retries=4, scheduler=None, fair_share=None,
+                 transport=None):
+        self.shop = shop
+        self.api_version = api_version
+        self.base_url = f"https://{shop}/admin/api/{api_version}/"
+        self.max_concurrency = max_concurrency
+        self._headers = {
+            "X-Shopify-Access-Token": access_token,
+            "X-Shopify-API-Key": api_key,
+            "X-Shopify-API-Secret": api_secret,
+        }
+        self._timeout = timeout
+        self._client = None
+        # Lets benchmarks point the client at an in-process stand-in for Shopify
+        self._transport = transport
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.scheduler = scheduler or LeakyBucketScheduler()
+        self.fair_share = fair_share
+
+    @property
+    def http(self):
+        """The underlying pooled HTTP client, created on first use"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers=self._headers,
+                timeout=self._timeout,
+                transport=self._transport,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get(self, path, params=None, priority=INTERACTIVE):
+        """GET ``{path}.json`` under the admin API through the rate-limit scheduler"""
+        url = path if path.startswith("https://") else f"{self.base_url}{path}.json"
+        return await self._request("GET", url, path, priority, params=params)
+
+    async def graphql(self, query, variables=None, priority=INTERACTIVE):
+        """Run a GraphQL Admin API query or mutation and return its ``data``.
+
+        Calls Shopify answers with a THROTTLED error are retried once the
+        query's cost has been restored; see the class docstring for mutations.
+        """
+        idempotent = not query.lstrip().startswith("mutation")
+        for attempt in range(self.max_retries + 1):
+            resp = await self._request("POST", f"{self.base_url}graphql.json", "graphql", priority,
+                                       retry=idempotent, json={"query": query, "variables": variables or {}})
+            if resp.status_code != 200:
+                raise HTTPException(status_code=resp.status_code, detail=f"Shopify GraphQL error: {resp.text}")
+            body = resp.json()
+            errors = body.get("errors") or []
+            throttled = any((error.get("extensions") or {}).get("code") == "THROTTLED" for error in errors)
+            if not throttled:
+                if errors:
+                    raise HTTPException(status_code=502, detail=f"Shopify GraphQL error: {errors}")
+                return body.get("data") or {}
+            if attempt < self.max_retries:
+                delay = throttle_delay(body) or backoff_delay(attempt)
+                logging.warning(f"Shopify GraphQL throttled, retrying in {delay:.2f}s")
+                self.scheduler.stats["retries"] += 1
+                await asyncio.sleep(delay)
+        raise HTTPException(status_code=429, detail="Shopify GraphQL throttled")
+
+    async def stream_lines(self, url):
+        """Yield the lines of a file Shopify hands out a signed URL for, e.g. a bulk operation result.
+
+        The file is not on the shop's domain, so it is downloaded without the
+        API credentials and outside the call-limit bucket.
+        """
+        async with httpx.AsyncClient(timeout=httpx.Timeout(self._timeout, read=None),
+                                     transport=self._transport) as client:
+            async with client.stream("GET", url) as resp:
+                if resp.status_code != 200:
+                    await resp.aread()
+                    raise HTTPException(status_code=502, detail=f"Download of {url} failed: {resp.status_code}")
+                async for line in resp.aiter_lines():
+                    if line:
+                        yield line
+
+    async def _request(self, method, url, label, priority, retry=True, **kwargs):
+        """Send one call through the scheduler, retrying as described in the class docstring.
+
+        With ``retry=False`` only 429s, which Shopify never processed, are retried.
+        """
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(priority)
+            try:
+                async with self._semaphore:
+                    if self.fair_share is None:
+                        resp = await self._send(method, url, **kwargs)
+                    else:
+                        async with self.fair_share.slot(self.shop):
+                            resp = await self._send(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if not retry or attempt >= self.max_retries:
+                    raise HTTPException(status_code=502, detail=f"Shopify API unreachable: {e}")
+                delay = backoff_delay(attempt)
+                logging.warning(f"Shopify request to {label} failed ({e}), retrying in {delay:.2f}s")
+            else:
+                await self.scheduler.observe(resp)
+                if (resp.status_code not in RETRY_STATUSES or attempt >= self.max_retries
+                        or (not retry and resp.status_code != 429)):
+                    return resp
+                delay = retry_after_seconds(resp) or backoff_delay(attempt)
+                logging.warning(f"Shopify returned {resp.status_code} for {label}, retrying in {delay:.2f}s")
+
+            attempt += 1
+            self.scheduler.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, method, url, **kwargs):
+        """One HTTP attempt, recorded in the per-endpoint call metrics"""
+        started = time.perf_counter()
+        try:
+            resp = await self.http.request(method, url, **kwargs)
+        except httpx.TransportError:
+            instrumentation.record_call(url, "error", time.perf_counter() - started, 0)
+            raise
+        instrumentation.record_call(url, resp.status_code, time.perf_counter() - started, len(resp.content))
+        return resp
+
+    async def iter_pages(self, endpoint, params=None, priority=PAGINATION):
+        """Yield the records of an endpoint one page at a time.
+
+        Follows the ``rel="next"`` URL from the Link header verbatim, since
+        Shopify only accepts ``limit``/``page_info`` on follow-up pages.
+        """
+        key = endpoint.split("/")[-1]
+        url, req_params = endpoint, dict(params or {})
+
+        while url:
+            resp = await self.get(url, req_params, priority=priority)
+
+            if resp.status_code != 200:
+                raise HTTPException(status_code=resp.status_code,
+                                    detail=f"Shopify API error: {resp.text}")
+
+            yield resp.json().get(key, [])
+
+            match = NEXT_LINK.search(resp.headers.get("Link", ""))
+            url, req_params = (match.group(1), None) if match else (None, None)
+
+    async def fetch_all(self, endpoint, params=None):
+        """Fetch all pages of data from Shopify API with pagination handling"""
+        results = []
+        async for page in self.iter_pages(endpoint, params):
+            results.extend(page)
+        return results
+
+    async def fetch_report(self, report_type, query_params=None):
+        """Fetch data from Shopify Analytics API"""
+        resp = await self.get(f"reports/{report_type}", query_params or {})
+
+        if resp.status_code != 200:
+            raise HTTPException(status_code=resp.status_code,
+                                detail=f"Analytics API error: {resp.text}")
+
+        return resp.json().get("report", {})
+
+    async def fetch_reports(self, report_types, query_params=None):
+        """Fetch several analytics reports concurrently, keyed by report type.
+
+        A report that fails is logged and returned as an empty dict so one
+        unavailable report does not take the others down with it.
+        """
+        reports = await asyncio.gather(
+            *(self.fetch_report(report_type, query_params) for report_type in report_types),
+            return_exceptions=True,
+        )
+        results = {}
+        for report_type, report in zip(report_types, reports):
+            if isinstance(report, Exception):
+                logging.warning(f"Shopify analytics report {report_type} unavailable or failed: {report}")
+                report = {}
+            results[report_type] = report
+        return results
@@ -0,0 +1,169 @@
+"""Shops served by this process.
+
+Every shop gets its own Shopify client (connection pool and rate-limit
+bucket), its own SQLite store and snapshot directory and its own namespace
+in the response cache. The shop a request is for is activated with
+``activate``, which routes ``store`` and ``snapshot`` calls made from that
+request, and from the tasks and threads it starts, to the shop's files.
+
+Credentials for additional shops are read from the JSON file named by
+``SHOPIFY_SHOPS_FILE``::
+
+    {"other-shop.myshopify.com": {"access_token": "...", "api_key": "...",
+                                  "api_secret": "...", "webhook_secret": "...",
+                                  "dashboard_token": "..."}}
+
+``dashboard_token`` is what callers of this API present to read a shop's
+data (``ShopRegistry.authenticate``); a shop without one can't be served.
+The exception is a single-shop deployment without SHOPIFY_DASHBOARD_TOKEN,
+which serves its shop to every caller as it did before tokens existed.
+"""
+import asyncio
+import contextvars
+import hmac
+import json
+import logging
+import os
+from collections import defaultdict
+
+import snapshot
+import store
+
+# The shop configured through the SHOPIFY_* environment variables
+DEFAULT_SHOP = os.environ.get("SHOPIFY_SHOP", "client-staging.myshopify.com")  # extracted from your admin url
+SHOPS_FILE = os.environ.get("SHOPIFY_SHOPS_FILE")
+DATA_DIR = os.environ.get(
+    "SHOPIFY_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "shops"),
+)
+
+_current = contextvars.ContextVar("shop", default=None)
+
+
+class Shop:
+    def __init__(self, domain, client, webhook_secret="", store_path=None, snapshot_dir=None):
+        self.domain = domain
+        self.client = client
+        self.webhook_secret = webhook_secret
+        self.store_path = store_path
+        self.snapshot_dir = snapshot_dir
+        self._locks = defaultdict(asyncio.Lock)
+
+    def lock(self, name):
+        """An asyncio lock private to this shop, e.g. one per synced resource"""
+        return self._locks[name]
+
+    def context(self):
+        """A fresh context with this shop active, for long-running tasks.
+
+        Fresh rather than copied, so a task started while serving a request
+        doesn't carry that request's state (e.g. its stage timings) along.
+        """
+        ctx = contextvars.Context()
+        ctx.run(activate, self)
+        return ctx
+
+
+def activate(shop):
+    """Make ``shop`` the shop of the current request or task"""
+    _current.set(shop)
+    store.use(shop.store_path)
+    snapshot.use(shop.snapshot_dir)
+
+
+def current():
+    shop = _current.get()
+    if shop is None:
+        raise LookupError("No shop is active in this context")
+    return shop
+
+
+def shop_paths(domain, data_dir=None):
+    """Store path and snapshot directory of a shop other than the default one"""
+    root = os.path.join(data_dir or DATA_DIR, domain)
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, "shopify_store.db"), os.path.join(root, "snapshots")
+
+
+def load_credentials(path=None):
+    """Per-shop credentials from ``SHOPIFY_SHOPS_FILE``, keyed by shop domain"""
+    path = path or SHOPS_FILE
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            return {domain.lower(): creds for domain, creds in json.load(f).items()}
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read shop credentials from {path}: {e}")
+        return {}
+
+
+class ShopRegistry:
+    """Known shops, with their clients created on first use.
+
+    ``default`` is the shop configured through the SHOPIFY_* environment
+    variables; it keeps the original store and snapshot locations so
+    single-shop deployments are unaffected.
+    """
+
+    def __init__(self, client_factory, default, default_credentials, credentials=None, data_dir=None):
+        self.client_factory = client_factory
+        self.default = default.lower()
+        self.data_dir = data_dir or DATA_DIR
+        self._credentials = {**(credentials or {}), self.default: default_credentials}
+        self._shops = {}
+        # One shop and no token: nothing to tell callers apart by, so everyone gets that shop
+        self.open = len(self._credentials) == 1 and not default_credentials.get("dashboard_token")
+        if self.open:
+            logging.warning(f"No dashboard token configured for {self.default}; its API is open to every caller")
+        for domain, creds in self._credentials.items():
+            if not self.open and not creds.get("dashboard_token"):
+                logging.warning(f"No dashboard token configured for {domain}; its API requests will be refused")
+
+    def domains(self):
+        return sorted(self._credentials)
+
+    def get(self, domain=None):
+        """The shop for ``domain`` (the default shop when empty), or None if it is unknown"""
+        domain = (domain or self.default).strip().lower()
+        shop = self._shops.get(domain)
+        if shop is None:
+            creds = self._credentials.get(domain)
+            if creds is None:
+                return None
+            shop = self._shops[domain] = self._create(domain, creds)
+        return shop
+
+    def authenticate(self, token):
+        """The shop whose dashboard token is ``token``, or None; any caller gets an open registry's shop"""
+        if self.open:
+            return self.get()
+        if not token:
+            return None
+        found = None
+        # Compare against every shop so the time taken doesn't reveal which one matched
+        for domain, creds in self._credentials.items():
+            expected = creds.get("dashboard_token")
+            if expected and hmac.compare_digest(expected.encode(), token.encode()):
+                found = domain
+        return self.get(found) if found else None
+
+    def _create(self, domain, creds):
+        store_path = snapshot_dir = None
+        if domain != self.default:
+            store_path, snapshot_dir = shop_paths(domain, self.data_dir)
+        client = self.client_factory(domain, creds)
+        return Shop(
+            domain,
+            client,
+            webhook_secret=creds.get("webhook_secret") or creds.get("api_secret", ""),
+            store_path=store_path,
+            snapshot_dir=snapshot_dir,
+        )
+
+    def active(self):
+        return list(self._shops.values())
+
+    async def aclose(self):
+        for shop in self._shops.values():
+            await shop.client.aclose()
@@ -0,0 +1,141 @@
+"""On-disk columnar snapshots of ``metrics.OrderColumns``.
+
+A snapshot is a directory of ``.npy`` files (one per column), a JSON file
+with the string dictionaries and a manifest. Readers memory-map the column
+files, so cold starts and parallel workers share the OS page cache instead
+of each re-parsing order JSON. Writers build a new versioned directory and
+atomically repoint ``CURRENT`` at it.
+"""
+import contextvars
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+
+import metrics
+
+SNAPSHOT_DIR = os.environ.get(
+    "SHOPIFY_SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"),
+)
+KEEP_SNAPSHOTS = 2
+
+_lock = threading.Lock()
+_opened = {}
+
+# Snapshot directory of the shop being served in the current request or task
+_current_base = contextvars.ContextVar("snapshot_dir", default=None)
+
+
+def use(base):
+    """Read and write snapshots from the current context under ``base``"""
+    _current_base.set(base)
+
+
+def _root(name, base=None):
+    return os.path.join(base or _current_base.get() or SNAPSHOT_DIR, name)
+
+
+def current_dir(name, base=None):
+    """Directory of the current snapshot for ``name``, or None"""
+    try:
+        with open(os.path.join(_root(name, base), "CURRENT")) as f:
+            return os.path.join(_root(name, base), f.read().strip())
+    except FileNotFoundError:
+        return None
+
+
+def write(name, cols, version, base=None):
+    """Write ``cols`` as the new current snapshot of ``name`` tagged with ``version``"""
+    root = _root(name, base)
+    os.makedirs(root, exist_ok=True)
+    target = tempfile.mkdtemp(prefix="v-", dir=root)
+
+    for field, values in {**cols.order_columns(), **cols.item_columns()}.items():
+        np.save(os.path.join(target, f"{field}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(target, "dictionaries.json"), "w") as f:
+        json.dump({"channels": cols.channels, "customers": cols.customers, "products": cols.products}, f)
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump({
+            "version": version,
+            "format": metrics.COLUMNS_FORMAT,
+            "orders": len(cols),
+            "items": len(cols.item_order),
+            "order_fields": cols.order_fields,
+            "item_fields": cols.item_fields,
+            "written_at": datetime.now(timezone.utc).isoformat(),
+        }, f)
+
+    # Atomically switch readers over to the new directory
+    pointer = os.path.join(root, "CURRENT.tmp")
+    with open(pointer, "w") as f:
+        f.write(os.path.basename(target))
+    os.replace(pointer, os.path.join(root, "CURRENT"))
+    _prune(root, os.path.basename(target))
+    return target
+
+
+def _prune(root, current):
+    """Remove old snapshot directories; open memory maps keep their pages alive"""
+    versions = sorted(
+        (entry for entry in os.scandir(root) if entry.is_dir() and entry.name != current),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in versions[KEEP_SNAPSHOTS - 1:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def open_dir(directory):
+    """Memory-map the snapshot in ``directory``; returns ``(manifest, cols)``"""
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    with open(os.path.join(directory, "dictionaries.json")) as f:
+        dictionaries = json.load(f)
+    cols = metrics.OrderColumns(
+        {field: np.load(os.path.join(directory, f"{field}.npy"), mmap_mode="r")
+         for field in manifest["order_fields"]},
+        {field: np.load(os.path.join(directory, f"{field}.npy"), mmap_mode="r")
+         for field in manifest["item_fields"]},
+        dictionaries["channels"],
+        dictionaries["customers"],
+        dictionaries["products"],
+    )
+    cols.directory = directory
+    return manifest, cols
+
+
+def load(name, version=None, base=None):
+    """Memory-map the current snapshot of ``name``.
+
+    Returns None when there is no snapshot, when it predates the current
+    column format or, if ``version`` is given, when the snapshot was written
+    for a different version.
+    """
+    directory = current_dir(name, base)
+    if directory is None:
+        return None
+
+    root = _root(name, base)
+    with _lock:
+        cached = _opened.get(root)
+        if cached and cached[0] == directory:
+            manifest, cols = cached[1], cached[2]
+        else:
+            try:
+                manifest, cols = open_dir(directory)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Snapshot {directory} unreadable: {e}")
+                return None
+            _opened[root] = (directory, manifest, cols)
+
+    if manifest.get("format") != metrics.COLUMNS_FORMAT:
+        return None
+    if version is not None and manifest.get("version") != version:
+        return None
+    return cols
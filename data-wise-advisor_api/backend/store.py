@@ -0,0 +1,758 @@
+import json
+import logging
+import os
+import contextvars
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+
+import cohorts
+import product_sales
+import rollups
+
+STORE_PATH = os.environ.get(
+    "SHOPIFY_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "shopify_store.db"),
+)
+
+RESOURCES = ("orders", "products", "customers")
+
+# Store of the shop being served in the current request or task
+_current_path = contextvars.ContextVar("store_path", default=None)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT,
+    payload TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS customers (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_customers_created_at ON customers (created_at);
+
+CREATE TABLE IF NOT EXISTS order_refunds (
+    order_id INTEGER PRIMARY KEY,
+    order_updated_at TEXT,
+    amount REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS inventory_items (
+    id INTEGER PRIMARY KEY,
+    payload TEXT,
+    fetched_at REAL,
+    fingerprint TEXT,
+    levels_fetched_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS inventory_levels (
+    inventory_item_id INTEGER NOT NULL,
+    location_id INTEGER NOT NULL,
+    available INTEGER,
+    updated_at TEXT,
+    PRIMARY KEY (inventory_item_id, location_id)
+);
+
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    webhook_id TEXT UNIQUE,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_at TEXT NOT NULL,
+    processed_at TEXT,
+    error TEXT,
+    claimed_by TEXT,
+    claimed_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_events_pending ON webhook_events (processed_at, id);
+
+CREATE TABLE IF NOT EXISTS reports (
+    report_type TEXT NOT NULL,
+    params TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (report_type, params)
+);
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    name TEXT PRIMARY KEY,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    next_run REAL NOT NULL DEFAULT 0,
+    last_started REAL,
+    last_finished REAL,
+    last_duration REAL,
+    last_error TEXT,
+    runs INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    resource TEXT PRIMARY KEY,
+    watermark TEXT,
+    synced_at TEXT
+);
+
+-- Writes per resource, so its version changes even when its newest updated_at doesn't
+CREATE TABLE IF NOT EXISTS store_changes (
+    resource TEXT PRIMARY KEY,
+    changes INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added to tables that older stores already have, as (table, column, type)
+_ADDED_COLUMNS = (
+    ("webhook_events", "claimed_by", "TEXT"),
+    ("webhook_events", "claimed_until", "REAL"),
+)
+
+_init_lock = threading.Lock()
+_initialized = set()
+
+# Product sales index of each store path
+_indexes_lock = threading.Lock()
+_product_indexes = {}
+
+
+def to_utc(timestamp):
+    """Normalize a Shopify ISO timestamp to a sortable UTC string"""
+    if not timestamp:
+        return None
+    dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def date_bounds(start_date, end_date):
+    """Turn YYYY-MM-DD query dates into inclusive UTC timestamp bounds"""
+    lower = f"{start_date}T00:00:00" if start_date else None
+    upper = f"{end_date}T23:59:59" if end_date else None
+    return lower, upper
+
+
+def use(path):
+    """Route store calls made from the current context to the store at ``path``"""
+    _current_path.set(path)
+
+
+def current_path(path=None):
+    return path or _current_path.get() or STORE_PATH
+
+
+@contextmanager
+def connect(path=None):
+    """Open a connection to the local store, creating the schema on first use"""
+    path = current_path(path)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        with _init_lock:
+            if path not in _initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA + rollups.SCHEMA)
+                for table, column, kind in _ADDED_COLUMNS:
+                    if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+                _initialized.add(path)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def upsert(resource, records, path=None):
+    """Insert or replace records of a resource; returns (newest updated_at seen, records written).
+
+    A record never replaces a stored copy with a newer updated_at, so a page
+    fetched before a webhook landed can't roll the webhook's update back.
+    """
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+
+    # The last copy of a record wins if it appears more than once
+    latest = {record["id"]: record for record in records if record.get("id") is not None}
+
+    rows = []
+    newest = None
+    written = []
+    for record_id, record in latest.items():
+        updated = to_utc(record.get("updated_at"))
+        if updated and (newest is None or updated > newest):
+            newest = updated
+        rows.append((record_id, to_utc(record.get("created_at")), updated, json.dumps(record)))
+
+    if rows:
+        with connect(path) as conn:
+            # Take the write lock before reading the stored rows, so concurrent
+            # writers (webhook drainers in other processes, a sync) can't both
+            # take the same old contribution out of the rollups
+            conn.execute("BEGIN IMMEDIATE")
+            stored = _stored(conn, resource, list(latest))
+            rows = [row for row in rows if _replaces(row, stored.get(row[0]))]
+            conn.executemany(
+                f"INSERT INTO {resource} (id, created_at, updated_at, payload) VALUES (?, ?, ?, ?) "
+                f"ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at, "
+                f"updated_at = excluded.updated_at, payload = excluded.payload "
+                f"WHERE COALESCE(excluded.updated_at, '') >= COALESCE({resource}.updated_at, '')",
+                rows,
+            )
+            written = [row[0] for row in rows]
+            if written:
+                conn.execute(
+                    "INSERT INTO store_changes (resource, changes) VALUES (?, 1) "
+                    "ON CONFLICT (resource) DO UPDATE SET changes = changes + 1",
+                    (resource,),
+                )
+            if resource == "orders":
+                # A cached refund total is only good for the payload it was computed from
+                conn.executemany("DELETE FROM order_refunds WHERE order_id = ?", [(i,) for i in written])
+                # Keep the daily rollups in step within the same transaction,
+                # for the orders actually written
+                old_orders = [json.loads(stored[i][1]) for i in written if i in stored]
+                rollups.apply_orders(conn, old_orders, [latest[i] for i in written])
+    return newest, len(written)
+
+
+def _replaces(row, stored):
+    """Whether an (id, created_at, updated_at, payload) row should overwrite the stored copy.
+
+    Older copies never do, and an identical copy (as re-read by the sync
+    overlap) is skipped so it doesn't churn the rollups.
+    """
+    if stored is None:
+        return True
+    updated, payload = stored
+    return (row[2] or "") > (updated or "") or ((row[2] or "") == (updated or "") and row[3] != payload)
+
+
+def _stored(conn, resource, ids):
+    """id -> (updated_at, payload) of the stored records among ``ids``"""
+    stored = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for record_id, updated, payload in conn.execute(
+            f"SELECT id, updated_at, payload FROM {resource} WHERE id IN ({placeholders})", chunk
+        ):
+            stored[record_id] = (updated, payload)
+    return stored
+
+
+def load_ids(resource, ids, path=None):
+    """Stored records with the given ids"""
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+    with connect(path) as conn:
+        return _load_ids(conn, resource, list(ids))
+
+
+def _load_ids(conn, resource, ids):
+    """Stored payloads for the given ids, in chunks below SQLite's parameter limit"""
+    records = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        records.extend(
+            json.loads(row[0])
+            for row in conn.execute(f"SELECT payload FROM {resource} WHERE id IN ({placeholders})", chunk)
+        )
+    return records
+
+
+def _created_filter(start_date, end_date):
+    clauses, args = [], []
+    lower, upper = date_bounds(start_date, end_date)
+    if lower:
+        clauses.append("created_at >= ?")
+        args.append(lower)
+    if upper:
+        clauses.append("created_at <= ?")
+        args.append(upper)
+    return clauses, args
+
+
+def load(resource, start_date=None, end_date=None, path=None):
+    """Load stored records, optionally filtered on created_at by YYYY-MM-DD bounds"""
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+
+    query = f"SELECT payload FROM {resource}"
+    clauses, args = _created_filter(start_date, end_date)
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY created_at, id"
+
+    with connect(path) as conn:
+        return [json.loads(row[0]) for row in conn.execute(query, args)]
+
+
+def load_page(resource, start_date=None, end_date=None, after_id=None, limit=1000, undated=False, path=None):
+    """Load one id-ordered page of stored records with an id greater than ``after_id``.
+
+    ``undated`` also includes records without a created_at outside the date filter.
+    """
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+
+    clauses, args = _created_filter(start_date, end_date)
+    if clauses and undated:
+        clauses = [f"(created_at IS NULL OR ({' AND '.join(clauses)}))"]
+    if after_id is not None:
+        clauses.append("id > ?")
+        args.append(after_id)
+    query = f"SELECT payload FROM {resource}"
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY id LIMIT ?"
+    args.append(limit)
+
+    with connect(path) as conn:
+        return [json.loads(row[0]) for row in conn.execute(query, args)]
+
+
+def created_ranges(resource, parts, min_records=0, path=None):
+    """Split a resource into up to ``parts`` YYYY-MM-DD ranges holding about as many records each.
+
+    The ranges are inclusive, whole UTC days and open-ended at both ends.
+    Resources with fewer than ``min_records`` dated records get one range.
+    """
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+    with connect(path) as conn:
+        dated = conn.execute(f"SELECT COUNT(created_at) FROM {resource}").fetchone()[0]
+        if parts <= 1 or dated < max(min_records, parts):
+            return [(None, None)]
+        days = []
+        for part in range(1, parts):
+            day = conn.execute(
+                f"SELECT substr(created_at, 1, 10) FROM {resource} WHERE created_at IS NOT NULL "
+                "ORDER BY created_at LIMIT 1 OFFSET ?",
+                (dated * part // parts,),
+            ).fetchone()[0]
+            if not days or day > days[-1]:
+                days.append(day)
+    # A day never straddles two ranges
+    ends = [(date.fromisoformat(day) - timedelta(days=1)).isoformat() for day in days]
+    return list(zip([None, *days], [*ends, None]))
+
+
+def version(resource, path=None):
+    """Change marker for a resource derived from its row count, newest updated_at and write count"""
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+    with connect(path) as conn:
+        return _version(conn, resource)
+
+
+def _version(conn, resource):
+    newest, rows = conn.execute(f"SELECT MAX(updated_at), COUNT(*) FROM {resource}").fetchone()
+    changes = conn.execute("SELECT changes FROM store_changes WHERE resource = ?", (resource,)).fetchone()
+    return f"{rows}:{newest or ''}:{changes[0] if changes else 0}"
+
+
+def get_watermark(resource, path=None):
+    """Return the updated_at watermark of the last sync for a resource"""
+    with connect(path) as conn:
+        row = conn.execute("SELECT watermark FROM sync_state WHERE resource = ?", (resource,)).fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(resource, watermark, path=None):
+    """Record the updated_at watermark reached by a sync"""
+    synced_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    with connect(path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (resource, watermark, synced_at) VALUES (?, ?, ?)",
+            (resource, watermark, synced_at),
+        )
+
+
+def sync_status(path=None):
+    """Watermark, last sync time and record count per resource"""
+    status = {}
+    with connect(path) as conn:
+        for resource in RESOURCES:
+            row = conn.execute(
+                "SELECT watermark, synced_at FROM sync_state WHERE resource = ?", (resource,)
+            ).fetchone()
+            status[resource] = {
+                "watermark": row[0] if row else None,
+                "synced_at": row[1] if row else None,
+                "count": conn.execute(f"SELECT COUNT(*) FROM {resource}").fetchone()[0],
+            }
+    return status
+
+
+def reset(resource, path=None):
+    """Drop all stored records and the watermark for a resource"""
+    if resource not in RESOURCES:
+        raise ValueError(f"Unknown resource: {resource}")
+    with connect(path) as conn:
+        conn.execute(f"DELETE FROM {resource}")
+        conn.execute("DELETE FROM sync_state WHERE resource = ?", (resource,))
+        if resource == "orders":
+            # An empty store has complete (empty) rollups
+            rollups.clear(conn, built=True)
+    logging.info(f"Local store reset for {resource}")
+
+
+def get_refund_totals(orders, path=None):
+    """Cached refund totals for orders whose updated_at has not changed since caching"""
+    wanted = {o["id"]: to_utc(o.get("updated_at")) for o in orders if o.get("id") is not None}
+    if not wanted:
+        return {}
+
+    cached = {}
+    ids = list(wanted)
+    with connect(path) as conn:
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for order_id, updated, amount in conn.execute(
+                f"SELECT order_id, order_updated_at, amount FROM order_refunds WHERE order_id IN ({placeholders})",
+                chunk,
+            ):
+                if updated == wanted[order_id]:
+                    cached[order_id] = amount
+    return cached
+
+
+def set_refund_totals(totals, path=None):
+    """Cache refund totals as (order_id, order updated_at, amount) tuples"""
+    rows = [(order_id, to_utc(updated), amount) for order_id, updated, amount in totals]
+    if rows:
+        with connect(path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO order_refunds (order_id, order_updated_at, amount) VALUES (?, ?, ?)",
+                rows,
+            )
+            rollups.apply_refunds(conn, [(order_id, amount) for order_id, _, amount in rows])
+
+
+def inventory_state(item_ids, path=None):
+    """inventory item id -> (levels fingerprint, levels fetched at, details fetched at) for cached items"""
+    state = {}
+    with connect(path) as conn:
+        for i in range(0, len(item_ids), 500):
+            chunk = item_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for item_id, fingerprint, levels_fetched_at, fetched_at in conn.execute(
+                f"SELECT id, fingerprint, levels_fetched_at, fetched_at FROM inventory_items "
+                f"WHERE id IN ({placeholders})",
+                chunk,
+            ):
+                state[item_id] = (fingerprint, levels_fetched_at, fetched_at)
+    return state
+
+
+_UPSERT_LEVEL = (
+    "INSERT INTO inventory_levels (inventory_item_id, location_id, available, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (inventory_item_id, location_id) DO UPDATE SET "
+    "available = excluded.available, updated_at = excluded.updated_at "
+    "WHERE inventory_levels.updated_at IS NULL OR excluded.updated_at >= inventory_levels.updated_at"
+)
+
+
+def _level_rows(levels):
+    return [
+        (level["inventory_item_id"], level["location_id"], level.get("available"), to_utc(level.get("updated_at")))
+        for level in levels
+        if level.get("inventory_item_id") is not None and level.get("location_id") is not None
+    ]
+
+
+def save_inventory_levels(levels, fingerprints, path=None):
+    """Replace the levels of the items in ``fingerprints`` (item id -> fingerprint) with ``levels``"""
+    fetched_at = time.time()
+    item_ids = list(fingerprints)
+    with connect(path) as conn:
+        for i in range(0, len(item_ids), 500):
+            chunk = item_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM inventory_levels WHERE inventory_item_id IN ({placeholders})", chunk)
+        conn.executemany(_UPSERT_LEVEL, _level_rows(levels))
+        conn.executemany(
+            "INSERT INTO inventory_items (id, fingerprint, levels_fetched_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET fingerprint = excluded.fingerprint, "
+            "levels_fetched_at = excluded.levels_fetched_at",
+            [(item_id, fingerprint, fetched_at) for item_id, fingerprint in fingerprints.items()],
+        )
+
+
+def apply_inventory_levels(levels, path=None):
+    """Record levels pushed by webhooks; older updates than the stored ones are ignored"""
+    with connect(path) as conn:
+        conn.executemany(_UPSERT_LEVEL, _level_rows(levels))
+
+
+def remove_inventory_levels(levels, path=None):
+    """Forget levels of items no longer stocked at a location"""
+    with connect(path) as conn:
+        conn.executemany(
+            "DELETE FROM inventory_levels WHERE inventory_item_id = ? AND location_id = ?",
+            [(level["inventory_item_id"], level["location_id"]) for level in levels],
+        )
+
+
+def save_inventory_items(items, path=None):
+    """Cache inventory item details (SKU, cost, tracked)"""
+    fetched_at = time.time()
+    with connect(path) as conn:
+        conn.executemany(
+            "INSERT INTO inventory_items (id, payload, fetched_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET payload = excluded.payload, fetched_at = excluded.fetched_at",
+            [(item["id"], json.dumps(item), fetched_at) for item in items if item.get("id") is not None],
+        )
+
+
+def load_inventory(path=None):
+    """Cached (levels, items): item id -> {location id: available}, and item id -> item details"""
+    levels, items = {}, {}
+    with connect(path) as conn:
+        for item_id, location_id, available in conn.execute(
+            "SELECT inventory_item_id, location_id, available FROM inventory_levels"
+        ):
+            levels.setdefault(item_id, {})[location_id] = available
+        for item_id, payload, levels_fetched_at in conn.execute(
+            "SELECT id, payload, levels_fetched_at FROM inventory_items"
+        ):
+            if payload is not None:
+                items[item_id] = json.loads(payload)
+            if levels_fetched_at is not None:
+                # Fetched without any level: stocked nowhere
+                levels.setdefault(item_id, {})
+    return levels, items
+
+
+def save_locations(locations, path=None):
+    fetched_at = time.time()
+    with connect(path) as conn:
+        conn.execute("DELETE FROM locations")
+        conn.executemany(
+            "INSERT INTO locations (id, payload, fetched_at) VALUES (?, ?, ?)",
+            [(location["id"], json.dumps(location), fetched_at) for location in locations],
+        )
+
+
+def load_locations(max_age=None, path=None):
+    """Stored locations, or None if never fetched or older than ``max_age`` seconds"""
+    with connect(path) as conn:
+        rows = conn.execute("SELECT payload, fetched_at FROM locations ORDER BY id").fetchall()
+    if not rows or (max_age is not None and time.time() - min(row[1] for row in rows) > max_age):
+        return None
+    return [json.loads(row[0]) for row in rows]
+
+
+def rollups_built(path=None):
+    """Whether the daily rollups cover every stored order"""
+    with connect(path) as conn:
+        return rollups.is_built(conn)
+
+
+def rebuild_rollups(cols, expected_version, rows=None, path=None):
+    """Rebuild the daily rollups from a columnar view of all orders.
+
+    ``rows`` are ``rollups.day_rows(cols)`` when they were computed elsewhere.
+    Returns False without writing if the orders changed since ``cols`` was
+    built for ``expected_version``.
+    """
+    with connect(path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if _version(conn, "orders") != expected_version:
+            return False
+        rollups.rebuild(conn, cols, rows)
+    logging.info(f"Daily rollups rebuilt from {len(cols)} orders")
+    return True
+
+
+def rollup_summary(start_date=None, end_date=None, path=None):
+    """Metrics for a date range answered from the daily rollups"""
+    with connect(path) as conn:
+        return rollups.summary(conn, start_date, end_date, key=current_path(path))
+
+
+def product_sales_index(path=None):
+    """The product sales index of the store, brought up to date with its rollups"""
+    path = current_path(path)
+    with _indexes_lock:
+        index = _product_indexes.get(path)
+        if index is None:
+            index = _product_indexes[path] = product_sales.ProductSalesIndex()
+    with connect(path) as conn, index.lock:
+        # One read snapshot, so the generation matches the rows read for it
+        conn.execute("BEGIN")
+        current = rollups.generation(conn)
+        if index.generation != current:
+            changes = None
+            if index.generation is not None:
+                changes = rollups.product_changes(conn, index.generation, current)
+            if changes is None:
+                index.load(rollups.product_rows(conn))
+            else:
+                index.apply(changes)
+            index.generation = current
+    return index
+
+
+def cohort_summary(start_month=None, end_month=None, max_age=12, path=None):
+    """Cohort retention matrix and LTV curves answered from the cohort tables"""
+    with connect(path) as conn:
+        return cohorts.summary(conn, start_month, end_month, max_age)
+
+
+def utc_now():
+    """The current time as a sortable UTC string, like ``to_utc``"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def enqueue_event(webhook_id, topic, payload, path=None):
+    """Durably queue a webhook payload; returns False for an already seen webhook id"""
+    with connect(path) as conn:
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO webhook_events (webhook_id, topic, payload, received_at) VALUES (?, ?, ?, ?)",
+            (webhook_id, topic, payload, utc_now()),
+        )
+        return cursor.rowcount == 1
+
+
+def claim_events(owner, limit=500, lease_seconds=300, path=None):
+    """Claim the oldest unprocessed webhook events for ``owner``, as (id, topic, payload) tuples.
+
+    Claiming is one atomic UPDATE, so with several drainers on one store
+    (uvicorn workers, ``webhooks.py --local``) every event is handed to only
+    one of them. A claim that isn't marked processed within ``lease_seconds``,
+    e.g. because its drainer died, lapses and the event is handed out again.
+    An idle queue is seen with a plain read, without taking the write lock.
+    """
+    now = time.time()
+    with connect(path) as conn:
+        claimable = conn.execute(
+            "SELECT 1 FROM webhook_events WHERE processed_at IS NULL "
+            "AND (claimed_until IS NULL OR claimed_until < ?) LIMIT 1",
+            (now,),
+        ).fetchone()
+        if claimable is None:
+            return []
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "UPDATE webhook_events SET claimed_by = ?, claimed_until = ? WHERE id IN ("
+            "SELECT id FROM webhook_events WHERE processed_at IS NULL "
+            "AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY id LIMIT ?) "
+            "RETURNING id, topic, payload",
+            (owner, now + lease_seconds, now, limit),
+        ).fetchall()
+    return [(event_id, topic, json.loads(payload)) for event_id, topic, payload in sorted(rows)]
+
+
+def mark_processed(event_ids, error=None, path=None):
+    """Mark webhook events as handled, optionally recording why they failed"""
+    processed_at = utc_now()
+    with connect(path) as conn:
+        conn.executemany(
+            "UPDATE webhook_events SET processed_at = ?, error = ? WHERE id = ?",
+            [(processed_at, error, event_id) for event_id in event_ids],
+        )
+
+
+def queue_status(path=None):
+    """Pending, processed and failed webhook event counts"""
+    with connect(path) as conn:
+        pending, processed, failed = conn.execute(
+            "SELECT COALESCE(SUM(processed_at IS NULL), 0), COALESCE(SUM(processed_at IS NOT NULL), 0), "
+            "COALESCE(SUM(error IS NOT NULL), 0) FROM webhook_events"
+        ).fetchone()
+    return {"pending": pending, "processed": processed, "failed": failed}
+
+
+def _report_params(params):
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+
+
+def save_report(report_type, params, report, path=None):
+    """Store a fetched analytics report for its query parameters"""
+    with connect(path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO reports (report_type, params, payload, fetched_at) VALUES (?, ?, ?, ?)",
+            (report_type, _report_params(params), json.dumps(report), time.time()),
+        )
+
+
+def load_report(report_type, params=None, max_age=None, path=None):
+    """A stored analytics report, or None if it is missing or older than ``max_age`` seconds"""
+    with connect(path) as conn:
+        row = conn.execute(
+            "SELECT payload, fetched_at FROM reports WHERE report_type = ? AND params = ?",
+            (report_type, _report_params(params)),
+        ).fetchone()
+    if row is None or (max_age is not None and time.time() - row[1] > max_age):
+        return None
+    return json.loads(row[0])
+
+
+def claim_job(name, owner, lease_seconds, path=None):
+    """Take the lease on a due background job.
+
+    Returns None when the lease was taken, otherwise the number of seconds
+    until the job is due again or the current holder's lease runs out. Every
+    worker process shares the lease, so a job runs in only one of them.
+    """
+    now = time.time()
+    with connect(path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT OR IGNORE INTO job_runs (name) VALUES (?)", (name,))
+        lease_until, next_run = conn.execute(
+            "SELECT lease_until, next_run FROM job_runs WHERE name = ?", (name,)
+        ).fetchone()
+        wait = max(lease_until, next_run) - now
+        if wait > 0:
+            return wait
+        conn.execute(
+            "UPDATE job_runs SET owner = ?, lease_until = ?, last_started = ? WHERE name = ?",
+            (owner, now + lease_seconds, now, name),
+        )
+    return None
+
+
+def finish_job(name, owner, next_run, duration, error=None, path=None):
+    """Release a job lease and record how the run went"""
+    with connect(path) as conn:
+        conn.execute(
+            "UPDATE job_runs SET owner = NULL, lease_until = 0, next_run = ?, last_finished = ?, "
+            "last_duration = ?, last_error = ?, runs = runs + 1, failures = failures + ? "
+            "WHERE name = ? AND owner = ?",
+            (next_run, time.time(), duration, error, int(error is not None), name, owner),
+        )
+
+
+def job_status(path=None):
+    """Shared run history of every background job"""
+    with connect(path) as conn:
+        rows = conn.execute(
+            "SELECT name, owner, lease_until, next_run, last_started, last_finished, last_duration, "
+            "last_error, runs, failures FROM job_runs ORDER BY name"
+        ).fetchall()
+    fields = ("owner", "lease_until", "next_run", "last_started", "last_finished",
+              "last_duration", "last_error", "runs", "failures")
+    return {row[0]: dict(zip(fields, row[1:])) for row in rows}
@@ -0,0 +1,262 @@
+"""Shopify webhook ingestion.
+
+Verified webhook payloads are written to a durable queue in the local store
+and acknowledged immediately. ``WebhookWorker`` drains the queue in batches
+and applies the events idempotently to the stored orders, products,
+customers and cached inventory levels; the daily rollups follow along
+inside ``store.upsert``.
+
+Test payloads can be replayed against a running server, or straight into
+the local queue, with:
+
+    python webhooks.py orders/updated order.json [--shop other.myshopify.com] [--url http://localhost:8000] [--local]
+
+``--shop`` picks the shop the event is for; it defaults to the shop set by
+SHOPIFY_SHOP, and other shops are looked up in SHOPIFY_SHOPS_FILE.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import uuid
+from collections import defaultdict
+
+import shops
+import store
+
+WEBHOOK_SECRET = os.environ.get("SHOPIFY_WEBHOOK_SECRET", os.environ.get("SHOPIFY_API_SECRET", ""))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("SHOPIFY_WEBHOOK_BATCH_SIZE", "500"))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get("SHOPIFY_WEBHOOK_POLL_INTERVAL", "1"))
+WEBHOOK_LEASE = float(os.environ.get("SHOPIFY_WEBHOOK_LEASE", "300"))
+
+# Topic -> stored resource it updates
+TOPICS = {
+    "orders/create": "orders",
+    "orders/updated": "orders",
+    "refunds/create": "orders",
+    "products/update": "products",
+    "customers/update": "customers",
+    "inventory_levels/update": "inventory",
+    "inventory_levels/connect": "inventory",
+    "inventory_levels/disconnect": "inventory",
+    "inventory_items/update": "inventory",
+}
+
+
+def sign(body, secret=None):
+    """Base64 HMAC-SHA256 of a raw webhook body, as sent in X-Shopify-Hmac-Sha256"""
+    secret = WEBHOOK_SECRET if secret is None else secret
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def verify(body, signature, secret=None):
+    """Check a webhook body against its X-Shopify-Hmac-Sha256 header"""
+    secret = WEBHOOK_SECRET if secret is None else secret
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign(body, secret), signature)
+
+
+def _newer(resource, records):
+    """Drop records that are older than what the store already has"""
+    latest = {}
+    for record in records:
+        if record.get("id") is None:
+            continue
+        current = latest.get(record["id"])
+        if current is None or (store.to_utc(record.get("updated_at")) or "") >= (store.to_utc(current.get("updated_at")) or ""):
+            latest[record["id"]] = record
+
+    stored = {r["id"]: store.to_utc(r.get("updated_at")) or "" for r in store.load_ids(resource, latest)}
+    return [
+        record for record_id, record in latest.items()
+        if (store.to_utc(record.get("updated_at")) or "") >= stored.get(record_id, "")
+    ]
+
+
+def _with_refunds(refunds):
+    """Stored orders with the given refunds merged into their refunds array"""
+    by_order = defaultdict(list)
+    for refund in refunds:
+        if refund.get("order_id") is not None:
+            by_order[refund["order_id"]].append(refund)
+
+    changed = []
+    for order in store.load_ids("orders", by_order):
+        existing = order.setdefault("refunds", [])
+        known = {r.get("id") for r in existing}
+        added = [r for r in by_order[order["id"]] if r.get("id") is None or r.get("id") not in known]
+        if added:
+            existing.extend(added)
+            # Shopify moves the order's updated_at with the refund; so do we, so
+            # the order reads as changed to the snapshot and the refund cache
+            stamps = [store.to_utc(order.get("updated_at")) or ""]
+            stamps += [store.to_utc(r.get("created_at") or r.get("processed_at")) or store.utc_now() for r in added]
+            order["updated_at"] = max(stamps) + "Z"
+            changed.append(order)
+    return changed
+
+
+def apply_events(events):
+    """Apply a batch of (id, topic, payload) events; returns the number of records written"""
+    by_topic = defaultdict(list)
+    for _, topic, payload in events:
+        by_topic[topic].append(payload)
+
+    written = 0
+    orders = by_topic["orders/create"] + by_topic["orders/updated"]
+    if orders:
+        written += store.upsert("orders", _newer("orders", orders))[1]
+    if by_topic["refunds/create"]:
+        # Refunds land on the stored order, which moves its returns in the rollups
+        written += store.upsert("orders", _with_refunds(by_topic["refunds/create"]))[1]
+    for topic, resource in (("products/update", "products"), ("customers/update", "customers")):
+        if by_topic[topic]:
+            written += store.upsert(resource, _newer(resource, by_topic[topic]))[1]
+
+    # Inventory webhooks keep the cached levels current between refreshes
+    levels = by_topic["inventory_levels/update"] + by_topic["inventory_levels/connect"]
+    if levels:
+        store.apply_inventory_levels(levels)
+        written += len(levels)
+    if by_topic["inventory_levels/disconnect"]:
+        store.remove_inventory_levels(by_topic["inventory_levels/disconnect"])
+        written += len(by_topic["inventory_levels/disconnect"])
+    if by_topic["inventory_items/update"]:
+        store.save_inventory_items(by_topic["inventory_items/update"])
+        written += len(by_topic["inventory_items/update"])
+    return written
+
+
+class WebhookWorker:
+    """Background task that drains the webhook queue in batches.
+
+    Every process runs its own worker; events are claimed before they are
+    applied, so each is applied by only one of them.
+    """
+
+    def __init__(self, batch_size=None, poll_interval=None, on_applied=None, owner=None):
+        self.batch_size = batch_size or WEBHOOK_BATCH_SIZE
+        # Events are claimed under this name, so other drainers of the same store skip them
+        self.owner = owner or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.poll_interval = poll_interval or WEBHOOK_POLL_INTERVAL
+        self.on_applied = on_applied
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.stats = {"batches": 0, "events": 0, "failed_events": 0}
+
+    def notify(self):
+        """Wake the worker after an event has been queued"""
+        self._wakeup.set()
+
+    def start(self, context=None):
+        """Start draining; ``context`` selects e.g. the shop whose queue this worker owns"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), context=context)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def drain(self):
+        """Apply queued events until the queue is empty; returns events handled"""
+        handled = 0
+        while True:
+            events = await asyncio.to_thread(store.claim_events, self.owner, self.batch_size, WEBHOOK_LEASE)
+            if not events:
+                return handled
+            ids = [event_id for event_id, _, _ in events]
+            try:
+                written = await asyncio.to_thread(apply_events, events)
+            except Exception as e:
+                # Fall back to one event at a time so one bad payload can't block the queue
+                logging.warning(f"Webhook batch failed, applying events individually: {e}")
+                written = 0
+                for event in events:
+                    try:
+                        written += await asyncio.to_thread(apply_events, [event])
+                        await asyncio.to_thread(store.mark_processed, [event[0]])
+                    except Exception as event_error:
+                        self.stats["failed_events"] += 1
+                        logging.error(f"Webhook event {event[0]} ({event[1]}) failed: {event_error}")
+                        await asyncio.to_thread(store.mark_processed, [event[0]], str(event_error))
+            else:
+                await asyncio.to_thread(store.mark_processed, ids)
+            self.stats["batches"] += 1
+            self.stats["events"] += len(events)
+            handled += len(events)
+            # Events older than the stored records change nothing
+            if written and self.on_applied:
+                self.on_applied()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                logging.error(f"Webhook worker error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Shopify webhook payload")
+    parser.add_argument("topic", choices=sorted(TOPICS))
+    parser.add_argument("payload", help="Path to a JSON payload file")
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the running API")
+    parser.add_argument("--shop", default=shops.DEFAULT_SHOP, help="Shop domain (defaults to SHOPIFY_SHOP)")
+    parser.add_argument("--secret", default=None, help="Webhook secret (defaults to the shop's)")
+    parser.add_argument("--local", action="store_true", help="Apply directly to the local store, no server")
+    args = parser.parse_args()
+
+    domain = args.shop.strip().lower()
+    secret = args.secret
+    if domain != shops.DEFAULT_SHOP.lower():
+        creds = shops.load_credentials().get(domain)
+        if creds is None:
+            parser.error(f"Unknown shop {domain}: not in SHOPIFY_SHOPS_FILE")
+        if secret is None:
+            secret = creds.get("webhook_secret") or creds.get("api_secret", "")
+        if args.local:
+            store.use(shops.shop_paths(domain)[0])
+
+    with open(args.payload, "rb") as f:
+        body = f.read()
+    webhook_id = str(uuid.uuid4())
+
+    if args.local:
+        store.enqueue_event(webhook_id, args.topic, body.decode())
+        handled = asyncio.run(WebhookWorker().drain())
+        print(f"Applied {handled} event(s) to {store.current_path()}")
+        return
+
+    import httpx
+
+    resp = httpx.post(
+        f"{args.url.rstrip('/')}/api/shopify/webhooks/{args.topic}",
+        content=body,
+        headers={
+            "Content-Type": "application/json",
+            "X-Shopify-Shop-Domain": domain,
+            "X-Shopify-Topic": args.topic,
+            "X-Shopify-Webhook-Id": webhook_id,
+            "X-Shopify-Hmac-Sha256": sign(body, secret),
+        },
+    )
+    print(resp.status_code, resp.text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+const STREAM_URL = "http://localhost:8000/api/shopify/data/stream";
+const DASHBOARD_TOKEN = import.meta.env.VITE_SHOPIFY_DASHBOARD_TOKEN;
+
+export type SectionHandler = (section: string, data: any) => void;
+
+/**
+ * Read the dashboard payload section by section from the NDJSON stream, so
+ * each card can render as soon as its section is computed.
+ */
+export async function streamDashboard(
+  params: Record<string, string | boolean | undefined>,
+  onSection: SectionHandler,
+  signal?: AbortSignal,
+): Promise<void> {
+  const query = new URLSearchParams({ format: "ndjson" });
+  Object.entries(params).forEach(([key, value]) => {
+    if (value !== undefined && value !== "") query.set(key, String(value));
+  });
+
+  const response = await fetch(`${STREAM_URL}?${query}`, {
+    signal,
+    headers: { Authorization: `Bearer ${DASHBOARD_TOKEN}` },
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Dashboard stream failed: ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = "";
+  for (;;) {
+    const { done, value } = await reader.read();
+    buffered += decoder.decode(value, { stream: !done });
+    const lines = buffered.split("\n");
+    buffered = done ? "" : lines.pop() ?? "";
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const { section, data } = JSON.parse(line);
+      if (section === "error") throw new Error(data.error);
+      if (section === "done") return;
+      onSection(section, data);
+    }
+    if (done) return;
+  }
+}
@@ -16,7 +16,7 @@ import AiInsightCard from "@/components/dashboard/AiInsightCard";
 import FileUploadCard from "@/components/dashboard/FileUploadCard";
 import DocumentsList from "@/components/dashboard/DocumentsList";
 import QuickActions from "@/components/dashboard/QuickActions";
-import axios from "axios";
+import { streamDashboard } from "@/lib/dashboardStream";
 
 const TIME_RANGES = [
   { label: "Last 7 days", value: "7d" },
@@ -65,24 +65,29 @@ const Dashboard = () => {
   const fetchShopifyStats = async (startDate, endDate) => {
     setLoading(true);
     try {
-      const response = await axios.get("http://localhost:8000/api/shopify/data", {
-        params: { start_date: startDate, end_date: endDate },
-      });
-      const data = response.data.data;
-      setStats({
-        revenue: data.sales_summary.total_sales,
-        customers: data.orders_summary.count,
-        aov: data.average_order_value.value,
-        conversion: data.conversion_rate.rate,
-        orders: data.orders_summary.count,
-        returningCustomerRate: data.customer_metrics.returning_customer_rate,
-        grossSales: data.sales_summary.gross_sales,
-        netSales: data.sales_summary.net_sales,
-        discounts: data.sales_summary.discounts,
-        returns: data.sales_summary.returns,
-        shipping: data.sales_summary.shipping,
-        taxes: data.sales_summary.taxes,
-        fulfilledOrders: data.orders_summary.fulfilled,
+      // Cards fill in as their sections arrive instead of after the whole payload
+      await streamDashboard({ start_date: startDate, end_date: endDate }, (section, data) => {
+        if (section === "orders_summary") {
+          setStats(s => ({ ...s, customers: data.count, orders: data.count, fulfilledOrders: data.fulfilled }));
+        } else if (section === "sales_summary") {
+          setStats(s => ({
+            ...s,
+            revenue: data.total_sales,
+            grossSales: data.gross_sales,
+            netSales: data.net_sales,
+            discounts: data.discounts,
+            returns: data.returns,
+            shipping: data.shipping,
+            taxes: data.taxes,
+          }));
+          setLoading(false);
+        } else if (section === "customer_metrics") {
+          setStats(s => ({ ...s, returningCustomerRate: data.returning_customer_rate }));
+        } else if (section === "average_order_value") {
+          setStats(s => ({ ...s, aov: data.value }));
+        } else if (section === "conversion_rate") {
+          setStats(s => ({ ...s, conversion: data.rate }));
+        }
       });
     } catch (err) {
       setStats({ revenue: 0, customers: 0, aov: 0, conversion: 0, orders: 0, returningCustomerRate: 0, grossSales: 0, netSales: 0, discounts: 0, returns: 0, shipping: 0, taxes: 0, fulfilledOrders: 0 });
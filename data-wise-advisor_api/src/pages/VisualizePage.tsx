@@ -306,7 +306,10 @@ const VisualizePage = () => {
     setIsRefreshing(true);
     setLoading(true);
     try {
-      const response = await axios.get("http://localhost:8000/api/shopify/data");
+      const response = await axios.get("http://localhost:8000/api/shopify/data", {
+        params: { include_raw: true },
+        headers: { Authorization: `Bearer ${import.meta.env.VITE_SHOPIFY_DASHBOARD_TOKEN}` },
+      });
       if (response.data.error) {
         toast({
           title: "Shopify Data Error",
@@ -317,10 +320,10 @@ const VisualizePage = () => {
         setIsRefreshing(false);
         return;
       }
-      const data = response.data.data;
-      const orders = Array.isArray(data?.raw_data?.orders) ? data.raw_data.orders : [];
-      const products = Array.isArray(data?.raw_data?.products) ? data.raw_data.products : [];
-      const customers = Array.isArray(data?.raw_data?.customers) ? data.raw_data.customers : [];
+      const rawData = response.data.raw_data;
+      const orders = Array.isArray(rawData?.orders) ? rawData.orders : [];
+      const products = Array.isArray(rawData?.products) ? rawData.products : [];
+      const customers = Array.isArray(rawData?.customers) ? rawData.customers : [];
 
       // Revenue Data (by month)
       const revenueByMonth: Record<string, RevenueMonth> = {};